@@ -0,0 +1,1263 @@
+import os
+import time
+import asyncio
+import operator
+import collections
+import my_sock as msock
+import outq
+import registry
+import topiclog
+import workers
+import cluster
+import metrics
+import compress
+import dedup
+import retain
+import filters
+import idle
+import loops
+import concurrent.futures
+
+#-------
+# Global settings
+#-------
+
+_ack     = bytes(msock._ack + msock._delim, msock._str_enc)
+_bin_ack = msock.encode_frame(msock._ack)
+_options = {msock._opt_bin, msock._opt_node, msock._opt_credit,  # "_hello" options supported
+            msock._opt_zlib, msock._opt_zstd, msock._opt_dict, msock._opt_hdr}
+
+_registry   = registry.SubRegistry()            # tpc --> ((sid, SubProtocol), ..)
+_dirty_subs = set()                             # SubProtocols with queued messages
+_paused_subs = set()                            # SubProtocols whose transport paused writing
+_starved    = set()                             # PubProtocols out of credit (see regrant())
+_log        = None                              # topiclog.LogStore, with "log_dir"
+_peers      = ()                                # workers.Peer of every other worker, with "workers"
+_local_subs = {}                                # tpc --> subscriptions of this worker or node
+_cluster    = None                              # cluster.Cluster, with "cluster"
+_dicts      = compress.Dictionaries()           # of the topics, with "dict_dir"
+_producers  = None                              # dedup.Producers, with "dedup_window"
+_keys       = None                              # dedup.KeyCache, with "dedup_key_secs"
+_rings      = None                              # retain.RingStore, with "ring_msgs"
+_idle       = idle.IdleTimer()                  # deadlines of the connections, with "idle_secs" or pings
+_outstanding = operator.methodcaller('outstanding')
+
+_metrics = metrics.Metrics(('pubs', 'delivered', 'writes', 'dropped', 'blocked', 'overflows',
+                            'throttled_ms', 'compressed', 'duplicates', 'duplicate_keys', 'reaped'),
+                           ('pub_conns', 'sub_conns'), ('fanout_us',))
+_stats_cmd = 'stats'                            # "id stats" replies with "_stats"
+_stats  = _metrics.counters
+_topics = _metrics.topics                       # tpc --> [msgs, bytes] published
+_fanout = _metrics.histograms['fanout_us']      # usecs from reading messages to writing them out
+_render_secs = 5                                # wait of the metrics endpoint for the event loop
+
+_settings = {
+    'queue_msgs':  10000,                       # bound of each subscriber queue, in messages
+    'queue_bytes': 64 << 20,                    # and in bytes
+    'overflow':    'block',                     # outq._policies, when a queue is full
+    'log_dir':     None,                        # directory of the topic logs, None for no logs
+    'log_fsync':   'batch',                     # topiclog._fsync_policies
+    'log_fsync_ms': 1000,                       # for "interval"
+    'log_segment_bytes':   64 << 20,
+    'log_retention_bytes': 1 << 30,             # per topic, 0 for no limit
+    'log_retention_secs':  7 * 86400,           # 0 for no limit
+    'fetch_bytes': 1 << 20,                     # payload bytes replayed per "fetch" or catch-up read
+    'offsets_commit_ms': 1000,                  # msecs between writes of the committed offsets
+    'workers': 1,                               # processes sharing the ports (see workers.py)
+    'worker_ring_bytes': 4 << 20,               # size of the ring between each two workers
+    'cluster': None,                            # [(host, pub port, sub port), ..] (see cluster.py)
+    'node': 0,                                  # index of this node in "cluster"
+    'credit_msgs': 1000,                        # credit window of publishers with "_opt_credit"
+    'credit_bytes': 256 << 20,                  # bytes queued to subscribers that stop granting credit
+    'verbosity': metrics._info,                 # metrics._quiet, _info or _debug, of the logs
+    'metrics_port': None,                       # of the HTTP metrics endpoint, plus the worker index
+    'dict_dir': None,                           # directory of the compression dictionaries of the topics
+    'dedup_window': dedup._window,              # sequence numbers tracked per idempotent producer, 0 for none
+    'dedup_key_secs': 0,                        # secs message keys are deduplicated for, 0 for never
+    'dedup_keys': dedup._keys,                  # message keys remembered at most
+    'ring_msgs': retain._ring_msgs,             # last messages kept in memory per topic, 0 for none
+    'ring_bytes': retain._ring_bytes,           # and payload bytes
+    'ring_memory': retain._ring_memory,         # bytes of the rings of all the topics
+    'retain': 0,                                # last messages a "sub" gets first, unless asked otherwise
+    'keepalive_secs': 60,                       # TCP keepalive of the client connections, 0 for none
+    'idle_secs': idle._idle_secs,               # secs a client may stay silent, 0 for ever (see reap())
+    'loop': loops._loop,                        # event loop run on (see loops.py)
+}
+
+#-------
+# Protocols for handling publishers and subscribers
+#-------
+
+class FramedProtocol(asyncio.BufferedProtocol):
+    """
+    Base protocol receiving straight into the FrameReader of the connection
+    and handing each complete message to "handle_msg()", or each binary frame
+    to "handle_frame()" once the client negotiated "_opt_bin".
+    One instance is created per connection, all of them served by the
+    single thread running the event loop.
+    A client negotiating "_opt_node" is another node of the cluster ("peer").
+    A client negotiating a codec along with "_opt_bin" is sent the messages
+    compressed, once per codec (see compress.Codec), by "codec".
+    A client negotiating "_opt_hdr" along with "_opt_bin" is sent the
+    messages with their headers (see publish()), "hdr".
+    Connections are probed with TCP keepalive, after "keepalive_secs", and
+    disconnected once silent for "idle_secs", or for "_ping_grace" times
+    the interval of a client negotiating "_opt_ping=secs" (see reap());
+    "_ping" is answered with "_pong", and anything read counts as heard.
+    """
+    role = None
+    peer = False
+    codec = None
+    hdr = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.reader = msock.FrameReader()
+        self.binary = False
+        self.cid = None                         # client id, known after "_hello"
+        self.read_at = 0                        # time.perf_counter_ns() of the last read
+        self.read_us = 0                        # msock.now_us() of the last read, the ingress time
+        _metrics.gauges[self.role.lower() + '_conns'] += 1
+        if _settings['keepalive_secs']:
+            msock.set_keepalive(transport.get_extra_info('socket'), _settings['keepalive_secs'])
+        _idle.add(self, time.monotonic())
+        addr = transport.get_extra_info('peername')
+        metrics.log(metrics._info, "Broker> %s connected: %s:%d" % (self.role, addr[0], addr[1]))
+
+    def get_buffer(self, sizehint):
+        return self.reader.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.read_at = time.perf_counter_ns()
+        self.read_us = msock.now_us()
+        _idle.touch(self, time.monotonic())
+        self.reader.buffer_updated(nbytes)
+        for frame in self.reader.frames():
+            if self.binary:
+                cmd, flags, tpc, ext, payload = msock.decode_frame(frame)
+                if cmd == msock._ping:
+                    self.transport.write(msock.encode_pong(True))
+                else:
+                    self.handle_frame(cmd, flags, tpc, ext, payload, frame)
+                continue
+            smsg = str(frame, msock._str_enc).strip()
+            words = smsg.split(' ')
+            if len(words) > 1 and words[1] == msock._hello:
+                self.handle_hello(words)
+            elif len(words) == 2 and words[1] == _stats_cmd:
+                self.send_stats()
+            elif len(words) == 2 and words[1] == msock._ping:
+                self.transport.write(msock.encode_pong(False))
+            else:
+                self.handle_msg(smsg, words)
+        if self.reader.oversized:
+            self.transport.abort()
+            return
+        self.flush()
+
+    def connection_lost(self, exc):
+        _idle.remove(self)
+        _metrics.gauges[self.role.lower() + '_conns'] -= 1
+        metrics.log(metrics._info, "Broker> %s disconnected" % self.role)
+
+    def handle_hello(self, words):              # cid, _hello, options
+        """
+        Acks with the supported options among the requested ones;
+        the ack is the last text message when switching to binary frames.
+        """
+        self.cid = words[0]
+        opts = compress.accept([o for o in words[2:] if o in _options and
+                                (o != msock._opt_hdr or msock._opt_bin in words[2:]) or
+                                _producers is not None and msock.idem_producer((o,)) or
+                                msock.ping_secs((o,))], _dicts)
+        metrics.log(metrics._info, "Broker> %s %s negotiated %s" % (self.role, self.cid, opts))
+        self.transport.write(bytes(' '.join([msock._ack] + opts) + msock._delim,
+                                   msock._str_enc))
+        if msock._opt_bin in opts:
+            self.binary = self.reader.binary = True
+        if msock._opt_node in opts:
+            self.peer = True
+            _idle.remove(self)
+        elif msock.ping_secs(opts):
+            _idle.add(self, time.monotonic(), idle.ping_timeout(opts))
+        self.hdr = msock._opt_hdr in opts
+        self.codec = compress.codec(opts, _dicts)
+
+    def send_stats(self):
+        """
+        Replies to "id stats" with "_ack" followed by "name=value" counters.
+        """
+        queues = [(sid, proto.outq) for sid, proto in _registry.conns() if not proto.peer]
+        stats = outq.format_stats(_stats, queues)
+        self.transport.write(bytes('%s %s%s' % (msock._ack, stats, msock._delim), msock._str_enc))
+
+    def send_ack(self, seq=None):
+        """
+        Acks the last message, or cumulatively every message up to "seq".
+        """
+        self.transport.write(self.encode_ack(seq))
+
+    def encode_ack(self, seq=None):
+        """
+        Returns:
+            the ack of send_ack(), as bytes
+        """
+        if seq is None:
+            return _bin_ack if self.binary else _ack
+        if self.binary:
+            return msock.encode_frame(msock._ack, seq=seq)
+        return bytes('%s %d%s' % (msock._ack, seq, msock._delim), msock._str_enc)
+
+    def flush(self):
+        """
+        Called once all the frames of a read have been handled.
+        """
+        pass
+
+    def handle_msg(self, smsg, words):
+        """
+        Handles a text command of the client, ignored unless overridden.
+        """
+        pass
+
+    def handle_frame(self, cmd, flags, tpc, ext, payload, frame):
+        """
+        Handles a binary frame of the client, ignored unless overridden.
+        """
+        pass
+
+#------
+
+class PubProtocol(FramedProtocol):
+    """
+    Handles one publisher connection.
+    Publishes carrying a sequence number are acked cumulatively, with one
+    ack for the highest sequence number of every read, so a pipelining
+    publisher gets a single ack for all the messages of a window.
+    All the acks of a read are sent once its messages are logged.
+    A "pubbatch" carries many messages and is acked once, as a whole;
+    in text it is the line "pid[:seq] pubbatch n" followed by n lines
+    "tpc msg".
+    The message key of a binary message is its key for "key-hash" consumer
+    groups, the producer id for those without one: the producer of its
+    headers, if any, or the publisher id, "pid" in text or the id given in
+    "_hello".
+    In a cluster, the acks of a read with messages forwarded to the nodes
+    owning their topics wait in "waiting" until those nodes acked them,
+    and the acks of the later reads wait behind them (see forward_acked());
+    while a node is down, reading stops once its link holds too many
+    batches unacked (see cluster.PubLink).
+    A publisher negotiating "_opt_credit" sends only the messages the
+    broker granted it credit for (see grant()), instead of being blocked
+    once it filled the queues of the subscribers.
+    An idempotent publisher, negotiating "_opt_idem=producer", numbers its
+    messages per producer rather than per connection: those it sends again,
+    e.g. after a lost ack, are acked and dropped before fan-out (see
+    duplicate()), as are the "pub" frames whose message key was seen on
+    their topic within "dedup_key_secs" (see duplicate_key()).
+    Binary messages may carry headers (see my_sock.hdr_ext()), the
+    priority they are queued to subscribers with among them; the time of
+    each read is their ingress time (see publish()).
+    The time from reading messages until they are written out to their
+    subscribers, once per read, goes to the "fanout_us" histogram.
+    """
+    role = "Pub"
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.blocked_by = set()                 # full SubProtocol queues, or cluster.PubLinks, blocking it
+        self.ack_seq = None                     # highest sequence number not yet acked
+        self.acks = 0                           # plain acks not yet sent
+        self.batch_left = 0                     # text "pubbatch" lines still to come
+        self.batch_seq  = None
+        self.batch_pid  = None
+        self.batch_dup  = False                 # the text "pubbatch" is a duplicate
+        self.producer   = None                  # producer id, of an idempotent publisher
+        self.links = set()                      # cluster.PubLinks forwarded to in this read
+        self.waiting = collections.deque()      # [links left, acks], in read order
+        self.credit = False                     # negotiated "_opt_credit"
+        self.received = 0                       # messages received
+        self.fanned = 0                         # messages received and written out, or queued
+        self.granted = 0                        # credit granted, up to the granted-th message
+        self.throttled = None                   # time.monotonic() since throttled
+
+    def handle_hello(self, words):
+        super().handle_hello(words)
+        self.credit = msock._opt_credit in words[2:]
+        if _producers is not None:
+            self.producer = msock.idem_producer(words[2:])
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        _starved.discard(self)
+        self.blocked_by.clear()
+        self.throttle()
+
+    def flush(self):
+        if _log is not None:
+            _log.sync()
+        acks = b''
+        if self.acks:
+            acks = (_bin_ack if self.binary else _ack) * self.acks
+            self.acks = 0
+        if self.ack_seq is not None:
+            acks += self.encode_ack(self.ack_seq)
+            self.ack_seq = None
+        if self.links or self.waiting and acks:
+            entry = [len(self.links), acks]
+            self.waiting.append(entry)
+            for link in self.links:
+                link.wait(self, entry)
+            self.links.clear()
+        elif acks:
+            self.transport.write(acks)
+        if self.credit:
+            self.grant()
+        if _cluster is not None:
+            _cluster.flush()
+        else:
+            flush_subs()
+        if self.received > self.fanned:
+            usecs = (time.perf_counter_ns() - self.read_at) // 1000
+            _fanout.record(usecs, self.received - self.fanned)
+            self.fanned = self.received
+
+    def forward_acked(self, entry):
+        """
+        Called once a node acked the messages of "entry" forwarded to it;
+        writes the acks whose messages every node acked, in order.
+        """
+        entry[0] -= 1
+        while self.waiting and self.waiting[0][0] <= 0:
+            acks = self.waiting.popleft()[1]
+            if acks and not self.transport.is_closing():
+                self.transport.write(acks)
+
+    def grant(self):
+        """
+        Grants credit for "credit_msgs" messages past those received,
+        shrunk as the queues of the paused subscribers fill "credit_bytes"
+        (see outq.credit_window()), and none while this publisher fills a
+        subscriber queue. A grant is sent once half a window is due; out of
+        credit, the publisher waits in "_starved" (see regrant()).
+        """
+        window = 0
+        if not self.blocked_by:
+            window = outq.credit_window(_settings['credit_msgs'], queued_bytes(),
+                                        _settings['credit_bytes'])
+        limit = self.received + window
+        if window and limit - self.granted >= max(1, window // 2):
+            self.granted = limit
+            self.transport.write(msock.encode_credit(self.binary, limit))
+        if self.received >= self.granted:
+            _starved.add(self)
+        else:
+            _starved.discard(self)
+        self.throttle()
+
+    def throttle(self):
+        """
+        Adds to "_stats" the time this publisher spent throttled, either
+        out of credit or not read while it blocks a subscriber queue.
+        """
+        throttled = bool(self.blocked_by) or self in _starved
+        if throttled and self.throttled is None:
+            self.throttled = time.monotonic()
+        elif not throttled and self.throttled is not None:
+            _stats['throttled_ms'] += round((time.monotonic() - self.throttled) * 1000)
+            self.throttled = None
+
+    def block(self, by):
+        """
+        Stops reading from this publisher while "by" blocks it, a full
+        SubProtocol queue or a cluster.PubLink behind on its acks, along
+        with its idle deadline, as its pings are not read either.
+        Returns:
+            True, if newly blocked by "by"
+        """
+        if by in self.blocked_by:
+            return False
+        if not self.blocked_by:
+            self.transport.pause_reading()
+            _idle.suspend(self)
+            _stats['blocked'] += 1
+        self.blocked_by.add(by)
+        self.throttle()
+        return True
+
+    def unblock(self, by):
+        """
+        Resumes reading from this publisher once nothing blocks it, and
+        its idle deadline from now.
+        """
+        self.blocked_by.discard(by)
+        if not self.blocked_by and not self.transport.is_closing():
+            self.transport.resume_reading()
+            _idle.resume(self, time.monotonic())
+            if self in _starved:
+                self.grant()
+        self.throttle()
+
+    def ack(self, seq):
+        if seq is None:
+            self.acks += 1
+        else:
+            self.ack_seq = seq
+
+    def duplicate(self, seq):
+        """
+        Returns:
+            True, if this idempotent publisher sent message "seq" before
+            (see dedup.Producers), so it is only to be acked
+        """
+        if self.producer is None or seq is None or not _producers.duplicate(self.producer, seq):
+            return False
+        _stats['duplicates'] += 1
+        return True
+
+    def duplicate_key(self, tpc, key):
+        """
+        Returns:
+            True, if message key "key" was seen on topic "tpc" within
+            "dedup_key_secs" (see dedup.KeyCache), so it is only to be acked
+        """
+        if key is None or _keys is None or not _keys.duplicate(bytes(tpc), key):
+            return False
+        _stats['duplicate_keys'] += 1
+        return True
+
+    def handle_msg(self, smsg, words):          # pub_id[:seq], cmd, tpc, msg
+        if self.batch_left:                     # tpc, msg
+            self.batch_left -= 1
+            if not self.batch_dup:
+                publish(bytes(words[0], msock._str_enc), bytes(' '.join(words[1:]), msock._str_enc),
+                        pub=self, producer=self.batch_pid)
+            if not self.batch_left:
+                self.ack(self.batch_seq)
+            return
+        if metrics.verbosity >= metrics._debug:
+            print("Broker> Received from Pub <%s>" % smsg)
+
+        if len(words) < 3:
+            print("Broker> Invalid publisher command")
+            return
+        pid, cmd, tpc, msg = words[0], words[1], words[2], ' '.join(words[3:])
+        pid, _, seq = pid.partition(msock._seq_sep)
+        seq = int(seq) if seq.isdigit() else None
+
+        if cmd == "pubbatch" and tpc.isdigit() and int(tpc) > 0:
+            self.batch_left, self.batch_seq, self.batch_pid = int(tpc), seq, pid
+            self.batch_dup = self.duplicate(seq)
+            return
+        self.ack(seq)
+
+        if cmd != "pub":
+            print("Broker> Invalid publisher command")
+            return
+        if self.duplicate(seq):
+            return
+
+        publish(bytes(tpc, msock._str_enc), bytes(msg, msock._str_enc), pub=self, producer=pid)
+
+    def handle_frame(self, cmd, flags, tpc, ext, payload, frame):
+        seq = msock.frame_seq(flags, ext)
+        self.ack(seq)
+        key = msock.frame_key(flags, ext)
+        if self.duplicate(seq) or self.duplicate_key(tpc, key):
+            return
+        hdrs = msock.frame_headers(flags, ext)
+
+        packed = None
+        if flags & compress._zip_flags:
+            packed = payload
+            payload = compress.unpack(flags, ext, packed, _dicts)
+            if payload is None:
+                print("Broker> Cannot decompress %s of %s, dropped" % (cmd, self.cid))
+                return
+        if cmd == "pubbatch":
+            for tpc, payload in msock.iter_batch(payload):
+                publish(tpc, payload, pub=self, producer=self.cid, headers=hdrs, key=key)
+            return
+        if cmd != "pub":
+            print("Broker> Invalid publisher command")
+            return
+        if packed is not None:
+            publish(tpc, payload, None, self, self.cid,
+                    packed=compress.repack(flags, ext, tpc, packed, _dicts), headers=hdrs, key=key)
+            return
+
+        frame = msock.retag_frame(frame, 'msg')
+        _, _, tpc, _, payload = msock.decode_frame(frame)
+        publish(tpc, payload, frame, self, self.cid, headers=hdrs, key=key)
+
+#------
+
+class SubProtocol(FramedProtocol):
+    """
+    Handles one subscriber connection.
+    "sid fetch tpc offset" replays the log of a topic (see fetch()).
+    "sid sub|unsub tpc group name [policy]" joins or leaves a consumer
+    group of the topic (see membership()).
+    "sid sub tpc from offset|earliest|latest", or "sid sub tpc" for a
+    subscriber id that committed an offset of "tpc", replays the log from
+    there and then goes on with the live messages (see catch_up()).
+    On disconnection the subscriber is removed from every topic.
+    In a cluster, what needs the log of a topic owned by another node goes
+    through a cluster.Relay to that node, kept in "relays"; the link from
+    another node also joins consumer groups on behalf of its members,
+    kept in "members" (see linked_member()).
+    """
+    role = "Sub"
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.outq = outq.OutQueue(_settings['queue_msgs'], _settings['queue_bytes'],
+                                  _settings['overflow'])
+        self.paused = False                     # transport asked to pause writing
+        self.blocking = set()                   # PubProtocols blocked by "outq"
+        self.catching = {}                      # tpc --> (sid, offset), replaying its log
+        self.live_from = {}                     # tpc --> first offset delivered live
+        self.scheduled = False                  # catch_up() is to be called soon
+        self.relays = {}                        # tpc, or the Relay of a fetch --> cluster.Relay
+        self.members = {}                       # (tpc, name, sid) --> workers.PeerMember
+
+    def handle_msg(self, smsg, words):          # subid, cmd, tpc OR _ack
+        metrics.log(metrics._info, "Broker> Received from sub <%s>" % smsg)
+
+        if len(words) == 1:                     # _ack
+            return
+        if len(words) == 4 and words[1] == "fetch" and words[3].isdigit():
+            fetch(self, words[2], int(words[3]))
+            return
+        opts = msock.sub_options(words[3:]) if len(words) >= 3 else None
+        if opts is None:
+            print("Broker> Invalid subscriber command")
+            return
+        self.send_ack()
+        subscription(self, words[0], words[1], words[2], *opts)
+
+    def handle_frame(self, cmd, flags, tpc, ext, payload, frame):
+        if cmd == msock._ack:
+            return
+        if cmd == "fetch":
+            fetch(self, str(tpc, msock._str_enc), msock.frame_seq(flags, ext) or 0)
+            return
+        words = str(payload, msock._str_enc).split(' ')
+        if self.peer and len(words) == 4 and words[0] == 'group':
+            self.send_ack()
+            linked_member(self, cmd, str(tpc, msock._str_enc), *words[1:])
+            return
+        opts = msock.sub_options(words)
+        if opts is None:
+            print("Broker> Invalid subscriber command")
+            return
+        self.send_ack()
+        subscription(self, self.cid, cmd, str(tpc, msock._str_enc), *opts)
+
+    def flush(self):
+        flush_subs()
+
+    def outstanding(self):
+        """
+        Returns:
+            the messages queued and not yet handed to the transport,
+            the load of "least-outstanding" consumer groups
+            (see _outstanding)
+        """
+        return len(self.outq)
+
+    def queue(self, parts, pub, bounded=True, priority=0, stamp=None):
+        """
+        Queues the buffers of a message, written by flush_subs(), in the
+        lane of its "priority", with the "stamp" of its egress time if any
+        (see outq.OutQueue).
+        While the transport has paused writing the queue is bounded, unless
+        not "bounded" (for replies already bounded in size), and,
+        when full, the overflow policy applies: publisher "pub" stops being
+        read until the queue drains, or the message or older ones are
+        dropped, or the subscriber is disconnected.
+        """
+        if self.transport.is_closing():
+            return
+        res = self.outq.put(parts, sum(len(p) for p in parts), self.paused and bounded, priority, stamp)
+        if res == outq._overflow:
+            print("Broker> Sub %s queue overflow, disconnecting" % self.cid)
+            _stats['overflows'] += 1
+            self.transport.abort()
+            return
+        _dirty_subs.add(self)
+        _stats['delivered'] += 1
+        if res == outq._dropped:
+            _stats['dropped'] += 1
+        elif res == outq._full and pub is not None and pub.block(self):
+            self.blocking.add(pub)
+
+    def flush_out(self):
+        """
+        Writes the queued messages, unless the transport asked to pause
+        writing, in which case they wait in the queue, copied out of the
+        reusable buffers they may view (see outq.detached()). So are those
+        handed to the transport, which keeps whatever it cannot send at once
+        in its write buffer, views included (Python 3.12 on, and uvloop).
+        """
+        if self.paused:
+            self.outq.detach()
+            return
+        bufs = outq.detached(self.outq.take())
+        if len(bufs) == 1:
+            self.transport.write(bufs[0])
+        elif bufs:
+            self.transport.writelines(bufs)
+        if self.blocking and self.outq.low():
+            self.unblock()
+
+    def unblock(self):
+        """
+        Resumes reading from the publishers blocked by this queue.
+        """
+        for pub in self.blocking:
+            pub.unblock(self)
+        self.blocking.clear()
+        if _starved:
+            regrant()
+
+    def pause_writing(self):
+        self.paused = True
+        _paused_subs.add(self)
+
+    def resume_writing(self):
+        self.paused = False
+        _paused_subs.discard(self)
+        self.flush_out()
+        if _starved:
+            regrant()
+        if self.catching:
+            self.catch_up()
+        for relay in list(self.relays.values()):
+            relay.resume()
+
+    def catch_up(self):
+        """
+        Replays the logs of the topics in "catching", one read of
+        "fetch_bytes" per topic each time, written before the next one and
+        only while the transport takes data (else resume_writing() goes on).
+        A topic whose log end is reached switches to live messages: being
+        served by one thread, no message is published in between.
+        """
+        self.scheduled = False
+        for tpc, (sid, offset) in list(self.catching.items()):
+            if self.paused or self.transport.is_closing():
+                return
+            log = _log.get(tpc)
+            if offset >= log.end():
+                del self.catching[tpc]
+                self.live_from[tpc] = offset
+                metrics.log(metrics._info, "Broker> Sub %s caught up with %s at %d" %
+                            (sid, tpc, offset))
+                continue
+            recs, nxt = log.read(offset, _settings['fetch_bytes'])
+            btpc = bytes(tpc, msock._str_enc)
+            for off, ts, payload in recs:
+                self.queue(msock.msg_parts(btpc, payload, self.binary, off), None, False)
+            _log.offsets.commit(sid, tpc, nxt)
+            self.catching[tpc] = (sid, nxt)
+        flush_subs()
+        if self.catching and not self.scheduled:
+            self.scheduled = True
+            asyncio.get_running_loop().call_soon(self.catch_up)
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        _dirty_subs.discard(self)
+        _paused_subs.discard(self)
+        self.unblock()
+        for relay in list(self.relays.values()):
+            relay.close()
+        for member in self.members.values():
+            _registry.drop(member)
+        for pair in _registry.drop(self):
+            if not replicated(self):
+                break
+            if len(pair) == 3:
+                announce("unsub", pair[0], 'group %s - %s' % (pair[2], pair[1]))
+            else:
+                local_interest(pair[0], -1)
+        flush_subs()
+
+#-------
+# Subscriptions and fan-out
+#-------
+
+def subscription(proto, sid, cmd, tpc, frm=None, group=None, policy=None, where=None):
+    """
+    Applies a "sub" or "unsub" command of subscriber "sid" on "proto".
+    With the logs on, a "sub" to a topic replays its log from "frm"
+    or, if None, from the offset "sid" committed last (see catch_up()).
+    With the rings on, a "sub" gets the last messages kept of the topic,
+    or of every topic matching the pattern, the last K for 'last K' ("frm"
+    '-K') or "retain" unless replaying a log, then the live ones (see
+    retained()).
+    With "where", the words of a filter, a "sub" gets only the messages
+    matching it, live ones, and the last ones kept (see filters.py).
+    With "group" it applies to the membership of consumer group "group".
+    In a cluster, a "sub" needing the log or the ring of a topic owned by
+    another node is relayed to it (see cluster.Relay).
+    """
+    if group is not None and (cmd == "sub" or cmd == "unsub" and policy is None):
+        membership(proto, sid, cmd, tpc, group, policy or registry._group_policies[0])
+        return
+    if cmd != "sub" and cmd != "unsub" or frm is not None and cmd != "sub" or group is not None:
+        print("Broker> Invalid subscriber command")
+        return
+    if where is not None:
+        where = filters.parse(where)
+        if where is None or cmd != "sub":
+            print("Broker> Invalid subscriber command, bad filter")
+            return
+
+    if (_cluster is not None and not proto.peer and not msock.is_pattern(tpc) and where is None and
+            _cluster.owner(tpc) != _cluster.me and
+            (frm is not None or _log is not None or _rings is not None and _settings['retain'])):
+        relayed(proto, sid, cmd, tpc, frm)
+        return
+
+    last = msock.last_count(frm)
+    start = None
+    if (cmd == "sub" and last is None and where is None and _log is not None and not proto.peer and
+            not msock.is_pattern(tpc)):
+        start = _log.start_offset(sid, tpc, frm)
+    if start == -1:
+        print("Broker> Invalid subscriber command, bad offset %s" % frm)
+        return
+    if last is None and start is None and not proto.peer:
+        last = _settings['retain']
+
+    if cmd == "sub":
+        if start is not None and tpc not in proto.catching:
+            proto.live_from[tpc] = float('inf')
+        res = _registry.subscribe(tpc, sid, proto, where)
+        if res is None:
+            print("Broker> Invalid topic pattern")
+        elif res:
+            metrics.log(metrics._info, "Broker> New subscriber for topic")
+            if replicated(proto) and res is True:   # not moved from another connection
+                local_interest(tpc, 1)
+        else:
+            metrics.log(metrics._info, "Broker> Subscriber already subscribed")
+        if start is not None and res:
+            metrics.log(metrics._info, "Broker> Replaying %s from %d" % (tpc, start))
+            proto.catching[tpc] = (sid, start)
+            proto.catch_up()
+        elif start is not None and tpc not in proto.catching:
+            proto.live_from.pop(tpc, None)
+        elif res and last:
+            retained(proto, tpc, last, where)
+    elif _registry.unsubscribe(tpc, sid):
+        proto.catching.pop(tpc, None)
+        proto.live_from.pop(tpc, None)
+        metrics.log(metrics._info, "Broker> Unsubscription")
+        if replicated(proto):
+            local_interest(tpc, -1)
+    else:
+        print("Broker> Invalid unsubscription, no previous subscription")
+
+#------
+
+def retained(proto, tpc, k, where=None):
+    """
+    Queues to "proto", just subscribed, the last "k" messages kept of topic
+    "tpc", or of every topic matching it if a pattern, of those matching
+    filters.Filter "where" if given. Nothing can be
+    published in between, on the thread of the event loop, so they are
+    followed by the live messages without a gap or a duplicate.
+    """
+    if _rings is None:
+        return
+    if msock.is_pattern(tpc):
+        tpcs = [t for t in list(_rings.rings) if msock.matches(tpc, t)]
+    else:
+        tpcs = [tpc]
+    n = 0
+    for t in tpcs:
+        btpc = bytes(t, msock._str_enc)
+        for payload in _rings.last(t, k):
+            if where is None or where.matches(filters.fields(payload)):
+                proto.queue(msock.msg_parts(btpc, payload, proto.binary), None, False)
+                n += 1
+    if n:
+        metrics.log(metrics._info, "Broker> Sent %d retained messages of %s" % (n, tpc))
+
+#------
+
+def membership(proto, sid, cmd, tpc, group, policy):
+    """
+    Adds subscriber "sid" on "proto" to consumer group "group" of topic
+    "tpc", or removes it, rebalancing the group. Groups are live only:
+    their messages are neither replayed nor committed as offsets.
+    With "workers" every worker keeps every member of the group.
+    """
+    if cmd == "sub":
+        res = _registry.join(tpc, group, sid, proto, policy)
+        if res is None:
+            print("Broker> Invalid group subscription, bad topic or policy")
+        elif res is False:
+            metrics.log(metrics._info, "Broker> Subscriber already in group")
+        else:
+            if res.policy != policy:
+                metrics.log(metrics._info, "Broker> Group %s keeps policy %s" % (group, res.policy))
+            metrics.log(metrics._info, "Broker> Group %s of %s rebalanced over %d members" %
+                        (group, tpc, len(res.members)))
+            announce("sub", tpc, 'group %s %s %s' % (group, res.policy, sid))
+        return
+    res = _registry.leave(tpc, group, sid)
+    if res is None:
+        print("Broker> Invalid group unsubscription, not a member")
+    else:
+        metrics.log(metrics._info, "Broker> Group %s of %s rebalanced over %d members" %
+                    (group, tpc, len(res.members)))
+        announce("unsub", tpc, 'group %s - %s' % (group, sid))
+
+#------
+
+def relayed(proto, sid, cmd, tpc, frm):
+    """
+    Applies a "sub" or "unsub" command of subscriber "sid" on "proto" to
+    topic "tpc" owned by another node, through a cluster.Relay to it.
+    """
+    if cmd == "sub":
+        if tpc in proto.relays:
+            metrics.log(metrics._info, "Broker> Subscriber already subscribed")
+            return
+        _cluster.relay(proto, sid, tpc, frm)
+        metrics.log(metrics._info, "Broker> Relaying %s from node %d" % (tpc, _cluster.owner(tpc)))
+    elif tpc in proto.relays:
+        proto.relays.pop(tpc).close()
+        metrics.log(metrics._info, "Broker> Unsubscription")
+    else:
+        print("Broker> Invalid unsubscription, no previous subscription")
+
+#------
+
+def linked_member(proto, cmd, tpc, name, policy, sid):
+    """
+    Adds member "sid" of consumer group "name", connected to the node
+    linked by "proto", to the group of topic "tpc" kept by this node,
+    owning it, or removes it.
+    """
+    if cmd == "sub":
+        member = workers.PeerMember(proto, name, sid)
+        if _registry.join(tpc, name, sid, member, policy):
+            proto.members[(tpc, name, sid)] = member
+    elif proto.members.pop((tpc, name, sid), None) is not None:
+        _registry.leave(tpc, name, sid)
+
+#------
+
+def publish(tpc, payload, frame=None, pub=None, producer=None, forwarded=False, packed=None, headers=None,
+            key=None):
+    """
+    Queues a published message to every subscriber of its topic.
+    Each encoding (text or binary) is built at most once per message and
+    shared by all the subscribers using it; "frame", when given, is the
+    received binary frame already tagged as "msg" and is forwarded as it is,
+    otherwise binary subscribers get a header followed by the topic and the
+    payload buffers. Topic, payload, "frame" and "packed" are bytes-like,
+    possibly views of the receive buffer of "pub": once the message has
+    subscribers they are copied, once for all of them, as transports keep
+    the buffers they are written (Python 3.12 on) while the next read reuses
+    that receive buffer. "pub" is the publishing PubProtocol.
+    With "log_dir" every message is also appended to the log of its topic,
+    skipped for the subscribers replaying the log up to it, and its offset
+    is committed for the subscribers it is queued to.
+    Subscribers with a filter get the message only if it matches, the
+    filters of the topic matched at once (see registry.SubRegistry.filtered()).
+    Each consumer group of the topic gets the message once, queued to the
+    member picked by its policy; "key-hash" groups hash the message "key",
+    bytes, or the producer id if it has none (see my_sock.group_key()).
+    With "workers" the other workers with subscribers of the topic are in
+    the registry too, as workers.Peer, and get the message once each,
+    "forwarded" to their own subscribers only.
+    In a cluster, a message to a topic owned by another node is forwarded
+    to it, which publishes it and sends it back "forwarded" to the nodes
+    subscribed to the topic, through the links from those nodes.
+    Subscribers with a codec get a compressed frame, built once per codec
+    and shared too, or "packed", (Codec, buffers), the frame as compressed
+    by the publisher, for those of its codec.
+    The message is queued in the lane of the priority of its "headers",
+    my_sock.Headers if published with some, so that it overtakes those of
+    lower priorities waiting in the queues. Subscribers with "_opt_hdr" get
+    a frame of their own with the headers, the key and the producer id,
+    the id of the publisher "producer" by default, and the ingress time of the
+    read of "pub", their egress time set as it is written (see
+    my_sock.hdr_parts()). Messages forwarded between workers or nodes, and
+    those replayed, go without headers, at the default priority.
+    """
+    _stats['pubs'] += 1
+    if pub is not None:
+        pub.received += 1
+    stpc = str(tpc, msock._str_enc)
+    counts = _topics.get(stpc) or _metrics.topic(stpc)
+    counts[0] += 1
+    counts[1] += len(payload)
+    if _cluster is not None and not forwarded and (pub is None or not pub.peer):
+        node = _cluster.owner(stpc)
+        if node != _cluster.me:
+            link = _cluster.forward(node, tpc, payload)
+            if pub is not None:
+                pub.links.add(link)
+            return
+    offset = None
+    if _log is not None and not forwarded:
+        offset = _log.append(stpc, payload)
+    if _rings is not None:
+        _rings.append(stpc, payload)
+    subcs = _registry.subscribers(stpc)
+    if _registry.filters:
+        subcs += _registry.filtered(stpc, payload, subcs)
+    groups = () if forwarded else _registry.consumer_groups(stpc)
+    if groups:
+        gkey = msock.group_key(key, headers, producer)
+        subcs += tuple((None, m[1]) for m in (g.pick(gkey, _outstanding) for g in groups)
+                       if m is not None)
+    if not subcs:
+        return
+    if frame is not None:
+        frame = bytes(frame)
+        _, _, tpc, _, payload = msock.decode_frame(memoryview(frame))
+    else:
+        tpc, payload = bytes(tpc), bytes(payload)
+    if packed is not None:
+        packed = (packed[0], tuple(bytes(b) for b in packed[1]))
+
+    parts = text = zips = hdrs = None
+    priority = min(headers.priority, msock._priorities - 1) if headers is not None else 0
+    if frame is not None:
+        parts = (frame,)
+    for sid, proto in subcs:
+        if forwarded and proto.peer:
+            continue
+        if offset is not None and sid is not None and not proto.peer:
+            if proto.live_from and offset < proto.live_from.get(stpc, offset + 1):
+                continue
+            _log.offsets.commit(sid, stpc, offset + 1)
+        zparts = None
+        if proto.codec is not None:
+            if zips is None:
+                zips = dict((packed,)) if packed is not None else {}
+            zparts = zips.get(proto.codec, ())
+            if zparts == ():
+                zparts = zips[proto.codec] = proto.codec.msg_parts(tpc, stpc, payload)
+                _stats['compressed'] += zparts is not None
+            if zparts is not None and not proto.hdr:
+                proto.queue(zparts, pub, True, priority)
+                continue
+        if proto.hdr:
+            if hdrs is None:
+                hdrs = msock.received_headers(headers, pub.read_us if pub is not None else msock.now_us(),
+                                              producer)
+            if zparts is not None:
+                hparts, stamp = msock.hdr_parts(tpc, zparts[3], hdrs,
+                                                msock._bin_hdr.unpack_from(zparts[0])[1], zparts[2])
+            else:
+                hparts, stamp = msock.hdr_parts(tpc, payload, hdrs)
+            proto.queue(hparts, pub, True, priority, stamp)
+        elif proto.binary:
+            if parts is None:
+                parts = msock.msg_parts(tpc, payload, True)
+            proto.queue(parts, pub, True, priority)
+        else:
+            if text is None:
+                text = (b''.join((tpc, b' ', payload, msock._bdelim)),)
+            proto.queue(text, pub, True, priority)
+
+#-------
+# Worker processes and cluster nodes
+#-------
+
+def replicated(proto):
+    """
+    Returns:
+        True, if the subscriptions of "proto" are told to the other
+        workers or nodes (see local_interest())
+    """
+    return not proto.peer and (bool(_peers) or _cluster is not None)
+
+#------
+
+def local_interest(tpc, delta):
+    """
+    Counts the subscriptions of this worker or node to topic or pattern
+    "tpc", telling the other workers or nodes when it gets its first one
+    or loses its last.
+    """
+    n = _local_subs.get(tpc, 0) + delta
+    if n > 0:
+        _local_subs[tpc] = n
+    else:
+        _local_subs.pop(tpc, None)
+    if n == 1 and delta > 0:
+        announce("sub", tpc)
+    elif n <= 0:
+        announce("unsub", tpc)
+
+#------
+
+def announce(cmd, tpc, payload=''):
+    """
+    Sends a change of the subscriptions of this worker to the other workers,
+    as a "sub" or "unsub" frame, of a group member if "payload" is
+    "group name policy sid" (see forwarded()), or to the other nodes
+    (see cluster.Cluster.announce()).
+    """
+    if _cluster is not None:
+        _cluster.announce(cmd, tpc, payload)
+    if not _peers:
+        return
+    frame = msock.encode_frame(cmd, bytes(tpc, msock._str_enc), bytes(payload, msock._str_enc))
+    for peer in _peers:
+        peer.send((frame,), len(frame))
+
+#------
+
+def forwarded(peer, frame):
+    """
+    Handles a frame read from the ring of worker "peer": a message to deliver
+    to the local subscribers, or to the group member named in its ext, or a
+    change of the subscriptions of "peer", applied to the registry.
+    Also handles the messages received over a cluster.SubLink, "peer" None.
+    """
+    cmd, flags, tpc, ext, payload = msock.decode_frame(frame)
+    if cmd == "msg" and flags & workers._flag_member:
+        name, _, sid = (str(b, msock._str_enc) for b in bytes(ext).partition(workers._member_sep))
+        for group in _registry.consumer_groups(str(tpc, msock._str_enc)):
+            if group.name != name:
+                continue
+            proto = group.conns.get(sid)
+            if proto is None:                   # left meanwhile
+                m = group.pick(None, _outstanding)
+                proto = m[1] if m is not None else None
+            if proto is not None:
+                proto.queue(msock.msg_parts(tpc, payload, proto.binary), None)
+        return
+    if cmd == "msg":
+        publish(tpc, payload, frame, forwarded=True)
+        return
+
+    stpc = str(tpc, msock._str_enc)
+    words = str(payload, msock._str_enc).split(' ')
+    if len(words) == 4 and words[0] == 'group':
+        _, name, policy, sid = words
+        if cmd == "sub":
+            _registry.join(stpc, name, sid, workers.PeerMember(peer, name, sid), policy)
+        else:
+            _registry.leave(stpc, name, sid)
+    elif cmd == "sub":
+        _registry.subscribe(stpc, peer.cid, peer)
+    else:
+        _registry.unsubscribe(stpc, peer.cid)
+
+#------
+
+def read_workers(fd, inbox, peers):
+    """
+    Reads the rings from the other workers, once woken up by their doorbell.
+    """
+    try:
+        os.read(fd, 65536)
+    except BlockingIOError:
+        pass
+    for src, ring in inbox:
+        for frame in ring.get():
+            forwarded(peers[src], frame)
+    flush_subs()
+
+#------
+
+def fetch(proto, tpc, offset):
+    """
+    Replays to subscriber "proto" the logged messages of topic "tpc" from
+    "offset" on, up to "fetch_bytes" of them, followed by the ack "_ack next"
+    with the offset to fetch next; binary messages carry their offset as
+    sequence number. Payloads are written straight from the mapped log
+    segments, and everything is queued behind the live messages already
+    queued to the subscriber.
+    In a cluster, the fetch of a topic owned by another node is relayed to it.
+    """
+    if _cluster is not None and _cluster.owner(tpc) != _cluster.me:
+        _cluster.relay(proto, proto.cid or 'fetch', tpc, fetch=offset)
+        return
+    recs, nxt = [], offset
+    if _log is not None:
+        recs, nxt = _log.read(tpc, offset, _settings['fetch_bytes'])
+    metrics.log(metrics._info, "Broker> Sub %s fetched %d msgs of %s from %d" %
+                (proto.cid, len(recs), tpc, offset))
+    btpc = bytes(tpc, msock._str_enc)
+    for off, ts, payload in recs:
+        proto.queue(msock.msg_parts(btpc, payload, proto.binary, off), None, False)
+    if proto.binary:
+        ack = msock.encode_frame(msock._ack, seq=nxt)
+    else:
+        ack = bytes('%s %d%s' % (msock._ack, nxt, msock._delim), msock._str_enc)
+    proto.queue((ack,), None, False)
+
+#------
+
+def queued_bytes():
+    """
+    Returns:
+        the bytes queued to the subscribers, held by those paused only
+    """
+    return sum(proto.outq.nbytes for proto in _paused_subs)
+
+#------
+
+def regrant():
+    """
+    Grants credit again to the publishers out of it, once a subscriber
+    queue drained or went away.
+    """
+    for pub in list(_starved):
+        if not pub.transport.is_closing():
+            pub.grant()
+
+#------
+
+def flush_subs():
+    """
+    Writes to every subscriber the messages queued since the last flush,
+    coalesced into a single (vectored) write per subscriber.
+    """
+    for proto in _dirty_subs:
+        if not proto.paused:
+            _stats['writes'] += 1
+        proto.flush_out()
+    _dirty_subs.clear()
+
+#------
+
+def reap():
+    """
+    Disconnects the connections silent past their deadline (see
+    idle.IdleTimer), connection_lost() then removing them from every
+    topic and group, and runs again in "_tick_secs", one timer for all.
+    """
+    for proto in _idle.expired(time.monotonic()):
+        print("Broker> %s %s silent for too long, disconnecting" % (proto.role, proto.cid))
+        _stats['reaped'] += 1
+        proto.transport.abort()
+    asyncio.get_running_loop().call_later(_idle.tick_secs, reap)
+
+#------
+
+def render_metrics():
+    """
+    Returns:
+        the text of the metrics endpoint (see metrics.Metrics.render())
+    """
+    queues = [(sid, proto.outq) for sid, proto in _registry.conns() if not proto.peer]
+    gauges = {'queued_msgs': sum(len(q) for sid, q in queues),
+              'queued_bytes': sum(q.nbytes for sid, q in queues),
+              'paused_subs': len(_paused_subs), 'starved_pubs': len(_starved)}
+    rings = ()
+    if _rings is not None:
+        gauges.update(rings=len(_rings), rings_memory=_rings.memory, rings_evicted=_rings.evicted)
+        rings = _rings.stats()
+    return _metrics.render(gauges, queues, rings)
+
+#------
+
+def in_loop(loop, fn):
+    """
+    Calls "fn()" from another thread in the thread of the event loop "loop",
+    where the state of the broker may be read safely.
+    Returns:
+        the result of "fn()"
+    """
+    fut = concurrent.futures.Future()
+    def call():
+        try:
+            fut.set_result(fn())
+        except Exception as err:
+            fut.set_exception(err)
+    loop.call_soon_threadsafe(call)
+    return fut.result(_render_secs)
+
+#-------
+# Running the broker
+#-------
+
+async def serve(host, pub_port, sub_port, worker_set=None, wid=0):
+    """
+    Accepts any number of publishers and subscribers on the two ports
+    and serves them until cancelled; as worker "wid" of "worker_set", a
+    workers.WorkerSet, along with the other workers; with "cluster", as
+    node "node" of the cluster.
+    """
+    global _peers, _cluster
+
+    loop = asyncio.get_running_loop()
+
+    pub_sock = msock.create_socket_server(host, pub_port, worker_set is not None)
+    sub_sock = msock.create_socket_server(host, sub_port, worker_set is not None)
+    if pub_sock is None or sub_sock is None:
+        return
+    if worker_set is not None:
+        _peers = worker_set.peers(wid, loop, _dirty_subs)
+        fd = worker_set.doorbells[wid][0]
+        loop.add_reader(fd, read_workers, fd, worker_set.inbox(wid),
+                        {peer.wid: peer for peer in _peers})
+        print("Broker> worker %d of %d" % (wid, worker_set.n))
+    if _settings['cluster']:
+        _cluster = cluster.Cluster(_settings['cluster'], _settings['node'], forwarded, flush_subs)
+        print("Broker> node %d of %d" % (_cluster.me, len(_cluster.nodes)))
+
+    metrics_srv = None
+    if _settings['metrics_port']:
+        metrics_srv = metrics.serve('localhost', _settings['metrics_port'] + wid,
+                                    lambda: in_loop(loop, render_metrics))
+
+    pub_srv = await loop.create_server(PubProtocol, sock=pub_sock)
+    print("Broker> listening pubs on %s:%d" % (host, pub_port))
+    sub_srv = await loop.create_server(SubProtocol, sock=sub_sock)
+    print("Broker> listening subs on %s:%d" % (host, sub_port))
+    loop.call_later(_idle.tick_secs, reap)
+
+    try:
+        async with pub_srv, sub_srv:
+            await asyncio.gather(pub_srv.serve_forever(), sub_srv.serve_forever())
+    finally:
+        if _cluster is not None:
+            _cluster.close()
+        if metrics_srv is not None:
+            metrics_srv.shutdown()
+
+#------
+
+def run(host, pub_port, sub_port, settings=None, worker_set=None, wid=0):
+    """
+    Runs the asyncio broker in the calling thread, on the event loop of
+    "loop" (see loops.py), with "settings" overriding the default "_settings",
+    as worker "wid" of "worker_set" if given (see workers.run()).
+    """
+    global _log, _dicts, _producers, _keys, _rings, _idle
+
+    _settings.update(settings or {})
+    metrics.verbosity = _settings['verbosity']
+    _idle = idle.IdleTimer(_settings['idle_secs'], now=time.monotonic())
+    if _settings['dedup_window']:
+        _producers = dedup.Producers(_settings['dedup_window'])
+    if _settings['dedup_key_secs']:
+        _keys = dedup.KeyCache(_settings['dedup_key_secs'], _settings['dedup_keys'])
+    if _settings['ring_msgs']:
+        _rings = retain.RingStore(_settings['ring_msgs'], _settings['ring_bytes'], _settings['ring_memory'])
+    if _settings['dict_dir']:
+        _dicts = compress.Dictionaries(_settings['dict_dir'])
+    if _settings['log_dir']:
+        _log = topiclog.LogStore(_settings['log_dir'], _settings)
+    try:
+        loops.run(serve(host, pub_port, sub_port, worker_set, wid), _settings['loop'])
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if _log is not None:
+            _log.close()
@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+
+import time
+import asyncio
+import argparse
+import bench_util
+import my_sock as msock
+
+#-------
+# Batch publishing / batched fan-out benchmark
+#-------
+#
+# One binary publisher sends "-n" messages over "-t" topics, as "pubbatch"
+# frames of B messages for every batch size B ("-B"; B = 1 sends plain
+# "pub" frames), pipelining up to "-w" frames. "-S" subscribers are
+# subscribed to every topic. Reported per batch size:
+#   msgs/s       messages delivered to all the subscribers per second
+#   pub_writes   write syscalls of the publisher
+#   sub_writes   write syscalls of the broker towards the subscribers
+#                ("writes" of its stats), also per delivered message
+
+async def stats(host, port):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(b'bench stats\n')
+    words = (await reader.readline()).split()[1:]
+    writer.close()
+    return {str(k, 'ascii'): int(v) for k, v in (w.split(b'=') for w in words)
+            if v.isdigit()}                         # not the "sub.<sid>" queue words
+
+async def subscriber(host, port, i, ntopics, nmsgs, ready):
+    reader, writer = await asyncio.open_connection(host, port)
+    for t in range(ntopics):
+        writer.write(b's%d sub t%d\n' % (i, t))
+    for t in range(ntopics):
+        await reader.readline()                     # ack
+    ready.set_result(None)
+    for _ in range(nmsgs):
+        await reader.readline()
+    writer.close()
+
+async def publisher(host, port, nmsgs, ntopics, batch, window, size):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(b'p1 hello bin\n')
+    await reader.readline()
+    payload = b'x' * size
+    frames  = []
+    for j in range(0, nmsgs, batch):
+        msgs = [('t%d' % (k % ntopics), payload) for k in range(j, min(j + batch, nmsgs))]
+        seq  = len(frames) + 1
+        if batch == 1:
+            frames.append(msock.encode_frame('pub', msgs[0][0], payload, seq=seq))
+        else:
+            frames.append(msock.encode_frame('pubbatch', b'', msock.encode_batch(msgs), seq=seq))
+
+    acked   = 0
+    changed = asyncio.Event()
+    async def read_acks():
+        nonlocal acked
+        while acked < len(frames):
+            hdr = await reader.readexactly(msock._bin_hdr.size)
+            _, flags, tlen, elen, plen = msock._bin_hdr.unpack(hdr)
+            ext = (await reader.readexactly(tlen + elen + plen))[tlen:tlen + elen]
+            acked = msock.frame_seq(flags, ext)
+            changed.set()
+
+    acks = asyncio.create_task(read_acks())
+    for seq, frame in enumerate(frames, 1):
+        while seq - acked > window:
+            changed.clear()
+            await changed.wait()
+        writer.write(frame)
+    await acks
+    writer.close()
+    return len(frames)
+
+async def run_once(host, pub_port, sub_port, d, batch):
+    loop  = asyncio.get_running_loop()
+    ready = [loop.create_future() for _ in range(d.nsubs)]
+    subs  = [asyncio.create_task(subscriber(host, sub_port, i, d.ntopics, d.nmsgs, ready[i]))
+             for i in range(d.nsubs)]
+    await asyncio.gather(*ready)
+    before = await stats(host, pub_port)
+    t0 = time.perf_counter()
+    nframes = await publisher(host, pub_port, d.nmsgs, d.ntopics, batch, d.window, d.size)
+    await asyncio.gather(*subs)
+    t1 = time.perf_counter()
+    after = await stats(host, pub_port)
+    delivered = d.nmsgs * d.nsubs
+    writes = after['writes'] - before['writes']
+    return {'batch': batch, 'msgs/s': delivered / (t1 - t0), 'pub_writes': nframes,
+            'sub_writes': writes, 'writes/msg': writes / delivered}
+
+#------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=20000, dest='nmsgs')
+    parser.add_argument('-B', type=int, nargs='+', default=[1, 8, 64, 256], dest='batches')
+    parser.add_argument('-S', type=int, default=4, dest='nsubs')
+    parser.add_argument('-t', type=int, default=4, dest='ntopics')
+    parser.add_argument('-w', type=int, default=16, dest='window')
+    parser.add_argument('-b', type=int, default=64, dest='size', help='Payload bytes')
+    parser.add_argument('-p', type=int, default=9400, dest='pub_port')
+    parser.add_argument('-s', type=int, default=9490, dest='sub_port')
+    d = parser.parse_args()
+
+    rows = []
+    for batch in d.batches:
+        proc = bench_util.start_broker(d.pub_port, d.sub_port)
+        try:
+            rows.append(asyncio.run(run_once('localhost', d.pub_port, d.sub_port, d, batch)))
+        finally:
+            bench_util.stop_broker(proc)
+
+    bench_util.report("Batch publishing, %d msgs to %d subscribers" % (d.nmsgs, d.nsubs), rows,
+                      ['batch', 'msgs/s', 'pub_writes', 'sub_writes', 'writes/msg'])
@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+
+import time
+import asyncio
+import argparse
+import multiprocessing
+import bench_util
+import my_sock as msock
+
+#-------
+# Cluster benchmark
+#-------
+#
+# For every number of nodes N ("-N"), N brokers are started as one
+# cluster, and "-c" client processes each connect "-k" publishers and
+# "-k" subscribers spread over the nodes: publisher i of client c goes to
+# one node, and its subscriber, subscribed to the same topic, to the next
+# one, so most messages are forwarded to the node owning their topic and
+# sent back to the node of the subscriber. Each publisher publishes "-n"
+# messages, pipelining them as "pid:seq pub" lines, "-B" per write, acked
+# once the owner has them. Reported per node count:
+#   msgs/s   messages delivered per second, by the whole cluster
+
+async def subscriber(host, port, tpc, nmsgs, ready):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(b's%s sub %s\n' % (tpc, tpc))
+    await reader.readline()                         # ack
+    ready.set_result(None)
+    for _ in range(nmsgs):
+        if not await reader.readline():
+            break
+    writer.close()
+
+async def publisher(host, port, tpc, nmsgs, batch, start):
+    reader, writer = await asyncio.open_connection(host, port)
+    await start
+    payload = b'x' * 64
+    for j in range(0, nmsgs, batch):
+        last = min(j + batch, nmsgs)
+        writer.write(b''.join(b'p:%d pub %s %s\n' % (k + 1, tpc, payload) for k in range(j, last)))
+        while msock.parse_ack(str(await reader.readline(), msock._str_enc).strip()) != last:
+            pass
+    writer.close()
+
+async def client(c, nodes, d, ready, go):
+    loop = asyncio.get_running_loop()
+    subs_ready = [loop.create_future() for _ in range(d.nconns)]
+    start = loop.create_future()
+    subs, pubs = [], []
+    for i in range(d.nconns):
+        tpc = b't%d_%d' % (c, i)
+        node = (c * d.nconns + i) % len(nodes)
+        host, pub_port, _ = nodes[node]
+        _, _, sub_port = nodes[(node + 1) % len(nodes)]
+        subs.append(asyncio.create_task(subscriber(host, sub_port, tpc, d.nmsgs, subs_ready[i])))
+        pubs.append(asyncio.create_task(publisher(host, pub_port, tpc, d.nmsgs, d.batch, start)))
+    await asyncio.gather(*subs_ready)
+    ready.release()
+    await loop.run_in_executor(None, go.wait)
+    start.set_result(None)
+    await asyncio.gather(*pubs, *subs)
+
+def run_client(c, nodes, d, ready, go):
+    asyncio.run(client(c, nodes, d, ready, go))
+
+def run_once(nodes, d):
+    ctx   = multiprocessing.get_context('fork')
+    ready = ctx.Semaphore(0)
+    go    = ctx.Event()
+    procs = [ctx.Process(target=run_client, args=(c, nodes, d, ready, go))
+             for c in range(d.nclients)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        ready.acquire()
+    time.sleep(0.5)                                 # subscriptions reach the owners
+    t0 = time.perf_counter()
+    go.set()
+    for p in procs:
+        p.join()
+    elapsed = time.perf_counter() - t0
+    return {'nodes': len(nodes), 'msgs/s': d.nclients * d.nconns * d.nmsgs / elapsed}
+
+#------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-N', type=int, nargs='+', default=[1, 2, 4], dest='nodes')
+    parser.add_argument('-c', type=int, default=4, dest='nclients', help='Client processes')
+    parser.add_argument('-k', type=int, default=4, dest='nconns',
+                        help='Publishers and subscribers per client')
+    parser.add_argument('-n', type=int, default=20000, dest='nmsgs', help='Messages per publisher')
+    parser.add_argument('-B', type=int, default=100, dest='batch', help='Messages per write')
+    parser.add_argument('-p', type=int, default=9700, dest='pub_port',
+                        help='Publisher port of the first node, the next ones following by 2')
+    d = parser.parse_args()
+
+    rows = []
+    for nnodes in d.nodes:
+        nodes = [('localhost', d.pub_port + 2 * i, d.pub_port + 2 * i + 1) for i in range(nnodes)]
+        spec = ','.join('%s:%d:%d' % node for node in nodes)
+        procs = []
+        try:
+            for i, (host, pub_port, sub_port) in enumerate(nodes):
+                procs.append(bench_util.start_broker(pub_port, sub_port,
+                                                     '--cluster', spec, '--node', i))
+            rows.append(run_once(nodes, d))
+        finally:
+            for proc in procs:
+                bench_util.stop_broker(proc)
+
+    bench_util.report("Broker cluster, %d clients of %d publishers and subscribers" %
+                      (d.nclients, d.nconns), rows, ['nodes', 'msgs/s'])
@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+
+import json
+import time
+import random
+import argparse
+import bench_util
+import compress
+
+#-------
+# Compression microbenchmark
+#-------
+#
+# Compresses "-n" JSON events of the same shape, of about "-b" bytes, with
+# every codec available, without and with a dictionary trained on other
+# events of the topic. Reported per codec:
+#   ratio        compressed bytes / payload bytes
+#   pack us      usecs to compress one payload (Codec.pack())
+#   unpack us    usecs to decompress one payload (compress.unpack())
+#   fanout MB    MB written to "-F" subscribers of every event
+#   x1 us        usecs per event compressing once for all its subscribers,
+#                as the broker does
+#   xF us        usecs per event compressing once per subscriber
+
+def event(rnd, size):
+    e = {'id': rnd.randrange(1 << 30), 'user': 'user%d' % rnd.randrange(1000),
+         'type': rnd.choice(('order', 'refund', 'cancel')), 'status': rnd.choice(('ok', 'pending')),
+         'amount': round(rnd.random() * 1000, 2), 'items': []}
+    while len(json.dumps(e)) < size:
+        e['items'].append({'sku': 'SKU-%05d' % rnd.randrange(100000), 'qty': rnd.randrange(1, 5)})
+    return bytes(json.dumps(e), 'ascii')
+
+def bench(name, dicts, payloads, fanout):
+    codec = compress.Codec(name, dicts)
+    t0 = time.perf_counter()
+    packed = [codec.pack('events', p) for p in payloads]
+    t1 = time.perf_counter()
+    for p in packed:
+        if p is not None:
+            compress.unpack(p[0], p[1], p[2], dicts)
+    t2 = time.perf_counter()
+    for p in payloads:
+        codec.msg_parts(b'events', 'events', p)
+    t3 = time.perf_counter()
+    for p in payloads:
+        for _ in range(fanout):
+            codec.msg_parts(b'events', 'events', p)
+    t4 = time.perf_counter()
+    n = len(payloads)
+    nbytes = sum(len(p) if z is None else len(z[2]) for p, z in zip(payloads, packed))
+    return {'codec': name + ('+dict' if dicts else ''), 'ratio': nbytes / sum(map(len, payloads)),
+            'pack us': (t1 - t0) * 1e6 / n, 'unpack us': (t2 - t1) * 1e6 / n,
+            'fanout MB': nbytes * fanout / 1e6,
+            'x1 us': (t3 - t2) * 1e6 / n, 'xF us': (t4 - t3) * 1e6 / n}
+
+#------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=20000, dest='nmsgs', help='Events per run')
+    parser.add_argument('-b', type=int, nargs='+', default=[128, 512, 2048], dest='sizes',
+                        help='Bytes per event')
+    parser.add_argument('-F', type=int, default=10, dest='fanout', help='Subscribers of every event')
+    d = parser.parse_args()
+
+    rnd = random.Random(1)
+    for size in d.sizes:
+        payloads = [event(rnd, size) for _ in range(d.nmsgs)]
+        dicts = compress.Dictionaries()
+        data = compress.train([event(rnd, size) for _ in range(1000)])
+        dicts.by_topic['events'] = (1, data)
+        dicts.by_id[1] = data
+        rows = [{'codec': 'none', 'ratio': 1.0, 'pack us': 0.0, 'unpack us': 0.0,
+                 'fanout MB': sum(map(len, payloads)) * d.fanout / 1e6, 'x1 us': 0.0, 'xF us': 0.0}]
+        for name in reversed(compress.available()):
+            rows.append(bench(name, None, payloads, d.fanout))
+            rows.append(bench(name, dicts, payloads, d.fanout))
+        bench_util.report("Compression of %d events of ~%d bytes, fan-out %d" % (d.nmsgs, size, d.fanout),
+                          rows, ['codec', 'ratio', 'pack us', 'unpack us', 'fanout MB', 'x1 us', 'xF us'])
@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+
+import time
+import asyncio
+import argparse
+import bench_util
+
+#-------
+# Connection-count / throughput benchmark
+#-------
+#
+# For every connection count C, C publishers and C subscribers connect to
+# the broker. Subscriber i subscribes to topic "t<i>" and publisher i
+# publishes "-n" messages to the same topic, waiting the ack of each one
+# (as publisher.py does). The benchmark reports the time needed to
+# establish all the connections and the end-to-end delivered messages/sec,
+# once for every broker mode.
+
+async def subscriber(host, port, i, nmsgs, ready):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(b's%d sub t%d\n' % (i, i))
+    await reader.readline()                         # ack
+    ready.set_result(None)
+    for _ in range(nmsgs):
+        if not await reader.readline():
+            break
+    writer.close()
+
+async def publisher(host, port, i, nmsgs, start):
+    reader, writer = await asyncio.open_connection(host, port)
+    await start
+    for j in range(nmsgs):
+        writer.write(b'p%d pub t%d msg %d\n' % (i, i, j))
+        await reader.readline()                     # ack
+    writer.close()
+
+async def run_once(host, pub_port, sub_port, nconns, nmsgs):
+    loop  = asyncio.get_running_loop()
+    t0    = time.perf_counter()
+    ready = [loop.create_future() for _ in range(nconns)]
+    start = loop.create_future()
+    subs  = [asyncio.create_task(subscriber(host, sub_port, i, nmsgs, ready[i]))
+             for i in range(nconns)]
+    pubs  = [asyncio.create_task(publisher(host, pub_port, i, nmsgs, start))
+             for i in range(nconns)]
+    await asyncio.gather(*ready)
+    t1 = time.perf_counter()
+    start.set_result(None)
+    await asyncio.gather(*pubs, *subs)
+    t2 = time.perf_counter()
+    return t1 - t0, t2 - t1
+
+#------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', type=int, nargs='+', default=[10, 100, 1000], dest='conns',
+                        help='Numbers of publisher (and subscriber) connections')
+    parser.add_argument('-n', type=int, default=100, dest='nmsgs',
+                        help='Messages per publisher')
+    parser.add_argument('-m', type=str, nargs='+', default=['threads', 'asyncio'], dest='modes',
+                        help='Broker modes to compare')
+    parser.add_argument('-p', type=int, default=9400, dest='pub_port')
+    parser.add_argument('-s', type=int, default=9490, dest='sub_port')
+    d = parser.parse_args()
+
+    rows = []
+    for mode in d.modes:
+        for nconns in d.conns:
+            proc = bench_util.start_broker(d.pub_port, d.sub_port, '-m', mode)
+            try:
+                tconn, tpub = asyncio.run(run_once('localhost', d.pub_port, d.sub_port,
+                                                   nconns, d.nmsgs))
+            finally:
+                bench_util.stop_broker(proc)
+            rows.append({'mode': mode, 'conns': 2 * nconns,
+                         'connect_s': tconn, 'msgs/s': nconns * d.nmsgs / tpub})
+
+    bench_util.report("Broker connections / throughput", rows,
+                      ['mode', 'conns', 'connect_s', 'msgs/s'])
@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+
+import time
+import random
+import argparse
+import bench_util
+import dedup
+
+#-------
+# Deduplication microbenchmark
+#-------
+#
+# Feeds "-n" messages to the dedup structures of the broker, for every
+# number of producers ("-P") or of distinct keys ("-K"):
+#   producers   dedup.Producers, messages of P idempotent producers in turn,
+#               "-r" percent of them sent again a few messages later
+#   keys        dedup.KeyCache, messages keyed at random among K keys on
+#               10 topics, keys remembered "-t" secs, at most "-k" of them
+# Reported per run: usecs per message, duplicates found and entries kept,
+# which should neither grow with P or K past the bounds nor slow down.
+
+def bench_producers(nmsgs, nproducers, resent):
+    rnd  = random.Random(1)
+    prod = dedup.Producers()
+    seqs = [0] * nproducers
+    names = ['p%d' % i for i in range(nproducers)]
+    msgs = []
+    for i in range(nmsgs):
+        p = i % nproducers
+        if seqs[p] > 8 and rnd.random() * 100 < resent:
+            msgs.append((names[p], seqs[p] - rnd.randrange(8)))
+        else:
+            seqs[p] += 1
+            msgs.append((names[p], seqs[p]))
+    t0 = time.perf_counter()
+    dups = sum(prod.duplicate(p, seq) for p, seq in msgs)
+    t1 = time.perf_counter()
+    return {'cache': 'producers', 'distinct': nproducers, 'us/msg': (t1 - t0) * 1e6 / nmsgs,
+            'duplicates': dups, 'kept': len(prod)}
+
+def bench_keys(nmsgs, nkeys, secs, max_keys):
+    rnd  = random.Random(1)
+    keys = dedup.KeyCache(secs, max_keys)
+    msgs = [(b't%d' % rnd.randrange(10), b'k%d' % rnd.randrange(nkeys)) for _ in range(nmsgs)]
+    t0 = time.perf_counter()
+    dups = sum(keys.duplicate(tpc, key) for tpc, key in msgs)
+    t1 = time.perf_counter()
+    return {'cache': 'keys', 'distinct': nkeys, 'us/msg': (t1 - t0) * 1e6 / nmsgs,
+            'duplicates': dups, 'kept': len(keys)}
+
+#------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=500000, dest='nmsgs', help='Messages per run')
+    parser.add_argument('-P', type=int, nargs='+', default=[1, 100, 10000], dest='producers',
+                        help='Idempotent producers')
+    parser.add_argument('-r', type=float, default=1.0, dest='resent', help='Percent of messages sent again')
+    parser.add_argument('-K', type=int, nargs='+', default=[1000, 100000, 10000000], dest='keys',
+                        help='Distinct message keys')
+    parser.add_argument('-t', type=float, default=60.0, dest='secs', help='Secs keys are remembered')
+    parser.add_argument('-k', type=int, default=dedup._keys, dest='max_keys', help='Keys remembered at most')
+    d = parser.parse_args()
+
+    rows = [bench_producers(d.nmsgs, p, d.resent) for p in d.producers]
+    rows += [bench_keys(d.nmsgs, k, d.secs, d.max_keys) for k in d.keys]
+    bench_util.report("Deduplication of %d messages" % d.nmsgs, rows,
+                      ['cache', 'distinct', 'us/msg', 'duplicates', 'kept'])
@@ -0,0 +1,198 @@
+#!/usr/bin/python3
+
+import sys
+import json
+import time
+import array
+import queue
+import socket
+import struct
+import argparse
+import platform
+import itertools
+import multiprocessing
+import bench_util
+import my_sock as msock
+import pubclient
+
+#-------
+# End-to-end benchmark
+#-------
+#
+# Launches broker.py, "-N" subscriber processes and "-M" publisher
+# processes on localhost, for every combination of payload size ("-b"),
+# number of topics ("-T"), fan-out ("-F") and publish rate ("-r"):
+#   - topic i of "e2e.0" .. "e2e.<T-1>" is subscribed to by the F
+#     subscribers i, i+1, .. (mod N), so each message is delivered F times
+#   - the publishers, through pubclient.Publisher, publish to the topics
+#     in turn at "-r" messages/sec in all (0 as fast as they can) for "-d"
+#     secs, each payload starting with the time it was published at
+#   - the subscribers note how long each message took to reach them.
+# Reported per run:
+#   pub/s          messages published per second
+#   deliv/s        messages delivered per second, all subscribers together
+#   p50/p99/p999   msecs from publish() until a subscriber read the message
+#   lost           deliveries that did not happen within "-g" secs
+# Results also go, with the settings and the commit, to the JSON file
+# "-o"; "-c" compares them against such a file of an earlier commit.
+
+_stamp = struct.Struct('!Q')                        # time.monotonic_ns() at the start of each payload
+
+def subscriber(port, i, topics, counts, ready, stop, results):
+    sock = socket.create_connection(('localhost', port))
+    reader = msock.FrameReader(sock)
+    msock.negotiate(sock, reader, 's%d' % i, (msock._opt_bin,))
+    for tpc in topics:
+        msock.write_bytes(sock, msock.encode_frame('sub', tpc))
+        reader.read_frame()                         # ack
+    ready.release()
+    sock.settimeout(0.1)
+    lat = array.array('q')                          # usecs per delivery
+    while not stop.is_set():
+        try:
+            n = sock.recv_into(reader.get_buffer())
+        except socket.timeout:
+            continue
+        if n <= 0:
+            break
+        reader.buffer_updated(n)
+        now = time.monotonic_ns()
+        for frame in reader.frames():
+            payload = msock.decode_frame(frame)[4]
+            lat.append((now - _stamp.unpack_from(payload)[0]) // 1000)
+        counts[i] = len(lat)
+    results.put((i, lat.tobytes()))
+
+def publisher(port, j, topics, rate, duration, size, ready, go, sent):
+    pub = pubclient.Publisher('localhost', port, 'p%d' % j)
+    pad = b'x' * max(size - _stamp.size, 0)
+    tpcs = itertools.cycle(topics)
+    ready.release()
+    go.wait()
+    t0 = time.perf_counter()
+    i = 0
+    while True:
+        now = time.perf_counter()
+        if now - t0 >= duration:
+            break
+        if rate and t0 + i / rate > now:
+            time.sleep(t0 + i / rate - now)
+            continue
+        pub.publish(next(tpcs), _stamp.pack(time.monotonic_ns()) + pad)
+        i += 1
+    pub.close()
+    sent[j] = i
+
+def run_once(size, ntopics, fanout, rate, d):
+    ctx     = multiprocessing.get_context('fork')
+    topics  = ['e2e.%d' % t for t in range(ntopics)]
+    fanout  = min(fanout, d.subs)
+    counts  = ctx.Array('q', d.subs, lock=False)
+    sent    = ctx.Array('q', d.pubs, lock=False)
+    ready   = ctx.Semaphore(0)
+    go, stop = ctx.Event(), ctx.Event()
+    results = ctx.Queue()
+    subs = [ctx.Process(target=subscriber, daemon=True,
+                        args=(d.sub_port, i, [tpc for t, tpc in enumerate(topics)
+                                              if (i - t) % d.subs < fanout],
+                              counts, ready, stop, results)) for i in range(d.subs)]
+    pubs = [ctx.Process(target=publisher, daemon=True,
+                        args=(d.pub_port, j, topics[j % ntopics:] + topics[:j % ntopics],
+                              rate / d.pubs, d.duration, size, ready, go, sent))
+            for j in range(d.pubs)]
+    for p in subs + pubs:
+        p.start()
+    for p in subs + pubs:
+        ready.acquire()
+
+    t0 = time.perf_counter()
+    go.set()
+    for p in pubs:
+        p.join()
+    pub_secs = time.perf_counter() - t0
+    expected = sum(sent) * fanout
+    deadline = time.time() + d.grace
+    while sum(counts) < expected and time.time() < deadline:
+        time.sleep(0.001)
+    deliv_secs = time.perf_counter() - t0
+    stop.set()
+    lat = array.array('q')
+    for _ in subs:
+        try:
+            lat.frombytes(results.get(timeout=10)[1])
+        except queue.Empty:
+            break
+    for p in subs:
+        p.join(5)
+        if p.is_alive():
+            p.terminate()
+    lat = sorted(lat)
+    return {'bytes': size, 'topics': ntopics, 'fanout': fanout, 'rate': rate,
+            'published': sum(sent), 'delivered': len(lat),
+            'pub/s': sum(sent) / pub_secs, 'deliv/s': len(lat) / deliv_secs,
+            'p50': bench_util.percentile(lat, 0.50) / 1000.0,
+            'p99': bench_util.percentile(lat, 0.99) / 1000.0,
+            'p999': bench_util.percentile(lat, 0.999) / 1000.0,
+            'lost': expected - len(lat)}
+
+#------
+
+def compare(rows, path):
+    """
+    Prints the change of throughput and latencies of every run against
+    the same run, with the same settings, in the JSON results at "path".
+    """
+    with open(path) as f:
+        old = json.load(f)
+    key = lambda r: (r['bytes'], r['topics'], r['fanout'], r['rate'])
+    before = {key(r): r for r in old['runs']}
+    print("\nAgainst %s (commit %s)" % (path, old.get('commit')))
+    cols = ['bytes', 'topics', 'fanout', 'rate', 'deliv/s', 'p50', 'p99', 'p999']
+    print("  ".join("%14s" % c for c in cols))
+    for r in rows:
+        b = before.get(key(r))
+        if b is None:
+            continue
+        change = ['%+.1f%%' % ((r[c] - b[c]) * 100.0 / b[c]) if b[c] else '-' for c in cols[4:]]
+        print("  ".join("%14s" % v for v in [r[c] for c in cols[:4]] + change))
+
+#------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-b', type=int, nargs='+', default=[64, 1024], dest='sizes', help='Payload bytes')
+    parser.add_argument('-T', type=int, nargs='+', default=[1, 100], dest='topics', help='Topics')
+    parser.add_argument('-F', type=int, nargs='+', default=[1, 4], dest='fanouts',
+                        help='Subscribers of every topic')
+    parser.add_argument('-r', type=int, nargs='+', default=[1000, 0], dest='rates',
+                        help='Messages/sec published, 0 as fast as possible')
+    parser.add_argument('-M', type=int, default=2, dest='pubs', help='Publisher processes')
+    parser.add_argument('-N', type=int, default=4, dest='subs', help='Subscriber processes')
+    parser.add_argument('-d', type=float, default=3.0, dest='duration', help='Secs of publishing per run')
+    parser.add_argument('-g', type=float, default=10.0, dest='grace',
+                        help='Secs the deliveries may take past the publishing')
+    parser.add_argument('-m', type=str, default='asyncio', choices=('asyncio', 'threads'), dest='mode')
+    parser.add_argument('-o', type=str, default='bench_e2e.json', dest='output', help='JSON results')
+    parser.add_argument('-c', type=str, dest='baseline', help='JSON results to compare against')
+    parser.add_argument('-p', type=int, default=9800, dest='pub_port')
+    parser.add_argument('-s', type=int, default=9890, dest='sub_port')
+    d = parser.parse_args()
+
+    proc = bench_util.start_broker(d.pub_port, d.sub_port, '-m', d.mode)
+    rows = []
+    try:
+        for size, ntopics, fanout, rate in itertools.product(d.sizes, d.topics, d.fanouts, d.rates):
+            rows.append(run_once(size, ntopics, fanout, rate, d))
+    finally:
+        bench_util.stop_broker(proc)
+
+    bench_util.report("End to end, %s broker, %d publishers, %d subscribers (latencies in msecs)" %
+                      (d.mode, d.pubs, d.subs), rows,
+                      ['bytes', 'topics', 'fanout', 'rate', 'pub/s', 'deliv/s', 'p50', 'p99', 'p999', 'lost'])
+    with open(d.output, 'w') as f:
+        json.dump({'commit': bench_util.git_commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   'python': sys.version.split()[0], 'platform': platform.platform(),
+                   'cpus': multiprocessing.cpu_count(), 'settings': vars(d), 'runs': rows}, f, indent=1)
+    print("\nResults written to %s" % d.output)
+    if d.baseline:
+        compare(rows, d.baseline)
@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+
+import time
+import socket
+import argparse
+import threading
+import bench_util
+import my_sock as msock
+
+#-------
+# Framing microbenchmark: read_from_socket() vs FrameReader
+#-------
+#
+# A writer thread sends "-n" messages of "-b" bytes over a socketpair.
+#   legacy      read_from_socket(), the writer waits each message to be read
+#               (the only way the function decodes every message correctly)
+#   legacy-bulk read_from_socket() against a writer that does not wait,
+#               counting how many messages are decoded intact
+#   reader      FrameReader.read_msg(), the writer does not wait
+#   frames      FrameReader.fill() + frames(), without decoding to str
+
+def writer(sock, nmsgs, msg, turn):
+    data = bytes(msg + msock._delim, msock._str_enc)
+    try:
+        for _ in range(nmsgs):
+            if turn is not None:
+                turn.acquire()
+            sock.sendall(data)
+        sock.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass                                    # reader gave up
+
+def bench(mode, nmsgs, size):
+    a, b = socket.socketpair()
+    msg  = 'x' * size
+    turn = threading.Semaphore(1) if mode == 'legacy' else None
+    w = threading.Thread(target=writer, args=(a, nmsgs, msg, turn))
+
+    t0 = time.perf_counter()
+    w.start()
+    nread = intact = 0
+    if mode in ('legacy', 'legacy-bulk'):
+        while nread < nmsgs:
+            smsg = msock.read_from_socket(b)
+            if smsg is None:
+                break
+            nread  += 1
+            intact += smsg == msg
+            if turn is not None:
+                turn.release()
+    elif mode == 'reader':
+        reader = msock.FrameReader(b)
+        while nread < nmsgs:
+            intact += reader.read_msg() == msg
+            nread  += 1
+    else:
+        reader = msock.FrameReader(b)
+        while nread < nmsgs:
+            if reader.fill() <= 0:
+                break
+            for frame in reader.frames():
+                intact += len(frame) == size
+                nread  += 1
+    t1 = time.perf_counter()
+
+    b.close()
+    if turn is not None:
+        for _ in range(nmsgs):
+            turn.release()
+    w.join()
+    a.close()
+    return {'mode': mode, 'size': size, 'read': nread, 'intact': intact,
+            'msgs/s': nread / (t1 - t0)}
+
+#------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=100000, dest='nmsgs',
+                        help='Messages per run')
+    parser.add_argument('-b', type=int, nargs='+', default=[16, 256, 4096], dest='sizes',
+                        help='Message sizes in bytes')
+    d = parser.parse_args()
+
+    rows = [bench(mode, d.nmsgs, size)
+            for size in d.sizes
+            for mode in ('legacy', 'legacy-bulk', 'reader', 'frames')]
+    bench_util.report("Framing, messages/sec", rows, ['mode', 'size', 'read', 'intact', 'msgs/s'])
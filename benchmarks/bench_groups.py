@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+
+import time
+import socket
+import argparse
+import multiprocessing
+import bench_util
+import my_sock as msock
+
+#-------
+# Consumer group benchmark
+#-------
+#
+# For every number of members G ("-G") and group policy ("-P"), G member
+# processes join one consumer group of a topic, each spending "-w" msecs
+# on every message it gets, as a consumer doing real work would. One
+# publisher then sends "-n" messages with "-k" different publisher ids,
+# the keys of "key-hash" groups. Reported per run:
+#   msgs/s   messages consumed by the whole group per second, from the
+#            first message published until the group consumed them all
+#   skew     messages of the busiest member over the mean per member
+
+def member(port, i, policy, work, counts, ready):
+    sock = socket.create_connection(('localhost', port))
+    reader = msock.FrameReader(sock)
+    msock.write2socket(sock, 'm%d sub t group g %s' % (i, policy))
+    reader.read_msg()                               # ack
+    ready.release()
+    while reader.read_msg() is not None:
+        time.sleep(work)
+        with counts.get_lock():
+            counts[i] += 1
+
+def run_once(nmembers, policy, d):
+    ctx    = multiprocessing.get_context('fork')
+    counts = ctx.Array('i', nmembers)
+    ready  = ctx.Semaphore(0)
+    procs  = [ctx.Process(target=member, args=(d.sub_port, i, policy, d.work / 1000, counts, ready),
+                          daemon=True) for i in range(nmembers)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        ready.acquire()
+
+    sock = socket.create_connection(('localhost', d.pub_port))
+    reader = msock.FrameReader(sock)
+    msgs = b''.join(b'k%d pub t %d\n' % (j % d.nkeys, j) for j in range(d.nmsgs))
+    t0 = time.perf_counter()
+    sock.sendall(msgs)
+    for _ in range(d.nmsgs):
+        reader.read_msg()
+    while sum(counts) < d.nmsgs:
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - t0
+    sock.close()
+    for p in procs:
+        p.terminate()
+        p.join()
+    return {'members': nmembers, 'policy': policy, 'msgs/s': d.nmsgs / elapsed,
+            'skew': max(counts) * nmembers / d.nmsgs}
+
+#------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=2000, dest='nmsgs')
+    parser.add_argument('-G', type=int, nargs='+', default=[1, 2, 4, 8], dest='members')
+    parser.add_argument('-P', type=str, nargs='+', default=['round-robin', 'least-outstanding',
+                                                            'key-hash'], dest='policies')
+    parser.add_argument('-w', type=float, default=1.0, dest='work', help='Msecs of work per message')
+    parser.add_argument('-k', type=int, default=64, dest='nkeys', help='Publisher ids (keys)')
+    parser.add_argument('-m', type=str, default='asyncio', choices=('asyncio', 'threads'), dest='mode')
+    parser.add_argument('-p', type=int, default=9500, dest='pub_port')
+    parser.add_argument('-s', type=int, default=9590, dest='sub_port')
+    d = parser.parse_args()
+
+    rows = []
+    for policy in d.policies:
+        for nmembers in d.members:
+            proc = bench_util.start_broker(d.pub_port, d.sub_port, '-m', d.mode)
+            try:
+                rows.append(run_once(nmembers, policy, d))
+            finally:
+                bench_util.stop_broker(proc)
+
+    bench_util.report("Consumer groups, %d msgs, %.1f msecs of work each" % (d.nmsgs, d.work),
+                      rows, ['members', 'policy', 'msgs/s', 'skew'])
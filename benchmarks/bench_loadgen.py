@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+
+import time
+import socket
+import argparse
+import threading
+import multiprocessing
+import bench_util
+import my_sock as msock
+import pubclient
+
+#-------
+# Load generator benchmark
+#-------
+#
+# Drives the broker through a pubclient.Publisher, pooling "-c"
+# connections, from "-t" threads publishing together at "-r" messages/sec
+# in all (0 as fast as they can) for "-d" secs, with payloads of "-b"
+# bytes, each thread keying its messages when "-k". "-S" subscriber
+# processes receive them. Reported for every rate and payload size:
+#   sent/s       messages published per second
+#   acked/s      messages acked per second, until the last one was acked
+#   delivered/s  messages received per second by each subscriber
+#   p50 / p99    msecs from publish() until the future was resolved
+
+def subscriber(port, i, binary, counts, ready):
+    sock = socket.create_connection(('localhost', port))
+    reader = msock.FrameReader(sock)
+    if binary:
+        msock.negotiate(sock, reader, 's%d' % i, (msock._opt_bin,))
+    if reader.binary:
+        msock.write_bytes(sock, msock.encode_frame('sub', 'load'))
+    else:
+        msock.write2socket(sock, 's%d sub load' % i)
+    reader.read_frame()                             # ack
+    ready.release()
+    n = 0
+    while reader.fill() > 0:
+        n += sum(1 for _ in reader.frames())
+        counts[i] = n
+
+def publishing(pub, rate, duration, payload, key, lat):
+    t0 = time.perf_counter()
+    i = 0
+    while True:
+        now = time.perf_counter()
+        if now - t0 >= duration:
+            return i
+        if rate and t0 + i / rate > now:
+            time.sleep(t0 + i / rate - now)
+            continue
+        fut = pub.publish('load', payload, key)
+        fut.add_done_callback(lambda f, t=time.perf_counter(): lat.append(time.perf_counter() - t))
+        i += 1
+
+def run_once(rate, size, d):
+    ctx    = multiprocessing.get_context('fork')
+    counts = ctx.Array('q', d.subs, lock=False)
+    ready  = ctx.Semaphore(0)
+    procs  = [ctx.Process(target=subscriber, args=(d.sub_port, i, d.binary, counts, ready),
+                          daemon=True) for i in range(d.subs)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        ready.acquire()
+
+    pub = pubclient.Publisher('localhost', d.pub_port, 'load', d.conns, d.binary)
+    lat, sent = [], [0] * d.threads
+    def run_thread(j):
+        sent[j] = publishing(pub, rate / d.threads, d.duration, b'x' * size,
+                             'k%d' % j if d.keyed else None, lat)
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=run_thread, args=(j,)) for j in range(d.threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    sent_secs = time.perf_counter() - t0
+    pub.flush()
+    acked_secs = time.perf_counter() - t0
+    total = sum(sent)
+    deadline = time.time() + 10
+    while min(counts) < total and time.time() < deadline:
+        time.sleep(0.001)
+    delivered_secs = time.perf_counter() - t0
+    pub.close()
+    for p in procs:
+        p.terminate()
+        p.join()
+    lat.sort()
+    return {'rate': rate or 'max', 'bytes': size, 'sent/s': total / sent_secs,
+            'acked/s': total / acked_secs, 'delivered/s': min(counts) / delivered_secs,
+            'p50 ms': bench_util.percentile(lat, 0.50) * 1000.0,
+            'p99 ms': bench_util.percentile(lat, 0.99) * 1000.0}
+
+#------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r', type=int, nargs='+', default=[1000, 10000, 0], dest='rates',
+                        help='Messages/sec published, 0 as fast as possible')
+    parser.add_argument('-b', type=int, nargs='+', default=[64], dest='sizes', help='Payload bytes')
+    parser.add_argument('-d', type=float, default=3.0, dest='duration', help='Secs of every run')
+    parser.add_argument('-c', type=int, default=2, dest='conns', help='Pooled connections')
+    parser.add_argument('-t', type=int, default=2, dest='threads', help='Publishing threads')
+    parser.add_argument('-k', action='store_true', dest='keyed', help='Key messages by thread')
+    parser.add_argument('-S', type=int, default=1, dest='subs', help='Subscriber processes')
+    parser.add_argument('-T', action='store_false', dest='binary', help='Text instead of binary')
+    parser.add_argument('-m', type=str, default='asyncio', choices=('asyncio', 'threads'), dest='mode')
+    parser.add_argument('-p', type=int, default=9700, dest='pub_port')
+    parser.add_argument('-s', type=int, default=9790, dest='sub_port')
+    d = parser.parse_args()
+
+    proc = bench_util.start_broker(d.pub_port, d.sub_port, '-m', d.mode)
+    rows = []
+    try:
+        for size in d.sizes:
+            for rate in d.rates:
+                rows.append(run_once(rate, size, d))
+    finally:
+        bench_util.stop_broker(proc)
+
+    bench_util.report("Load generator (%s broker, %d connections, %d threads)" %
+                      (d.mode, d.conns, d.threads),
+                      rows, ['rate', 'bytes', 'sent/s', 'acked/s', 'delivered/s', 'p50 ms', 'p99 ms'])
@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import bench_util
+import async_broker
+import topiclog
+
+#-------
+# Topic log benchmark
+#-------
+#
+# Runs in process, without a broker, on a log under "-d" (a temporary
+# directory by default). For every fsync policy ("-F") "-n" messages are
+# appended to one topic, with a sync() every "-B" messages as the broker
+# does after each read of a publisher. The log is then replayed from offset
+# 0 in reads of "fetch_bytes", as "fetch" does:
+#   append msgs/s  appended messages per second, syncs included
+#   replay MB/s    payload replayed from the mapped segments
+#   copy MB/s      the same replay reading the segment files into bytes
+
+def replay_copy(log):
+    """
+    Replays a log reading its files, copying every payload.
+    Returns:
+        payload bytes read
+    """
+    nbytes = 0
+    for seg in log.segments:
+        with open(seg.path, 'rb') as f:
+            data = f.read()
+        o = 0
+        while o < len(data):
+            offset, ts, n = topiclog._rec_hdr.unpack_from(data, o)
+            o += topiclog._rec_hdr.size
+            nbytes += len(data[o:o + n])
+            o += n
+    return nbytes
+
+def run_once(root, policy, d):
+    settings = dict(async_broker._settings, log_fsync=policy, log_retention_bytes=0,
+                    log_retention_secs=0)
+    dirname = os.path.join(root, policy)
+    store = topiclog.LogStore(dirname, settings)
+    payload = b'x' * d.size
+
+    t0 = time.perf_counter()
+    for i in range(d.nmsgs):
+        store.append('bench', payload)
+        if i % d.batch == d.batch - 1:
+            store.sync()
+    store.sync()
+    append = d.nmsgs / (time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    offset, nbytes = 0, 0
+    while True:
+        recs, offset = store.read('bench', offset, settings['fetch_bytes'])
+        if not recs:
+            break
+        nbytes += sum(len(p) for o, ts, p in recs)
+    replay = nbytes / (time.perf_counter() - t0) / 1e6
+
+    t0 = time.perf_counter()
+    nbytes = replay_copy(store.get('bench'))
+    copy = nbytes / (time.perf_counter() - t0) / 1e6
+    store.close()
+    shutil.rmtree(dirname)
+    return {'fsync': policy, 'append msgs/s': append, 'replay MB/s': replay, 'copy MB/s': copy}
+
+#------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=200000, dest='nmsgs')
+    parser.add_argument('-b', type=int, default=256, dest='size', help='Payload bytes')
+    parser.add_argument('-B', type=int, default=64, dest='batch', help='Messages per sync()')
+    parser.add_argument('-F', type=str, nargs='+', default=list(topiclog._fsync_policies),
+                        choices=topiclog._fsync_policies, dest='policies')
+    parser.add_argument('-d', type=str, default=None, dest='dir', help='Directory of the logs')
+    d = parser.parse_args()
+
+    root = d.dir or tempfile.mkdtemp(prefix='bench_log')
+    try:
+        rows = [run_once(root, p, d) for p in d.policies]
+    finally:
+        if d.dir is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    bench_util.report("Topic log, %d msgs of %d bytes, sync every %d msgs" % (d.nmsgs, d.size, d.batch),
+                      rows, ['fsync', 'append msgs/s', 'replay MB/s', 'copy MB/s'])
@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+
+import time
+import asyncio
+import argparse
+import bench_util
+import loops
+
+#-------
+# Broker I/O backend benchmark
+#-------
+#
+# Runs the broker on every backend ("-L"): "threads", a thread per
+# connection blocking on its socket, and the asyncio mode on each event
+# loop available here (see loops.py), and measures, with the clients always
+# on the default asyncio loop:
+#   msgs/s       delivered messages/sec of C publisher and C subscriber
+#                connections ("-c"), subscriber i on topic "t<i>", each
+#                publisher sending "-n" messages in windows of "-w" before
+#                waiting their acks
+#   p50/p99 us   usecs from publishing a message until its subscriber reads
+#                it, one message in flight at a time ("-r" of them)
+# A loop only pays off once the broker, not the clients, is the bottleneck:
+# on few cores the clients share the CPU with it.
+
+async def subscriber(host, port, i, nmsgs, ready):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(b's%d sub t%d\n' % (i, i))
+    await reader.readline()                         # ack
+    ready.set_result(None)
+    for _ in range(nmsgs):
+        if not await reader.readline():
+            break
+    writer.close()
+
+async def publisher(host, port, i, nmsgs, window, start):
+    reader, writer = await asyncio.open_connection(host, port)
+    await start
+    for j in range(0, nmsgs, window):
+        n = min(window, nmsgs - j)
+        writer.write(b''.join(b'p%d pub t%d msg %d\n' % (i, i, j + k) for k in range(n)))
+        for _ in range(n):
+            await reader.readline()                 # ack
+    writer.close()
+
+async def throughput(host, pub_port, sub_port, nconns, nmsgs, window):
+    loop  = asyncio.get_running_loop()
+    ready = [loop.create_future() for _ in range(nconns)]
+    start = loop.create_future()
+    subs  = [asyncio.create_task(subscriber(host, sub_port, i, nmsgs, ready[i])) for i in range(nconns)]
+    pubs  = [asyncio.create_task(publisher(host, pub_port, i, nmsgs, window, start)) for i in range(nconns)]
+    await asyncio.gather(*ready)
+    t0 = time.perf_counter()
+    start.set_result(None)
+    await asyncio.gather(*pubs, *subs)
+    return nconns * nmsgs / (time.perf_counter() - t0)
+
+async def latency(host, pub_port, sub_port, rounds):
+    sreader, swriter = await asyncio.open_connection(host, sub_port)
+    swriter.write(b'lat sub lat\n')
+    await sreader.readline()                        # ack
+    preader, pwriter = await asyncio.open_connection(host, pub_port)
+    usecs = []
+    for j in range(rounds):
+        t0 = time.perf_counter()
+        pwriter.write(b'lat pub lat %d\n' % j)
+        await sreader.readline()
+        usecs.append((time.perf_counter() - t0) * 1e6)
+        await preader.readline()                    # ack
+    pwriter.close()
+    swriter.close()
+    usecs.sort()
+    return bench_util.percentile(usecs, 0.5), bench_util.percentile(usecs, 0.99)
+
+#------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-L', type=str, nargs='+', default=['threads'] + list(loops.available()),
+                        dest='backends', help='Backends to compare, threads or an event loop of loops.py')
+    parser.add_argument('-c', type=int, nargs='+', default=[1, 10, 100], dest='conns',
+                        help='Numbers of publisher (and subscriber) connections')
+    parser.add_argument('-n', type=int, default=2000, dest='nmsgs', help='Messages per publisher')
+    parser.add_argument('-w', type=int, default=50, dest='window', help='Messages sent before waiting their acks')
+    parser.add_argument('-r', type=int, default=2000, dest='rounds', help='Messages timed one at a time')
+    parser.add_argument('-p', type=int, default=9400, dest='pub_port')
+    parser.add_argument('-s', type=int, default=9490, dest='sub_port')
+    d = parser.parse_args()
+
+    rows = []
+    for backend in d.backends:
+        args = ('-m', 'threads') if backend == 'threads' else ('-m', 'asyncio', '--loop', backend)
+        for nconns in d.conns:
+            proc = bench_util.start_broker(d.pub_port, d.sub_port, *args)
+            try:
+                rate = asyncio.run(throughput('localhost', d.pub_port, d.sub_port, nconns, d.nmsgs, d.window))
+                p50, p99 = asyncio.run(latency('localhost', d.pub_port, d.sub_port, d.rounds))
+            finally:
+                bench_util.stop_broker(proc)
+            rows.append({'backend': backend, 'conns': 2 * nconns, 'msgs/s': rate,
+                         'p50 us': p50, 'p99 us': p99})
+
+    bench_util.report("Broker backends, %d msgs per publisher" % d.nmsgs, rows,
+                      ['backend', 'conns', 'msgs/s', 'p50 us', 'p99 us'])
@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+
+import time
+import asyncio
+import argparse
+import bench_util
+import my_sock as msock
+
+#-------
+# Pipelined publishing benchmark
+#-------
+#
+# One publisher sends "-n" messages with at most W of them not yet acked,
+# for every window W ("-w"); W = 0 waits the ack of each message as
+# publisher.py does without "-w". An optional "-d" delay is added before
+# each ack is handled, emulating the round trip of a non-loopback link.
+
+async def publish(host, port, nmsgs, window, delay, size):
+    reader, writer = await asyncio.open_connection(host, port)
+    payload = b'x' * size
+    acked   = 0
+    changed = asyncio.Event()
+
+    async def read_acks():
+        nonlocal acked
+        while acked < nmsgs:
+            words = (await reader.readline()).split()
+            if delay:
+                await asyncio.sleep(delay)
+            acked = int(words[1]) if len(words) > 1 else acked + 1
+            changed.set()
+
+    acks = asyncio.create_task(read_acks())
+    t0 = time.perf_counter()
+    for seq in range(1, nmsgs + 1):
+        while seq - acked > max(window, 1):
+            changed.clear()
+            await changed.wait()
+        if window:
+            writer.write(b'p1%s%d pub t %s\n' % (bytes(msock._seq_sep, 'ascii'), seq, payload))
+        else:
+            writer.write(b'p1 pub t %s\n' % payload)
+    await acks
+    t1 = time.perf_counter()
+    writer.close()
+    return nmsgs / (t1 - t0)
+
+#------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=20000, dest='nmsgs')
+    parser.add_argument('-w', type=int, nargs='+', default=[0, 8, 64, 512], dest='windows')
+    parser.add_argument('-d', type=float, default=0.0, dest='delay',
+                        help='Seconds added to every ack round trip')
+    parser.add_argument('-b', type=int, default=64, dest='size', help='Payload bytes')
+    parser.add_argument('-m', type=str, default='asyncio', dest='mode', help='Broker mode')
+    parser.add_argument('-p', type=int, default=9400, dest='pub_port')
+    parser.add_argument('-s', type=int, default=9490, dest='sub_port')
+    d = parser.parse_args()
+
+    proc = bench_util.start_broker(d.pub_port, d.sub_port, '-m', d.mode)
+    rows = []
+    try:
+        for w in d.windows:
+            rate = asyncio.run(publish('localhost', d.pub_port, d.nmsgs, w, d.delay, d.size))
+            rows.append({'window': w, 'msgs/s': rate})
+    finally:
+        bench_util.stop_broker(proc)
+
+    bench_util.report("Pipelined publishing (%s broker, ack delay %gs)" % (d.mode, d.delay),
+                      rows, ['window', 'msgs/s'])
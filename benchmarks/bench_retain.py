@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+
+import sys
+import time
+import random
+import argparse
+import collections
+import bench_util
+import retain
+
+#-------
+# Topic ring microbenchmark
+#-------
+#
+# Keeps "-n" messages of about "-b" bytes, published at random to T topics
+# ("-T"), in a retain.RingStore keeping "-k" messages per topic and "-M"
+# bytes overall, and compares it with a collections.deque of the payloads
+# per topic, bounded in messages only. Reported per store and T:
+#   us/msg       usecs to keep one message
+#   last us      usecs to read the last "-K" messages of a topic
+#   bytes/msg    memory taken per message kept, payload included
+#   topics       topics still kept, fewer than T past "-M" for the rings
+#   evicted      rings dropped for "-M"
+
+def bench_rings(payloads, tpcs, keep, last, max_memory):
+    store = retain.RingStore(keep, max(map(len, payloads)) * keep, max_memory)
+    t0 = time.perf_counter()
+    for tpc, p in zip(tpcs, payloads):
+        store.append(tpc, p)
+    t1 = time.perf_counter()
+    kept = list(store.rings)
+    for tpc in kept:
+        store.last(tpc, last)
+    t2 = time.perf_counter()
+    msgs = sum(len(r) for r in store.rings.values())
+    return {'store': 'rings', 'us/msg': (t1 - t0) * 1e6 / len(payloads),
+            'last us': (t2 - t1) * 1e6 / max(len(kept), 1), 'bytes/msg': store.memory / max(msgs, 1),
+            'topics': len(store), 'evicted': store.evicted}
+
+def bench_deques(payloads, tpcs, keep, last):
+    store = {}
+    t0 = time.perf_counter()
+    for tpc, p in zip(tpcs, payloads):
+        q = store.get(tpc)
+        if q is None:
+            q = store[tpc] = collections.deque(maxlen=keep)
+        q.append(bytes(p))
+    t1 = time.perf_counter()
+    for q in store.values():
+        list(q)[-last:]
+    t2 = time.perf_counter()
+    msgs = sum(len(q) for q in store.values())
+    memory = sum(sys.getsizeof(q) + sum(sys.getsizeof(p) for p in q) for q in store.values())
+    return {'store': 'deques', 'us/msg': (t1 - t0) * 1e6 / len(payloads),
+            'last us': (t2 - t1) * 1e6 / max(len(store), 1), 'bytes/msg': memory / max(msgs, 1),
+            'topics': len(store), 'evicted': 0}
+
+#------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=500000, dest='nmsgs', help='Messages per run')
+    parser.add_argument('-b', type=int, default=64, dest='size', help='Bytes per message, about')
+    parser.add_argument('-T', type=int, nargs='+', default=[10, 1000, 100000], dest='topics',
+                        help='Topics published to')
+    parser.add_argument('-k', type=int, default=100, dest='keep', help='Messages kept per topic')
+    parser.add_argument('-K', type=int, default=10, dest='last', help='Last messages read per topic')
+    parser.add_argument('-M', type=int, default=64 << 20, dest='max_memory', help='Bytes of all the rings')
+    d = parser.parse_args()
+
+    rnd = random.Random(1)
+    payloads = [bytes(rnd.randrange(d.size // 2, d.size * 3 // 2)) for _ in range(d.nmsgs)]
+    rows = []
+    for ntopics in d.topics:
+        tpcs = ['t%d' % rnd.randrange(ntopics) for _ in range(d.nmsgs)]
+        for row in (bench_rings(payloads, tpcs, d.keep, d.last, d.max_memory),
+                    bench_deques(payloads, tpcs, d.keep, d.last)):
+            row['T'] = ntopics
+            rows.append(row)
+    bench_util.report("Keeping %d messages of ~%d bytes, the last %d per topic" % (d.nmsgs, d.size, d.keep),
+                      rows, ['store', 'T', 'us/msg', 'last us', 'bytes/msg', 'topics', 'evicted'])
@@ -0,0 +1,91 @@
+import os
+import sys
+import time
+import socket
+import subprocess
+
+#-------
+# Helpers shared by the benchmarks
+#-------
+
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _root)
+
+def start_broker(pub_port, sub_port, *args):
+    """
+    Launches "broker.py" listening on the passed ports, with any extra
+    command line arguments, and waits until both ports accept connections.
+    The broker output is discarded so that it does not skew the numbers.
+    Returns:
+        the subprocess.Popen of the broker
+    """
+    cmd = [sys.executable, os.path.join(_root, 'broker.py'),
+           '-p', str(pub_port), '-s', str(sub_port)] + [str(a) for a in args]
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_port(pub_port)
+    wait_port(sub_port)
+    return proc
+
+#------
+
+def stop_broker(proc):
+    """
+    Stops a broker started with start_broker().
+    """
+    proc.terminate()
+    try:
+        proc.wait(5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+#------
+
+def wait_port(port, host='localhost', timeout=10):
+    """
+    Waits until something listens on host:port.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), 0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("nothing listening on %s:%d" % (host, port))
+
+#------
+
+def report(title, rows, cols):
+    """
+    Prints a list of dict rows as an aligned table.
+    """
+    print("\n" + title)
+    print("  ".join("%14s" % c for c in cols))
+    for r in rows:
+        print("  ".join("%14s" % (("%.3f" % r[c]) if isinstance(r[c], float) else r[c])
+                        for c in cols))
+
+#------
+
+def percentile(values, q):
+    """
+    Returns:
+        the "q" quantile (0 < q < 1) of sorted "values", 0 if there are none
+    """
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+#------
+
+def git_commit():
+    """
+    Returns:
+        the commit checked out in the repository, None if unknown
+    """
+    try:
+        out = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=_root, capture_output=True, text=True)
+    except OSError:
+        return None
+    return out.stdout.strip() or None
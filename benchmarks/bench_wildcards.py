@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+
+import time
+import random
+import argparse
+import bench_util
+import registry
+import my_sock as msock
+
+#-------
+# Wildcard matching benchmark
+#-------
+#
+# Runs in process, without a broker: for every count of wildcard patterns
+# P ("-P"), one subscriber per pattern, topics of "-l" levels are looked up
+# as publish does. Reported, in microseconds per lookup:
+#   scan_us    matching the topic against every pattern in turn
+#   trie_us    resolving the topic through the trie of the registry
+#   cached_us  the cached subscribers of the topic, as most publishes find them
+
+def random_topic(rnd, nlevels, fanout):
+    return msock._tpc_sep.join('l%d' % rnd.randrange(fanout) for _ in range(nlevels))
+
+def random_pattern(rnd, nlevels, fanout):
+    levels = random_topic(rnd, nlevels, fanout).split(msock._tpc_sep)
+    for i in range(nlevels):
+        if rnd.random() < 0.3:
+            levels[i] = msock._wild_one
+    if rnd.random() < 0.2:
+        levels[rnd.randrange(1, nlevels):] = [msock._wild_many]
+    return msock._tpc_sep.join(levels)
+
+def scan_match(pattern, levels):
+    plevels = pattern.split(msock._tpc_sep)
+    for i, p in enumerate(plevels):
+        if p == msock._wild_many:
+            return True
+        if i >= len(levels) or (p != msock._wild_one and p != levels[i]):
+            return False
+    return len(plevels) == len(levels)
+
+def run_once(npatterns, d):
+    rnd = random.Random(npatterns)
+    reg = registry.SubRegistry()
+    patterns = [random_pattern(rnd, d.nlevels, d.fanout) for _ in range(npatterns)]
+    for i, p in enumerate(patterns):
+        reg.subscribe(p, 's%d' % i, i)
+    topics = [random_topic(rnd, d.nlevels, d.fanout) for _ in range(d.nlookups)]
+
+    scan_n = max(1, min(d.nlookups, d.nlookups * 100 // max(npatterns, 1)))
+    t0 = time.perf_counter()
+    for tpc in topics[:scan_n]:
+        levels = tpc.split(msock._tpc_sep)
+        [p for p in patterns if scan_match(p, levels)]
+    scan_us = (time.perf_counter() - t0) * 1e6 / scan_n
+
+    t0 = time.perf_counter()
+    for tpc in topics:
+        reg.snapshot.pop(tpc, None)
+        reg.subscribers(tpc)
+    trie_us = (time.perf_counter() - t0) * 1e6 / len(topics)
+
+    t0 = time.perf_counter()
+    for tpc in topics:
+        reg.subscribers(tpc)
+    cached_us = (time.perf_counter() - t0) * 1e6 / len(topics)
+
+    return {'patterns': npatterns, 'scan_us': scan_us, 'trie_us': trie_us, 'cached_us': cached_us}
+
+#------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-P', type=int, nargs='+', default=[10, 100, 1000, 10000], dest='patterns')
+    parser.add_argument('-l', type=int, default=4, dest='nlevels', help='Levels of each topic')
+    parser.add_argument('-f', type=int, default=10, dest='fanout', help='Names per level')
+    parser.add_argument('-n', type=int, default=20000, dest='nlookups')
+    d = parser.parse_args()
+
+    rows = [run_once(p, d) for p in d.patterns]
+    bench_util.report("Wildcard matching, topics of %d levels" % d.nlevels, rows,
+                      ['patterns', 'scan_us', 'trie_us', 'cached_us'])
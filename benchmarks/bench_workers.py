@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+
+import time
+import asyncio
+import argparse
+import multiprocessing
+import bench_util
+import my_sock as msock
+
+#-------
+# Worker processes benchmark
+#-------
+#
+# For every number of broker workers W ("-W"), "-c" client processes
+# each connect "-k" publishers and "-k" subscribers, so that the kernel
+# spreads the connections over the workers. Publisher i of client c
+# publishes "-n" messages to its own topic, pipelining them as
+# "pid:seq pub" lines, "-B" per write; the subscriber with the same
+# numbers subscribes to the topic of the next publisher (of the next
+# client), so most messages go from one worker to another through the
+# shared memory rings. Reported per worker count:
+#   msgs/s   messages delivered per second
+
+async def subscriber(host, port, tpc, nmsgs, ready):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(b's%s sub %s\n' % (tpc, tpc))
+    await reader.readline()                         # ack
+    ready.set_result(None)
+    for _ in range(nmsgs):
+        if not await reader.readline():
+            break
+    writer.close()
+
+async def publisher(host, port, tpc, nmsgs, batch, start):
+    reader, writer = await asyncio.open_connection(host, port)
+    await start
+    payload = b'x' * 64
+    for j in range(0, nmsgs, batch):
+        last = min(j + batch, nmsgs)
+        writer.write(b''.join(b'p:%d pub %s %s\n' % (k + 1, tpc, payload) for k in range(j, last)))
+        while msock.parse_ack(str(await reader.readline(), msock._str_enc).strip()) != last:
+            pass
+    writer.close()
+
+async def client(c, d, ready, go):
+    loop = asyncio.get_running_loop()
+    subs_ready = [loop.create_future() for _ in range(d.nconns)]
+    start = loop.create_future()
+    nxt = (c + 1) % d.nclients
+    subs = [asyncio.create_task(subscriber('localhost', d.sub_port, b't%d_%d' % (nxt, i),
+                                           d.nmsgs, subs_ready[i])) for i in range(d.nconns)]
+    pubs = [asyncio.create_task(publisher('localhost', d.pub_port, b't%d_%d' % (c, i),
+                                          d.nmsgs, d.batch, start)) for i in range(d.nconns)]
+    await asyncio.gather(*subs_ready)
+    ready.release()
+    await loop.run_in_executor(None, go.wait)
+    start.set_result(None)
+    await asyncio.gather(*pubs, *subs)
+
+def run_client(c, d, ready, go):
+    asyncio.run(client(c, d, ready, go))
+
+def run_once(nworkers, d):
+    ctx   = multiprocessing.get_context('fork')
+    ready = ctx.Semaphore(0)
+    go    = ctx.Event()
+    procs = [ctx.Process(target=run_client, args=(c, d, ready, go)) for c in range(d.nclients)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        ready.acquire()
+    time.sleep(0.5)                                 # subscriptions reach every worker
+    t0 = time.perf_counter()
+    go.set()
+    for p in procs:
+        p.join()
+    elapsed = time.perf_counter() - t0
+    return {'workers': nworkers, 'msgs/s': d.nclients * d.nconns * d.nmsgs / elapsed}
+
+#------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-W', type=int, nargs='+', default=[1, 2, 4], dest='workers')
+    parser.add_argument('-c', type=int, default=4, dest='nclients', help='Client processes')
+    parser.add_argument('-k', type=int, default=4, dest='nconns',
+                        help='Publishers and subscribers per client')
+    parser.add_argument('-n', type=int, default=20000, dest='nmsgs', help='Messages per publisher')
+    parser.add_argument('-B', type=int, default=100, dest='batch', help='Messages per write')
+    parser.add_argument('-p', type=int, default=9600, dest='pub_port')
+    parser.add_argument('-s', type=int, default=9690, dest='sub_port')
+    d = parser.parse_args()
+
+    rows = []
+    for nworkers in d.workers:
+        proc = bench_util.start_broker(d.pub_port, d.sub_port, '-w', nworkers)
+        try:
+            rows.append(run_once(nworkers, d))
+        finally:
+            bench_util.stop_broker(proc)
+
+    bench_util.report("Broker workers, %d clients of %d publishers and subscribers" %
+                      (d.nclients, d.nconns), rows, ['workers', 'msgs/s'])
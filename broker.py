@@ -3,7 +3,21 @@
 import threading
 import argparse
 import my_sock as msock
+import async_broker
+import outq
+import registry
+import topiclog
+import workers
+import cluster
+import metrics
+import compress
+import dedup
+import retain
+import filters
+import idle
+import loops
 import sys
+import socket
 import time
 
 #------- 
@@ -13,9 +27,35 @@ import time
 _host = "localhost"
 _pub_port = None
 _sub_port = None
+_mode     = None
+_settings = dict(async_broker._settings)         # tunables shared by both modes
 
-_subs_per_topic = {}
-_subs_conn_lock = threading.Lock()
+_registry       = registry.SubRegistry()        # tpc --> ((sid, sconn), ..)
+_bin_conns      = set()                         # connections that negotiated "_opt_bin"
+_codecs         = {}                            # sconn --> compress.Codec, of those negotiating one
+_hdr_conns      = set()                         # connections that negotiated "_opt_hdr" along with "_opt_bin"
+_dicts          = compress.Dictionaries()       # of the topics, with "--dict-dir"
+_producers      = None                          # dedup.Producers, with "--dedup-window"
+_keys           = None                          # dedup.KeyCache, with "--dedup-key-secs"
+_dedup_lock     = threading.Lock()              # of both, shared by the publisher threads
+_rings          = None                          # retain.RingStore, with "--ring-msgs"
+_ring_lock      = threading.Lock()              # of it, along with the subscribers of what it keeps
+_sub_queues     = {}                            # sconn --> ThreadedOutQueue, drained by subwriter()
+_log            = None                          # topiclog.LogStore, with "-l"
+_live_from      = {}                            # sconn --> {tpc: first offset delivered live}
+_idle           = idle.IdleTimer()              # deadlines of the connections, with "--idle-secs" or pings
+_idle_lock      = threading.Lock()              # of it, shared by every connection thread and reaperthread()
+_credit_poll    = 0.01                          # secs between checks of a publisher out of credit
+_ack            = bytes(msock._ack + msock._delim, msock._str_enc)  # of a subscriber command, queued
+_bin_ack        = msock.encode_frame(msock._ack)
+_zip_options    = (msock._opt_zlib, msock._opt_zstd, msock._opt_dict)   # "_hello" options of compression
+
+_metrics = metrics.Metrics(('pubs', 'delivered', 'dropped', 'overflows', 'compressed',
+                            'duplicates', 'duplicate_keys', 'reaped'),
+                           ('pub_conns', 'sub_conns'), ('fanout_us',))
+_stats   = _metrics.counters
+_topics  = _metrics.topics                      # tpc --> [msgs, bytes] published
+_fanout  = _metrics.histograms['fanout_us']     # usecs from reading messages to queueing them
 
 #------- 
 # Command line parsing
@@ -26,7 +66,7 @@ def parse_cmd_args ():
     Sets and parses the arguments in the command line
     storing them in the respective global variables.
     """
-    global _pub_port, _sub_port
+    global _host, _pub_port, _sub_port, _mode
 
     parser  = argparse.ArgumentParser()
     parser.add_argument('-p', type=int, metavar='XXXX', nargs=1, required=True,
@@ -35,12 +75,146 @@ def parse_cmd_args ():
     parser.add_argument('-s', type=int, metavar='YYYY', nargs=1, required=True,
                               dest='sub_port', 
                               help='Port where subscribers will connect')
+    parser.add_argument('-m', type=str, metavar='mode', default='asyncio',
+                              choices=('asyncio', 'threads'), dest='mode',
+                              help='asyncio (default) serves all connections in one event loop, '
+                                   'threads uses one thread per connection')
+    parser.add_argument('--loop', type=str, metavar='loop', default=_settings['loop'],
+                              choices=loops._loops, dest='loop',
+                              help='Event loop of the asyncio mode: %s (default %%(default)s), '
+                                   'those available here: %s' % (', '.join(loops._loops),
+                                                                   ', '.join(loops.available())))
+    parser.add_argument('-q', type=int, metavar='N', default=_settings['queue_msgs'],
+                              dest='queue_msgs',
+                              help='Messages queued per subscriber (default %(default)s)')
+    parser.add_argument('-Q', type=int, metavar='bytes', default=_settings['queue_bytes'],
+                              dest='queue_bytes',
+                              help='Bytes queued per subscriber (default %(default)s)')
+    parser.add_argument('-o', type=str, metavar='policy', default=_settings['overflow'],
+                              choices=outq._policies, dest='overflow',
+                              help='When a subscriber queue is full: ' + ', '.join(outq._policies) +
+                                   ' (default %(default)s)')
+    parser.add_argument('-l', type=str, metavar='dir', default=None,
+                              dest='log_dir',
+                              help='Logs every published message under dir, for "fetch"')
+    parser.add_argument('--log-fsync', type=str, metavar='policy', default=_settings['log_fsync'],
+                              choices=topiclog._fsync_policies, dest='log_fsync',
+                              help='When logs are fsynced: ' + ', '.join(topiclog._fsync_policies) +
+                                   ' (default %(default)s)')
+    parser.add_argument('--log-fsync-ms', type=int, metavar='msecs', default=_settings['log_fsync_ms'],
+                              dest='log_fsync_ms',
+                              help='Msecs between fsyncs with "--log-fsync interval" (default %(default)s)')
+    parser.add_argument('--log-segment-bytes', type=int, metavar='bytes',
+                              default=_settings['log_segment_bytes'], dest='log_segment_bytes',
+                              help='Size of each log file (default %(default)s)')
+    parser.add_argument('--log-retention-bytes', type=int, metavar='bytes',
+                              default=_settings['log_retention_bytes'], dest='log_retention_bytes',
+                              help='Bytes kept per topic, 0 for no limit (default %(default)s)')
+    parser.add_argument('--log-retention-secs', type=int, metavar='secs',
+                              default=_settings['log_retention_secs'], dest='log_retention_secs',
+                              help='Secs messages are kept, 0 for no limit (default %(default)s)')
+    parser.add_argument('-w', type=int, metavar='N', default=_settings['workers'],
+                              dest='workers',
+                              help='asyncio worker processes sharing the ports (default %(default)s)')
+    parser.add_argument('--worker-ring-bytes', type=int, metavar='bytes',
+                              default=_settings['worker_ring_bytes'], dest='worker_ring_bytes',
+                              help='Size of the ring between each two workers (default %(default)s)')
+    parser.add_argument('--credit-msgs', type=int, metavar='N', default=_settings['credit_msgs'],
+                              dest='credit_msgs',
+                              help='Credit window of publishers asking for credit (default %(default)s)')
+    parser.add_argument('--credit-bytes', type=int, metavar='bytes', default=_settings['credit_bytes'],
+                              dest='credit_bytes',
+                              help='Bytes queued to subscribers that stop granting credit '
+                                   '(default %(default)s)')
+    parser.add_argument('--cluster', type=str, metavar='host:pub:sub,..', default=None,
+                              dest='cluster',
+                              help='Nodes of the cluster, the same list on every node')
+    parser.add_argument('--node', type=int, metavar='i', default=_settings['node'],
+                              dest='node',
+                              help='Index of this node in --cluster (default %(default)s)')
+    parser.add_argument('-v', type=int, metavar='level', default=_settings['verbosity'],
+                              choices=(metrics._quiet, metrics._info, metrics._debug), dest='verbosity',
+                              help='Logs errors only (0), also connections and commands (1), '
+                                   'also every message (2) (default %(default)s)')
+    parser.add_argument('--metrics-port', type=int, metavar='XXXX', default=None,
+                              dest='metrics_port',
+                              help='Serves the metrics on http://localhost:XXXX/metrics, '
+                                   'on XXXX + i for worker i')
+    parser.add_argument('--dict-dir', type=str, metavar='dir', default=None,
+                              dest='dict_dir',
+                              help='Compression dictionaries of the topics, "<topic>.dict" files '
+                                   '(see compress.py)')
+    parser.add_argument('--dedup-window', type=int, metavar='N', default=_settings['dedup_window'],
+                              dest='dedup_window',
+                              help='Sequence numbers tracked per idempotent producer, 0 for none '
+                                   '(default %(default)s)')
+    parser.add_argument('--dedup-key-secs', type=float, metavar='secs', default=_settings['dedup_key_secs'],
+                              dest='dedup_key_secs',
+                              help='Drops messages whose key was seen on their topic within secs '
+                                   '(default %(default)s, never)')
+    parser.add_argument('--dedup-keys', type=int, metavar='N', default=_settings['dedup_keys'],
+                              dest='dedup_keys',
+                              help='Message keys remembered at most (default %(default)s)')
+    parser.add_argument('--ring-msgs', type=int, metavar='N', default=_settings['ring_msgs'],
+                              dest='ring_msgs',
+                              help='Last messages kept in memory per topic, for "sub tpc last K" '
+                                   '(default %(default)s, none)')
+    parser.add_argument('--ring-bytes', type=int, metavar='bytes', default=_settings['ring_bytes'],
+                              dest='ring_bytes',
+                              help='Payload bytes kept in memory per topic (default %(default)s)')
+    parser.add_argument('--ring-memory', type=int, metavar='bytes', default=_settings['ring_memory'],
+                              dest='ring_memory',
+                              help='Memory of the rings of all the topics, those published to least '
+                                   'recently dropped past it (default %(default)s)')
+    parser.add_argument('--retain', type=int, metavar='K', default=_settings['retain'],
+                              dest='retain',
+                              help='Last messages every "sub" gets first, 1 for the last value, '
+                                   'kept with --ring-msgs K at least (default %(default)s)')
+    parser.add_argument('--keepalive-secs', type=int, metavar='secs', default=_settings['keepalive_secs'],
+                              dest='keepalive_secs',
+                              help='TCP keepalive of the client connections, probed once silent '
+                                   'for secs, 0 for none (default %(default)s)')
+    parser.add_argument('--idle-secs', type=float, metavar='secs', default=_settings['idle_secs'],
+                              dest='idle_secs',
+                              help='Disconnects clients silent for secs, those declaring "ping=N" '
+                                   'once silent for %g pings, 0 for never (default %%(default)s)'
+                                   % msock._ping_grace)
     
     d = parser.parse_args()
+    if d.loop != loops._loop and (d.mode != 'asyncio' or d.loop not in loops.available()):
+        parser.error('--loop needs the asyncio mode and a loop available here: %s' %
+                     ', '.join(loops.available()))
+    if d.workers > 1 and (d.mode != 'asyncio' or d.log_dir or d.ring_msgs or d.retain):
+        parser.error('-w needs the asyncio mode, no -l and no --ring-msgs')
+    nodes = None
+    if d.cluster is not None:
+        nodes = cluster.parse_nodes(d.cluster)
+        if nodes is None or not 0 <= d.node < len(nodes):
+            parser.error('--cluster needs host:pub:sub,.. and --node an index in it')
+        if d.mode != 'asyncio' or d.workers > 1:
+            parser.error('--cluster needs the asyncio mode and no -w')
+        if nodes[d.node][1:] != (d.pub_port[0], d.sub_port[0]):
+            parser.error('-p and -s differ from the ports of --node in --cluster')
+        _host = nodes[d.node][0]
 
     _pub_port = d.pub_port[0]
     _sub_port = d.sub_port[0]
-    print('Broker> got --> pub port %d, sub port %d' % (_pub_port, _sub_port))
+    _mode     = d.mode
+    _settings.update(queue_msgs=d.queue_msgs, queue_bytes=d.queue_bytes, overflow=d.overflow,
+                     log_dir=d.log_dir, log_fsync=d.log_fsync, log_fsync_ms=d.log_fsync_ms,
+                     log_segment_bytes=d.log_segment_bytes,
+                     log_retention_bytes=d.log_retention_bytes,
+                     log_retention_secs=d.log_retention_secs,
+                     workers=d.workers, worker_ring_bytes=d.worker_ring_bytes,
+                     cluster=nodes, node=d.node,
+                     credit_msgs=d.credit_msgs, credit_bytes=d.credit_bytes,
+                     verbosity=d.verbosity, metrics_port=d.metrics_port, dict_dir=d.dict_dir,
+                     dedup_window=d.dedup_window, dedup_key_secs=d.dedup_key_secs,
+                     dedup_keys=d.dedup_keys, ring_msgs=max(d.ring_msgs, d.retain),
+                     ring_bytes=d.ring_bytes, ring_memory=d.ring_memory, retain=d.retain,
+                     keepalive_secs=d.keepalive_secs, idle_secs=d.idle_secs, loop=d.loop)
+    print('Broker> got --> pub port %d, sub port %d, mode %s' % (_pub_port, _sub_port, _mode) +
+          (', loop %s' % d.loop if _mode == 'asyncio' else ''))
 
 #------- 
 # Threads for handling publishers and subscribers
@@ -48,100 +222,800 @@ def parse_cmd_args ():
 
 def pubthread():
     """
-    Thread for handling publishers.
-    Note:
-    Currently supports one publisher.
+    Thread accepting publishers.
+    Each connected publisher is served by its own thread (see pubconn()).
     """
     pub_sock = msock.create_socket_server(_host, _pub_port)
     print("Broker> listening pubs on %s:%d" % (_host, _pub_port))
     
-    conn, addr = pub_sock.accept()
-    print("Broker> Pub connected: " + addr[0] + ":" + str(addr[1]))
-
     while True:
-        smsg = msock.read_from_socket(conn)      # pub_id, cmd, tpc, msg
-        if smsg is None:
-            print("Broker> Pub disconnected, cannot read from pub")
-            break
-        print("Broker> Received from Pub <%s>" % smsg)    
+        conn, addr = pub_sock.accept()
+        metrics.log(metrics._info, "Broker> Pub connected: " + addr[0] + ":" + str(addr[1]))
+        threading.Thread(target=pubconn, args=(conn,), daemon=True).start()
+
+#------
+
+def pubconn(conn):
+    """
+    Thread for handling one publisher.
+    Publishes carrying a sequence number are acked cumulatively,
+    once per read, with the highest sequence number read; all the acks
+    of a read are sent once its messages are logged.
+    The messages for each subscriber are gathered over the whole read and
+    queued to its writer thread (see subwriter()), which writes whatever
+    is queued with a single vectored write; the acks of the read follow,
+    once its messages are queued. A publisher that negotiated
+    "_opt_credit" is granted credit after every read (see grant()).
+    The time of each read is the ingress time of its messages (see
+    fan_out()).
+    The time from reading messages until they are queued to their
+    subscribers, once per read, goes to the "fanout_us" histogram.
+    Every read counts as hearing from the publisher (see watch()).
+    """
+    reader = msock.FrameReader(conn)
+    state  = {'batch_left': 0, 'batch_seq': None,     # of a text "pubbatch"
+              'batch_dup': False,
+              'producer': None,                         # producer id, of an idempotent publisher
+              'acks': 0,                                # plain acks not yet sent
+              'pid': None,                              # key of "key-hash" consumer groups
+              'credit': False, 'received': 0,           # messages received
+              'granted': 0, 'throttled': 0.0,           # credit granted, secs out of credit
+              'read_us': 0}                             # msock.now_us() of the last read
+    _metrics.gauges['pub_conns'] += 1
+    watch(conn)
+    while reader.fill() > 0:
+        read_at = time.perf_counter_ns()
+        heard(conn)
+        state['read_us'] = msock.now_us()
+        received = state['received']
+        ack_seq = None
+        out = {}                                 # sconn --> [(buffers, priority, stamp)]
+        for frame in reader.frames():
+            seq = pubframe(conn, reader, frame, state, out)
+            if seq is not None:
+                ack_seq = seq
+        if _log is not None:
+            _log.sync()
+        blocking = out and _settings['overflow'] == 'block'
+        if blocking:                            # not read, nor pings, while waiting on a queue
+            suspend(conn)
+        for sconn, msgs in out.items():
+            queue_out(sconn, msgs)
+        if blocking:
+            resume(conn)
+        if state['received'] > received:
+            _fanout.record((time.perf_counter_ns() - read_at) // 1000, state['received'] - received)
+        if state['acks']:
+            ack = (msock.encode_frame(msock._ack) if reader.binary else
+                   bytes(msock._ack + msock._delim, msock._str_enc))
+            msock.write_bytes(conn, ack * state['acks'])
+            state['acks'] = 0
+        if ack_seq is not None:
+            msock.send_ack(conn, reader.binary, ack_seq)
+        if state['credit']:
+            grant(conn, reader.binary, state)
+
+    _metrics.gauges['pub_conns'] -= 1
+    _codecs.pop(conn, None)
+    unwatch(conn)
+    conn.close()
+    metrics.log(metrics._info, "Broker> Pub disconnected, cannot read from pub")
+    if state['credit']:
+        metrics.log(metrics._info, "\t\tthrottled for %.3f secs out of credit" %
+                    state['throttled'])
+
+#------
+
+def pubframe(conn, reader, frame, state, out):
+    """
+    Handles one frame read from a publisher, a message or a "pubbatch" of
+    messages, gathering in "out" what each subscriber should be sent.
+    A text "pubbatch" is the line "pid[:seq] pubbatch n" followed by n
+    lines "tpc msg", tracked in "state".
+    The publisher id, "pid" in text or the id given in "_hello", is kept
+    in "state" as the producer id of the messages; "key-hash" consumer
+    groups key binary messages by their message key, if any, or by it.
+    Plain acks, and the messages received, are counted in "state", to be
+    sent, and granted credit for, by pubconn().
+    Compressed frames are decompressed, a "pubbatch" as a whole; the
+    compressed payload of a "pub" is passed on to its subscribers of the
+    same codec.
+    What an idempotent publisher sends again, and "pub" frames whose key
+    was seen on their topic lately, are acked but dropped (see duplicate()).
+    The headers of a binary message, if any, go along with it, those of a
+    "pubbatch" with each of its messages.
+    "_ping" is answered with "_pong" at once.
+    Returns:
+        None, if the frame has a plain ack or is not to be acked
+        seq,  the sequence number of the frame, still to be acked
+    """
+    if reader.binary:                            # cmd, tpc, payload
+        cmd, flags, btpc, ext, payload = msock.decode_frame(frame)
+        if cmd == msock._ping:
+            msock.write_bytes(conn, msock.encode_pong(True))
+            return None
+        seq = msock.frame_seq(flags, ext)
+        if seq is None:
+            state['acks'] += 1
+        key = msock.frame_key(flags, ext)
+        if duplicate(state['producer'], seq, btpc, key):
+            return seq
+        hdrs = msock.frame_headers(flags, ext)
+        packed = None
+        if flags & compress._zip_flags:
+            packed = payload
+            payload = compress.unpack(flags, ext, packed, _dicts)
+            if payload is None:
+                print("Broker> Cannot decompress %s of %s, dropped" % (cmd, state['pid']))
+                return seq
+        if cmd == "pubbatch":
+            for btpc, payload in msock.iter_batch(payload):
+                state['received'] += 1
+                fan_out(btpc, payload, None, out, state['pid'], None, hdrs, state['read_us'], key)
+        elif cmd == "pub" and packed is not None:
+            state['received'] += 1
+            fan_out(btpc, payload, None, out, state['pid'],
+                    compress.repack(flags, ext, btpc, packed, _dicts), hdrs, state['read_us'], key)
+        elif cmd == "pub":
+            frame = msock.retag_frame(frame, 'msg')
+            _, _, btpc, _, payload = msock.decode_frame(frame)
+            state['received'] += 1
+            fan_out(btpc, payload, frame, out, state['pid'], None, hdrs, state['read_us'], key)
+        else:
+            print("Broker> Invalid publisher command")
+        return seq
+
+    smsg = str(frame, msock._str_enc).strip()     # pub_id[:seq], cmd, tpc, msg
+    words = smsg.split(' ')
+    if state['batch_left']:                      # tpc, msg
+        state['batch_left'] -= 1
+        if not state['batch_dup']:
+            state['received'] += 1
+            fan_out(bytes(words[0], msock._str_enc), bytes(' '.join(words[1:]), msock._str_enc),
+                    None, out, state['pid'], None, None, state['read_us'])
+        if state['batch_left']:
+            return None
+        if state['batch_seq'] is None:
+            state['acks'] += 1
+        return state['batch_seq']
+    if metrics.verbosity >= metrics._debug:
+        print("Broker> Received from Pub <%s>" % smsg)
 
-        words = smsg.split(' ')
-        pid, cmd, tpc, msg = words[0], words[1], words[2], ' '.join(words[3:])
+    if len(words) == 2 and words[1] == msock._ping:
+        msock.write_bytes(conn, msock.encode_pong(False))
+        return None
+    if len(words) < 3:
+        print("Broker> Invalid publisher command")
+        return None
+    if words[1] == msock._hello:
+        state['pid'], opts = hello(conn, reader, words, (msock._opt_bin, msock._opt_credit) + _zip_options)
+        state['credit'] = msock._opt_credit in opts
+        if _producers is not None:
+            state['producer'] = msock.idem_producer(opts)
+        return None
+    pid, cmd, tpc, msg = words[0], words[1], words[2], ' '.join(words[3:])
+    pid, _, seq = pid.partition(msock._seq_sep)
+    seq = int(seq) if seq.isdigit() else None
+    state['pid'] = pid
+    if cmd == "pubbatch" and tpc.isdigit() and int(tpc) > 0:
+        state['batch_left'], state['batch_seq'] = int(tpc), seq
+        state['batch_dup'] = duplicate(state['producer'], seq)
+        return None
+    if metrics.verbosity >= metrics._debug:
         print("\t\tpubid: %s" % pid)
         print("\t\ttopic: %s" % tpc)
         print("\t\tmessage: %s" % msg)
-        msock.send_ack(conn)
-        
-        if cmd != "pub":
-            print("Broker> Invalid publisher command")
+    if seq is None:
+        state['acks'] += 1
+    
+    if cmd != "pub":
+        print("Broker> Invalid publisher command")
+        return seq
+    if duplicate(state['producer'], seq):
+        return seq
+
+    state['received'] += 1
+    fan_out(bytes(tpc, msock._str_enc), bytes(msg, msock._str_enc), None, out, pid, None, None,
+            state['read_us'])
+    return seq
+
+#------
+
+def duplicate(producer, seq, btpc=None, key=None):
+    """
+    Tells a message to drop: message "seq" of idempotent "producer" sent
+    before (see dedup.Producers), or one with message "key" seen on topic
+    "btpc" within "--dedup-key-secs" (see dedup.KeyCache).
+    Returns:
+        True,  if a duplicate, counted in "_stats"
+        False, when normal
+    """
+    if producer is not None and seq is not None:
+        with _dedup_lock:
+            dup = _producers.duplicate(producer, seq)
+        if dup:
+            _stats['duplicates'] += 1
+            return True
+    if key is not None and _keys is not None:
+        with _dedup_lock:
+            dup = _keys.duplicate(bytes(btpc), key)
+        if dup:
+            _stats['duplicate_keys'] += 1
+            return True
+    return False
+
+#------
+
+def subscribers(tpc, payload):
+    """
+    Returns:
+        ((sid, sconn), ..), the subscribers of topic "tpc" and those of
+        them with a filter the message "payload" matches
+    """
+    subcs = _registry.subscribers(tpc)
+    if _registry.filters:
+        subcs += _registry.filtered(tpc, payload, subcs)
+    return subcs
+
+#------
+
+def fan_out(btpc, payload, frame, out, producer=None, packed=None, headers=None, ingress=0, key=None):
+    """
+    Gathers in "out" the message for each subscriber of topic "btpc", as
+    the received binary "frame" retagged as "msg" if given, or else as a
+    frame or a text message built once and shared by the subscribers.
+    Frames viewing the receive buffer are copied, once, as they are
+    written after the buffer is reused.
+    Subscribers with a codec get a compressed frame, built once per codec
+    and shared too, or "packed", (Codec, buffers), the frame as compressed
+    by the publisher, for those of its codec.
+    The subscribers are read from the registry snapshot, without locking.
+    With "-l" every message is also appended to the log of its topic,
+    skipped for the subscribers replaying the log up to it, and its offset
+    is committed for the subscribers it is queued to.
+    With "--ring-msgs" it is also kept in the ring of its topic, along
+    with reading the subscribers, under "_ring_lock" (see retained()).
+    Subscribers with a filter get the message only if it matches, the
+    filters of the topic matched at once (see registry.SubRegistry.filtered()).
+    Each consumer group of the topic gets the message once, gathered for
+    the member picked by its policy, counting what "out" already holds for
+    it as outstanding; "key-hash" groups hash the message "key", bytes,
+    or the producer id if it has none (see my_sock.group_key()).
+    Each message goes in "out" along with the priority of its "headers",
+    my_sock.Headers if published with some, the lane it is queued in.
+    Subscribers with "_opt_hdr" get a frame of their own with the headers,
+    the producer id defaulting to "producer", and the "ingress" time, its egress
+    time set as their writer thread takes it (see my_sock.hdr_parts()).
+    """
+    tpc = str(btpc, msock._str_enc)
+    _stats['pubs'] += 1
+    counts = _topics.get(tpc) or _metrics.topic(tpc)
+    counts[0] += 1
+    counts[1] += len(payload)
+    offset = None
+    if _log is not None:
+        offset = _log.append(tpc, payload)
+    if _rings is not None:
+        with _ring_lock:
+            _rings.append(tpc, payload)
+            subcs = subscribers(tpc, payload)
+    else:
+        subcs = subscribers(tpc, payload)
+    groups = _registry.consumer_groups(tpc)
+    if groups:
+        load = lambda sconn: outstanding(sconn) + len(out.get(sconn, ()))
+        gkey = msock.group_key(key, headers, producer)
+        subcs += tuple((None, m[1]) for m in (g.pick(gkey, load) for g in groups)
+                       if m is not None)
+    if not subcs:
+        return
+    if metrics.verbosity >= metrics._debug:
+        print("Broker> Sending message to all subscribers for the topic")
+    text = zips = hdrs = data = None
+    priority = min(headers.priority, msock._priorities - 1) if headers is not None else 0
+    for sid, sconn in subcs:
+        if offset is not None and sid is not None:
+            live_from = _live_from.get(sconn)
+            if live_from and offset < live_from.get(tpc, offset + 1):
+                continue
+            _log.offsets.commit(sid, tpc, offset + 1)
+        codec = _codecs.get(sconn)
+        zbuf = None
+        if codec is not None:
+            if zips is None:
+                zips = {packed[0]: b''.join(packed[1])} if packed is not None else {}
+            zbuf = zips.get(codec, b'')
+            if zbuf == b'':
+                zbuf = codec.msg_parts(btpc, tpc, payload)
+                zbuf = zips[codec] = b''.join(zbuf) if zbuf is not None else None
+                _stats['compressed'] += zbuf is not None
+            if zbuf is not None and sconn not in _hdr_conns:
+                out.setdefault(sconn, []).append(((zbuf,), priority, None))
+                _stats['delivered'] += 1
+                continue
+        if sconn in _hdr_conns:
+            if hdrs is None:
+                hdrs = msock.received_headers(headers, ingress, producer)
+            if zbuf is not None:
+                _, flags, tlen, elen, plen = msock._bin_hdr.unpack_from(zbuf)
+                o = msock._bin_hdr.size + tlen
+                parts, stamp = msock.hdr_parts(btpc, zbuf[o + elen:], hdrs, flags, zbuf[o:o + elen])
+            else:
+                if data is None:
+                    data = bytes(payload)
+                parts, stamp = msock.hdr_parts(btpc, data, hdrs)
+            out.setdefault(sconn, []).append((parts, priority, stamp))
+            _stats['delivered'] += 1
             continue
+        if sconn in _bin_conns:
+            if frame is None:
+                frame = msock.encode_frame('msg', btpc, payload)
+            elif isinstance(frame, memoryview):
+                frame = bytes(frame)
+            buf = frame
+        else:
+            if text is None:
+                text = b''.join((btpc, b' ', payload, msock._bdelim))
+            buf = text
+        out.setdefault(sconn, []).append(((buf,), priority, None))
+        _stats['delivered'] += 1
+
+#------
+
+def grant(conn, binary, state):
+    """
+    Grants a publisher credit for "credit_msgs" messages past those
+    received, shrunk as the subscriber queues fill "credit_bytes" (see
+    outq.credit_window()), once half a window is due. Out of credit, with
+    none to grant, it waits polling every "_credit_poll" secs until the
+    queues drain, the publisher being throttled meanwhile.
+    """
+    t0 = None
+    while True:
+        queued = sum(q.nbytes for q in list(_sub_queues.values()))
+        window = outq.credit_window(_settings['credit_msgs'], queued, _settings['credit_bytes'])
+        if window or state['received'] < state['granted']:
+            break
+        if t0 is None:
+            t0 = time.monotonic()
+        time.sleep(_credit_poll)
+    if t0 is not None:
+        state['throttled'] += time.monotonic() - t0
+    limit = state['received'] + window
+    if window and limit - state['granted'] >= max(1, window // 2):
+        state['granted'] = limit
+        msock.write_bytes(conn, msock.encode_credit(binary, limit))
+
+#------
 
-        with _subs_conn_lock:
-            if tpc in _subs_per_topic:
-                print("Broker> Sending message to all subscribers for the topic")
-                for sid, sconn in _subs_per_topic[tpc]:
-                    msock.write2socket(sconn, tpc + ' ' + msg)
-                print("Broker> Message sent to all subscribers for the topic")
+def outstanding(sconn):
+    """
+    Returns:
+        the messages queued to a subscriber and not yet taken by its
+        writer thread, the load of "least-outstanding" consumer groups
+    """
+    q = _sub_queues.get(sconn)
+    return len(q) if q is not None else 0
+
+#------
+
+def queue_out(sconn, msgs):
+    """
+    Queues messages to a subscriber, "msgs" as gathered by fan_out(),
+    applying the overflow policy of its queue; for "block" the publisher
+    thread waits until the queue drains.
+    """
+    q = _sub_queues.get(sconn)
+    if q is None:                               # disconnected meanwhile
+        return
+    for parts, priority, stamp in msgs:
+        res = q.put_wait(parts, sum(len(b) for b in parts), True, priority, stamp)
+        if res == outq._dropped:
+            _stats['dropped'] += 1
+        elif res == outq._overflow:
+            _stats['overflows'] += 1
+            print("Broker> Sub queue overflow, disconnecting")
+            q.close()
+            evict(sconn)
+            return
+
+#------
+
+def subwriter(conn, q):
+    """
+    Thread writing to one subscriber whatever is queued for it,
+    with one vectored write each time. A failed write evicts the
+    subscriber at once (see evict()).
+    """
+    while True:
+        bufs = q.take_wait()
+        if bufs is None:
+            break
+        if msock.write_vec(conn, bufs) == -1:
+            evict(conn)
+            break
+
+#------
+
+def evict(conn):
+    """
+    Removes a subscriber from every topic and group, so that publishers
+    stop queueing to it at once rather than once its thread reads the
+    disconnection, and shuts its connection down, its thread then
+    cleaning up the rest.
+    """
+    _registry.drop(conn)
+    try:
+        conn.shutdown(socket.SHUT_RDWR)
+    except OSError:                             # closed meanwhile
+        pass
+
+#------
+
+def watch(conn):
+    """
+    Turns on TCP keepalive for a client connection, with "--keepalive-secs",
+    and starts its deadline, with "--idle-secs" (see reaperthread()).
+    """
+    if _settings['keepalive_secs']:
+        msock.set_keepalive(conn, _settings['keepalive_secs'])
+    with _idle_lock:
+        _idle.add(conn, time.monotonic())
+
+def heard(conn):
+    with _idle_lock:
+        _idle.touch(conn, time.monotonic())
+
+def unwatch(conn):
+    with _idle_lock:
+        _idle.remove(conn)
+
+def suspend(conn):
+    """
+    Stops the deadline of a connection while it is not read, e.g. a
+    publisher waiting on a full subscriber queue, until resume().
+    """
+    with _idle_lock:
+        _idle.suspend(conn)
+
+def resume(conn):
+    with _idle_lock:
+        _idle.resume(conn, time.monotonic())
+
+#------
+
+def reaperthread():
+    """
+    Thread disconnecting, every "_tick_secs", the clients silent past
+    their deadline (see idle.IdleTimer), one thread for all of them.
+    """
+    while True:
+        time.sleep(_idle.tick_secs)
+        with _idle_lock:
+            dead = _idle.expired(time.monotonic())
+        for conn in dead:
+            print("Broker> Client silent for too long, disconnecting")
+            _stats['reaped'] += 1
+            evict(conn)
 
 #------
 
 def subthread():
     """
-    Thread for handling subscribers.
-    Note:
-    Currently supports one subscriber.
+    Thread accepting subscribers.
+    Each connected subscriber is served by its own thread (see subconn()).
     """
-    global _subs_per_topic 
-    
     sub_sock = msock.create_socket_server(_host, _sub_port)
     print("Broker> listening subs on %s:%d" % (_host, _sub_port))
 
-    conn, addr = sub_sock.accept()
-    print("Broker> Sub connected : " + addr[0] + ":" + str(addr[1]))
+    while True:
+        conn, addr = sub_sock.accept()
+        metrics.log(metrics._info, "Broker> Sub connected : " + addr[0] + ":" + str(addr[1]))
+        threading.Thread(target=subconn, args=(conn,), daemon=True).start()
+
+#------
 
+def subconn(conn):
+    """
+    Thread for handling one subscriber.
+    "sid fetch tpc offset" replays the log of a topic (see fetch()).
+    "sid sub tpc from offset|earliest|latest", or "sid sub tpc" for a
+    subscriber id that committed an offset of "tpc", replays the log from
+    there and then goes on with the live messages (see catch_up()).
+    "sid sub|unsub tpc group name [policy]" joins or leaves a consumer
+    group of the topic (see membership()).
+    "sid ping", or a "_ping" frame, is answered with "_pong"; anything
+    read counts as hearing from the subscriber (see watch()).
+    Acks and pongs go through the out-queue of the subscriber like its
+    messages, so that subwriter() alone writes to the socket and nothing
+    interleaves with a frame partly written.
+    On disconnection the subscriber is removed from every topic and group,
+    and the connection closed once subwriter() is done with it.
+    """
+    reader = msock.FrameReader(conn)
+    sid = None
+    q   = outq.ThreadedOutQueue(_settings['queue_msgs'], _settings['queue_bytes'],
+                                _settings['overflow'])
+    _sub_queues[conn] = q
+    _metrics.gauges['sub_conns'] += 1
+    live_from = _live_from[conn] = {}
+    writer = threading.Thread(target=subwriter, args=(conn, q), daemon=True)
+    writer.start()
+    watch(conn)
     while True:
-        smsg = msock.read_from_socket(conn)      # subid, cmd, tpc OR _ack
-        if smsg is None:
-            print("Broker> Sub disconnected, cannot read from sub")
+        frame = reader.read_frame()
+        if frame is not None:
+            heard(conn)
+        else:
+            metrics.log(metrics._info, "Broker> Sub disconnected, cannot read from sub")
+            metrics.log(metrics._info, "\t\tqueue depth/bytes/dropped/peak: %d/%d/%d/%d" % q.stats())
+            _registry.drop(conn)
+            _bin_conns.discard(conn)
+            _hdr_conns.discard(conn)
+            _codecs.pop(conn, None)
+            _live_from.pop(conn, None)
+            _sub_queues.pop(conn, None)
+            _metrics.gauges['sub_conns'] -= 1
+            unwatch(conn)
+            q.close()
+            try:
+                conn.shutdown(socket.SHUT_RDWR)     # e.g. on a frame over msock._max_frame
+            except OSError:                         # already down
+                pass
+            writer.join()
+            conn.close()
             break
-        print("Broker> Received from sub <%s>" % smsg)  
 
-        words = smsg.split(' ')
-        if len(words) == 1:                     # _ack
-            continue
-        sid, cmd, tpc = words
-        print("\t\tsubid: %s" % sid)
-        print("\t\treceived command: %s" % cmd)
-        print("\t\treceived topic: %s" % tpc)
-        msock.send_ack(conn)
+        if reader.binary:                        # cmd, tpc OR _ack
+            cmd, flags, btpc, ext, payload = msock.decode_frame(frame)
+            if cmd == msock._ack:
+                continue
+            if cmd == msock._ping:
+                pong = msock.encode_pong(True)
+                q.put_wait((pong,), len(pong), False)
+                continue
+            tpc = str(btpc, msock._str_enc)
+            if cmd == "fetch":
+                fetch(q, True, tpc, msock.frame_seq(flags, ext) or 0)
+                continue
+            opts = msock.sub_options(str(payload, msock._str_enc).split(' '))
+            if opts is None:
+                print("Broker> Invalid subscriber command")
+                continue
+            q.put_wait((_bin_ack,), len(_bin_ack), False)
+        else:                                    # subid, cmd, tpc OR _ack
+            smsg = str(frame, msock._str_enc).strip()
+            metrics.log(metrics._info, "Broker> Received from sub <%s>" % smsg)  
+
+            words = smsg.split(' ')
+            if len(words) == 1:                 # _ack
+                continue
+            if len(words) > 1 and words[1] == msock._hello:
+                sid, _ = hello(conn, reader, words, q=q)
+                continue
+            if len(words) == 2 and words[1] == msock._ping:
+                pong = msock.encode_pong(False)
+                q.put_wait((pong,), len(pong), False)
+                continue
+            if len(words) == 4 and words[1] == "fetch" and words[3].isdigit():
+                fetch(q, False, words[2], int(words[3]))
+                continue
+            opts = msock.sub_options(words[3:]) if len(words) >= 3 else None
+            if opts is None:
+                print("Broker> Invalid subscriber command")
+                continue
+            sid, cmd, tpc = words[:3]
+            metrics.log(metrics._info, "\t\tsubid: %s" % sid)
+            metrics.log(metrics._info, "\t\treceived command: %s" % cmd)
+            metrics.log(metrics._info, "\t\treceived topic: %s" % tpc)
+            q.put_wait((_ack,), len(_ack), False)
 
-        if cmd != "sub" and cmd != "unsub":
+        frm, group, policy, where = opts
+        if group is not None and (cmd == "sub" or cmd == "unsub" and policy is None):
+            membership(conn, sid, cmd, tpc, group, policy or registry._group_policies[0])
+            continue
+        if cmd != "sub" and cmd != "unsub" or frm is not None and cmd != "sub" or group is not None:
             print("Broker> Invalid subscriber command")
             continue
+        if where is not None:
+            where = filters.parse(where)
+            if where is None or cmd != "sub":
+                print("Broker> Invalid subscriber command, bad filter")
+                continue
+
+        last = msock.last_count(frm)
+        start = None
+        if cmd == "sub" and last is None and where is None and _log is not None and not msock.is_pattern(tpc):
+            start = _log.start_offset(sid, tpc, frm)
+        if start == -1:
+            print("Broker> Invalid subscriber command, bad offset %s" % frm)
+            continue
+        if last is None and start is None:
+            last = _settings['retain']
+
+        if cmd == "sub":
+            if start is not None:
+                live_from[tpc] = float('inf')
+            if _rings is not None and last:
+                res = retained(q, reader.binary, sid, conn, tpc, last, where)
+            else:
+                res = _registry.subscribe(tpc, sid, conn, where)
+            if res is None:
+                print("Broker> Invalid topic pattern")
+            elif res:
+                metrics.log(metrics._info, "Broker> New subscriber for topic")
+            else:
+                metrics.log(metrics._info, "Broker> Subscriber already subscribed")
+            if start is not None and res:
+                metrics.log(metrics._info, "Broker> Replaying %s from %d" % (tpc, start))
+                catch_up(q, reader.binary, sid, tpc, start, live_from)
+            elif start is not None:
+                live_from.pop(tpc, None)
+        elif _registry.unsubscribe(tpc, sid):
+            live_from.pop(tpc, None)
+            metrics.log(metrics._info, "Broker> Unsubscription")
+        else:
+            print("Broker> Invalid unsubscription, no previous subscription")
+
+#------
+
+def retained(q, binary, sid, sconn, tpc, k, where=None):
+    """
+    Subscribes "sid" on "sconn" to topic "tpc", filtered by filters.Filter
+    "where" if given, and queues to "q" the last "k" messages kept of
+    "tpc", or of every topic matching it if a pattern, of those matching.
+    Both happen under "_ring_lock", as messages are kept and their
+    subscribers read under it in fan_out(), so the live messages follow
+    without a gap or a duplicate.
+    Returns:
+        what registry.SubRegistry.subscribe() does
+    """
+    n = 0
+    with _ring_lock:
+        res = _registry.subscribe(tpc, sid, sconn, where)
+        if res:
+            tpcs = [t for t in _rings.rings if msock.matches(tpc, t)] if msock.is_pattern(tpc) else [tpc]
+            for t in tpcs:
+                btpc = bytes(t, msock._str_enc)
+                for payload in _rings.last(t, k):
+                    if where is None or where.matches(filters.fields(payload)):
+                        q.put_wait(msock.msg_parts(btpc, payload, binary), len(payload), False)
+                        n += 1
+    if n:
+        metrics.log(metrics._info, "Broker> Sent %d retained messages of %s" % (n, tpc))
+    return res
+
+#------
+
+def membership(conn, sid, cmd, tpc, group, policy):
+    """
+    Adds subscriber "sid" on "conn" to consumer group "group" of topic
+    "tpc", or removes it, rebalancing the group. Groups are live only:
+    their messages are neither replayed nor committed as offsets.
+    """
+    if cmd == "sub":
+        res = _registry.join(tpc, group, sid, conn, policy)
+        if res is None:
+            print("Broker> Invalid group subscription, bad topic or policy")
+        elif res is False:
+            metrics.log(metrics._info, "Broker> Subscriber already in group")
+        else:
+            if res.policy != policy:
+                metrics.log(metrics._info, "Broker> Group %s keeps policy %s" % (group, res.policy))
+            metrics.log(metrics._info, "Broker> Group %s of %s rebalanced over %d members" %
+                        (group, tpc, len(res.members)))
+        return
+    res = _registry.leave(tpc, group, sid)
+    if res is None:
+        print("Broker> Invalid group unsubscription, not a member")
+    else:
+        metrics.log(metrics._info, "Broker> Group %s of %s rebalanced over %d members" %
+                    (group, tpc, len(res.members)))
+
+#------
+
+def catch_up(q, binary, sid, tpc, offset, live_from):
+    """
+    Queues to the subscriber of queue "q" the log of topic "tpc" from
+    "offset" on, one read of "fetch_bytes" at a time, each one once the
+    queue has drained half way. Then it switches the topic to live messages
+    from the log end on, taking the lock of the log so that a message is
+    either appended before, and replayed, or after, and delivered live.
+    """
+    log  = _log.get(tpc)
+    btpc = bytes(tpc, msock._str_enc)
+    while not q.closed:
+        with log.lock:
+            if offset >= log.end():
+                live_from[tpc] = offset
+                metrics.log(metrics._info, "Broker> Sub %s caught up with %s at %d" %
+                            (sid, tpc, offset))
+                return
+        recs, offset = log.read(offset, _settings['fetch_bytes'])
+        for off, ts, payload in recs:
+            q.put_wait(msock.msg_parts(btpc, payload, binary, off), len(payload), False)
+        _log.offsets.commit(sid, tpc, offset)
+        q.wait_low()
 
-        with _subs_conn_lock:                   
-            subcs = _subs_per_topic.get(tpc)
-            if subcs is None:                   # topic does not exist    
-                if cmd == "sub":
-                    print("Broker> New subscriber and topic")
-                    _subs_per_topic[tpc] = [(sid, conn)]
-                else:
-                    print("Broker> Invalid unsubscription")
-            else:                               # topic exists
-                subs = [x[0] for x in subcs]    # already enlisted subscribers
-                ndx  = None                     # index of connected subscriber, None if not enlisted
-                if sid in subs:
-                    ndx = subs.index(sid)
-                if cmd == "sub" and ndx is None:
-                    print("Broker> New subscriber for existing topic")
-                    _subs_per_topic[tpc].append((sid, conn))  
-                elif cmd == "sub" and ndx is not None:
-                    print("Broker> Subscriber already subscribed") 
-                elif cmd == "unsub" and ndx is None:
-                    print("Broker> Invalid unsubscription, no previous subscription")
-                else:
-                    print("Broker> Unsubscription")
-                    subcs.pop(ndx)
+#------
+
+def fetch(q, binary, tpc, offset):
+    """
+    Queues to the subscriber of queue "q" the logged messages of topic "tpc"
+    from "offset" on, up to "fetch_bytes" of them, followed by the ack
+    "_ack next" with the offset to fetch next; binary messages carry their
+    offset as sequence number. The writer thread sends the payloads
+    straight from the mapped log segments. The replies, already bounded
+    in size, are queued beyond the queue bound.
+    """
+    recs, nxt = [], offset
+    if _log is not None:
+        recs, nxt = _log.read(tpc, offset, _settings['fetch_bytes'])
+    metrics.log(metrics._info, "Broker> Sub fetched %d msgs of %s from %d" % (len(recs), tpc, offset))
+    btpc = bytes(tpc, msock._str_enc)
+    for off, ts, payload in recs:
+        q.put_wait(msock.msg_parts(btpc, payload, binary, off), len(payload), False)
+    if binary:
+        ack = msock.encode_frame(msock._ack, seq=nxt)
+    else:
+        ack = bytes('%s %d%s' % (msock._ack, nxt, msock._delim), msock._str_enc)
+    q.put_wait((ack,), len(ack), False)
+
+#------
+
+def hello(conn, reader, words, supported=(msock._opt_bin, msock._opt_hdr) + _zip_options, q=None):
+    """
+    Handles the "_hello" command of a client:
+        cid, _hello, options
+    acking with the "supported" options among the requested ones, of
+    the codecs the one compress.accept() picks, "_opt_hdr" along with
+    "_opt_bin" only. A client declaring "_opt_ping=secs" gets the
+    deadline of its pings (see idle.ping_timeout()). The ack goes through
+    the out-queue "q" of a subscriber, if given, written by subwriter().
+    Returns:
+        (cid, options), the id of the client and the options acked
+    """
+    cid  = words[0]
+    opts = compress.accept([o for o in words[2:] if o in supported and
+                            (o != msock._opt_hdr or msock._opt_bin in words[2:]) or
+                            _producers is not None and msock.idem_producer((o,)) or
+                            msock.ping_secs((o,))], _dicts)
+    metrics.log(metrics._info, "Broker> %s negotiated %s" % (cid, opts))
+    ack = ' '.join([msock._ack] + opts)
+    if q is not None:
+        ack = bytes(ack + msock._delim, msock._str_enc)
+        q.put_wait((ack,), len(ack), False)
+    else:
+        msock.write2socket(conn, ack)
+    if msock._opt_bin in opts:
+        reader.binary = True
+        _bin_conns.add(conn)
+        if msock._opt_hdr in opts:
+            _hdr_conns.add(conn)
+    codec = compress.codec(opts, _dicts)
+    if codec is not None:
+        _codecs[conn] = codec
+    if msock.ping_secs(opts):
+        with _idle_lock:
+            _idle.add(conn, time.monotonic(), idle.ping_timeout(opts))
+    return cid, opts
+
+#------
+
+def render_metrics():
+    """
+    Returns:
+        the text of the metrics endpoint (see metrics.Metrics.render())
+    """
+    queues = [(sid, _sub_queues[sconn]) for sid, sconn in _registry.conns() if sconn in _sub_queues]
+    gauges = {'queued_msgs': sum(len(q) for q in list(_sub_queues.values())),
+              'queued_bytes': sum(q.nbytes for q in list(_sub_queues.values()))}
+    rings = ()
+    if _rings is not None:
+        with _ring_lock:
+            gauges.update(rings=len(_rings), rings_memory=_rings.memory, rings_evicted=_rings.evicted)
+            rings = _rings.stats()
+    return _metrics.render(gauges, queues, rings)
 
 #------- 
 # Running the broker
@@ -149,6 +1023,31 @@ def subthread():
 
 if __name__ == "__main__":
     parse_cmd_args()
+    if _mode == 'asyncio' and _settings['workers'] > 1:
+        workers.run(_settings['workers'], _settings['worker_ring_bytes'], async_broker.run,
+                    (_host, _pub_port, _sub_port, _settings))
+        print("Broker> Bye")
+        sys.exit(0)
+    if _mode == 'asyncio':
+        async_broker.run(_host, _pub_port, _sub_port, _settings)
+        print("Broker> Bye")
+        sys.exit(0)
+
+    metrics.verbosity = _settings['verbosity']
+    if _settings['metrics_port']:
+        metrics.serve('localhost', _settings['metrics_port'], render_metrics)
+    if _settings['dict_dir']:
+        _dicts = compress.Dictionaries(_settings['dict_dir'])
+    if _settings['dedup_window']:
+        _producers = dedup.Producers(_settings['dedup_window'])
+    if _settings['dedup_key_secs']:
+        _keys = dedup.KeyCache(_settings['dedup_key_secs'], _settings['dedup_keys'])
+    if _settings['ring_msgs']:
+        _rings = retain.RingStore(_settings['ring_msgs'], _settings['ring_bytes'], _settings['ring_memory'])
+    if _settings['log_dir']:
+        _log = topiclog.LogStore(_settings['log_dir'], _settings)
+    _idle = idle.IdleTimer(_settings['idle_secs'], now=time.monotonic())
+    threading.Thread(target=reaperthread, daemon=True).start()
     try:
         p_pub = threading.Thread(target=pubthread)
         p_pub.start()
@@ -160,4 +1059,4 @@ if __name__ == "__main__":
     p_pub.join()
     s_sub.join()
     
-    print("Broker> Bye")
\ No newline at end of file
+    print("Broker> Bye")
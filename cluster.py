@@ -0,0 +1,370 @@
+import os
+import asyncio
+import collections
+import my_sock as msock
+import registry
+
+#-------
+# Global settings
+#-------
+
+_retry_secs  = 0.5                              # wait before connecting again to a node
+_node_cid    = 'node%d'                         # client id of the links of node i
+_relay_ping  = 30                               # secs between pings of a relay, not to be reaped as idle
+_max_unacked = 256                              # batches a PubLink holds unacked before blocking publishers
+
+#-------
+# Links between nodes
+#-------
+
+class Link(asyncio.BufferedProtocol):
+    """
+    Persistent binary connection of this node to "port" of node "node",
+    opened with "_hello" asking for "options": "_opt_bin" and "_opt_node",
+    so that the other node knows it serves a node rather than a client. It connects
+    again every "_retry_secs" while the node is down or once it is lost,
+    calling ready() whenever connected.
+    """
+    reconnect = True
+    options   = (msock._opt_bin, msock._opt_node)
+
+    def __init__(self, cluster, node, port, cid=None):
+        self.cluster   = cluster
+        self.node      = node
+        self.port      = port
+        self.cid       = cid or _node_cid % cluster.me
+        self.transport = None
+        self.reader    = None
+        self.binary    = False
+        self.closed    = False
+        self.connect()
+
+    def connect(self):
+        if self.closed:
+            return
+        loop = asyncio.get_running_loop()
+        host = self.cluster.nodes[self.node][0]
+        task = loop.create_task(loop.create_connection(lambda: self, host, self.port))
+        task.add_done_callback(self.connected)
+
+    def connected(self, task):
+        if task.cancelled() or task.exception() is not None:
+            if self.reconnect:
+                asyncio.get_running_loop().call_later(_retry_secs, self.connect)
+            else:
+                self.lost()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.reader = msock.FrameReader()
+        self.binary = False
+        transport.write(bytes(' '.join((self.cid, msock._hello) + self.options) + msock._delim,
+                              msock._str_enc))
+
+    def get_buffer(self, sizehint):
+        return self.reader.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes):
+        self.reader.buffer_updated(nbytes)
+        for frame in self.reader.frames():
+            if self.binary:
+                self.handle_frame(frame)
+            elif msock._opt_bin in str(frame, msock._str_enc).split(' '):
+                self.binary = self.reader.binary = True
+                print("Broker> Linked to node %d on port %d" % (self.node, self.port))
+                self.ready()
+            else:
+                print("Broker> Node %d refused the link" % self.node)
+                self.transport.abort()
+                return
+        if self.reader.oversized:
+            self.transport.abort()
+            return
+        self.cluster.flush()
+
+    def connection_lost(self, exc):
+        self.transport = None
+        if self.binary:
+            print("Broker> Lost the link to node %d" % self.node)
+        self.binary = False
+        if self.reconnect and not self.closed:
+            asyncio.get_running_loop().call_later(_retry_secs, self.connect)
+        else:
+            self.lost()
+
+    def write(self, frame):
+        if self.binary:
+            self.transport.write(frame)
+
+    def close(self):
+        self.closed = True
+        if self.transport is not None:
+            self.transport.close()
+
+    def ready(self):
+        pass
+
+    def lost(self):
+        pass
+
+    def handle_frame(self, frame):
+        """
+        Handles a binary frame received from the node; ignored by default.
+        """
+        pass
+
+#------
+
+class PubLink(Link):
+    """
+    Link to the publisher port of node "node", forwarding the messages
+    published here to topics it owns. The messages of every flush go as
+    one "pubbatch" frame, numbered so that the node acks them cumulatively;
+    batches stay in "unacked" until acked, sent again after reconnecting.
+    wait() holds the acks of a publisher until the batch about to be
+    flushed is acked (see async_broker.PubProtocol.flush()), and blocks it
+    while "_max_unacked" batches are, e.g. while the node is down, until
+    half of them are acked.
+    The link is an idempotent publisher, its producer id unique to this
+    run of the node, so the batches the node got before the link was lost
+    are not delivered again.
+    """
+
+    def __init__(self, cluster, node):
+        producer      = '%s.%s' % (_node_cid % cluster.me, os.urandom(4).hex())
+        self.options  = Link.options + (msock._opt_idem + msock._opt_sep + producer,)
+        self.batch    = []                      # (tpc, payload), of the next flush
+        self.seq      = 0                       # of the last batch flushed
+        self.unacked  = collections.deque()     # (seq, frame)
+        self.waiters  = {}                      # seq --> [(pub, entry), ..]
+        self.blocking = set()                   # PubProtocols blocked until acked
+        super().__init__(cluster, node, cluster.nodes[node][1])
+
+    def add(self, tpc, payload):
+        self.batch.append((bytes(tpc), bytes(payload)))
+
+    def wait(self, pub, entry):
+        self.waiters.setdefault(self.seq + 1, []).append((pub, entry))
+        if len(self.unacked) >= _max_unacked and pub.block(self):
+            self.blocking.add(pub)
+
+    def flush(self):
+        if not self.batch:
+            return
+        self.seq += 1
+        frame = msock.encode_frame('pubbatch', b'', msock.encode_batch(self.batch), seq=self.seq)
+        self.batch = []
+        self.unacked.append((self.seq, frame))
+        self.write(frame)
+
+    def ready(self):
+        for seq, frame in self.unacked:
+            self.write(frame)
+
+    def handle_frame(self, frame):
+        cmd, flags, tpc, ext, payload = msock.decode_frame(frame)
+        seq = msock.frame_seq(flags, ext)
+        if cmd != msock._ack or seq is None:
+            return
+        while self.unacked and self.unacked[0][0] <= seq:
+            acked, _ = self.unacked.popleft()
+            for pub, entry in self.waiters.pop(acked, ()):
+                pub.forward_acked(entry)
+        if self.blocking and len(self.unacked) <= _max_unacked // 2:
+            for pub in self.blocking:
+                pub.unblock(self)
+            self.blocking.clear()
+
+#------
+
+class SubLink(Link):
+    """
+    Link to the subscriber port of node "node", subscribed to the topics it
+    owns, and to every pattern, that the clients of this node subscribed
+    to, once each (see async_broker.local_interest()), and to the consumer
+    groups they joined, one "sub" frame per member, with the payload
+    "group name policy sid". The messages received are handed to
+    "cluster.deliver". The subscriptions are made again after reconnecting.
+    """
+
+    def __init__(self, cluster, node):
+        self.subs = {}                          # (tpc, payload key) --> payload
+        super().__init__(cluster, node, cluster.nodes[node][2])
+
+    def send(self, cmd, tpc, payload=''):
+        words = payload.split(' ')
+        key = (tpc, words[1], words[3]) if len(words) == 4 else (tpc,)
+        if cmd == "sub":
+            self.subs[key] = payload
+        else:
+            self.subs.pop(key, None)
+        self.write(msock.encode_frame(cmd, bytes(tpc, msock._str_enc),
+                                      bytes(payload, msock._str_enc)))
+
+    def ready(self):
+        for key, payload in self.subs.items():
+            self.write(msock.encode_frame("sub", bytes(key[0], msock._str_enc),
+                                          bytes(payload, msock._str_enc)))
+
+    def handle_frame(self, frame):
+        if frame[0] == msock._bin_cmds['msg']:
+            self.cluster.deliver(None, bytes(frame))   # out of the receive buffer, reused by the next read
+
+#------
+
+class Relay(Link):
+    """
+    Connection to the subscriber port of node "node" for one subscriber
+    "proto" of this node, for what needs the log of a topic, kept by the
+    node owning it: a "sub" of subscriber "sid" to "tpc", from "frm", or
+    a "fetch" from offset "fetch". Everything received is queued to "proto";
+    the fetch reply closes the relay. Reading stops while "proto" cannot
+    take more (see resume()). The owner serves it as any other subscriber,
+    committing the offsets of "sid", and a relay pings it every
+    "_relay_ping" secs, so that it is not disconnected as idle.
+    """
+    reconnect = False
+    options   = (msock._opt_bin, '%s%s%d' % (msock._opt_ping, msock._opt_sep, _relay_ping))
+
+    def __init__(self, cluster, node, proto, sid, tpc, frm=None, fetch=None):
+        self.proto = proto
+        self.tpc   = tpc
+        self.frm   = frm
+        self.fetch = fetch
+        self.key   = tpc if fetch is None else self     # in "proto.relays"
+        super().__init__(cluster, node, cluster.nodes[node][2], sid)
+
+    def ready(self):
+        tpc = bytes(self.tpc, msock._str_enc)
+        if self.fetch is not None:
+            self.write(msock.encode_frame("fetch", tpc, seq=self.fetch))
+        else:
+            self.write(msock.encode_frame("sub", tpc, bytes(self.frm or '', msock._str_enc)))
+            asyncio.get_running_loop().call_later(_relay_ping, self.ping)
+
+    def ping(self):
+        if self.transport is not None and not self.closed:
+            self.write(msock.encode_frame(msock._ping))
+            asyncio.get_running_loop().call_later(_relay_ping, self.ping)
+
+    def handle_frame(self, frame):
+        cmd, flags, tpc, ext, payload = msock.decode_frame(frame)
+        seq = msock.frame_seq(flags, ext)
+        proto = self.proto
+        if cmd == "msg":                        # copied out of the receive buffer, reused by the next read
+            proto.queue(msock.msg_parts(bytes(tpc), bytes(payload), proto.binary, seq), None, False)
+        elif cmd == msock._ack and seq is not None:
+            if proto.binary:
+                ack = msock.encode_frame(msock._ack, seq=seq)
+            else:
+                ack = bytes('%s %d%s' % (msock._ack, seq, msock._delim), msock._str_enc)
+            proto.queue((ack,), None, False)
+            self.close()
+        if proto.paused and self.transport is not None:
+            self.transport.pause_reading()
+
+    def resume(self):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def lost(self):
+        if self.proto.relays.get(self.key) is self:
+            del self.proto.relays[self.key]
+
+#-------
+# Cluster of nodes
+#-------
+
+class Cluster:
+    """
+    Nodes of a cluster, "nodes" being [(host, pub port, sub port), ..],
+    the same list on every node, and "me" the index of this node.
+    Every topic is owned by one node, picked by a hash of its name; the
+    owner logs it and fans it out, to its own subscribers and to the
+    other nodes subscribed to it, which deliver it to theirs.
+    "deliver(None, frame)" and "flush()" hand the messages received over
+    the links to the broker.
+    """
+
+    def __init__(self, nodes, me, deliver, flush):
+        self.nodes      = nodes
+        self.me         = me
+        self.deliver    = deliver
+        self.flush_subs = flush
+        self.publinks   = {}                    # node --> PubLink
+        self.sublinks   = {}                    # node --> SubLink
+        self.dirty      = set()                 # PubLinks with messages not yet flushed
+
+    def owner(self, tpc):
+        """
+        Returns:
+            the index of the node owning topic "tpc"
+        """
+        return registry._hash(tpc) % len(self.nodes)
+
+    def forward(self, node, tpc, payload):
+        """
+        Adds a message for node "node" to the next flush.
+        Returns:
+            the PubLink to the node
+        """
+        link = self.publinks.get(node)
+        if link is None:
+            link = self.publinks[node] = PubLink(self, node)
+        link.add(tpc, payload)
+        self.dirty.add(link)
+        return link
+
+    def flush(self):
+        """
+        Sends the messages forwarded since the last flush, and writes what
+        the links queued to the subscribers.
+        """
+        for link in self.dirty:
+            link.flush()
+        self.dirty.clear()
+        self.flush_subs()
+
+    def announce(self, cmd, tpc, payload=''):
+        """
+        Sends a change of the subscriptions of this node to the owner of
+        topic "tpc" or, for a pattern, to every other node.
+        """
+        if msock.is_pattern(tpc):
+            nodes = [n for n in range(len(self.nodes)) if n != self.me]
+        else:
+            nodes = [self.owner(tpc)] if self.owner(tpc) != self.me else []
+        for node in nodes:
+            link = self.sublinks.get(node)
+            if link is None:
+                link = self.sublinks[node] = SubLink(self, node)
+            link.send(cmd, tpc, payload)
+
+    def relay(self, proto, sid, tpc, frm=None, fetch=None):
+        """
+        Opens a Relay to the owner of "tpc" for subscriber "proto",
+        kept in "proto.relays".
+        """
+        relay = Relay(self, self.owner(tpc), proto, sid, tpc, frm, fetch)
+        proto.relays[relay.key] = relay
+
+    def close(self):
+        for link in list(self.publinks.values()) + list(self.sublinks.values()):
+            link.close()
+
+#------
+
+def parse_nodes(spec):
+    """
+    Parses a list of nodes "host:pub_port:sub_port,..".
+    Returns:
+        None, if invalid
+        [(host, pub port, sub port), ..], when normal
+    """
+    nodes = []
+    for node in spec.split(','):
+        parts = node.split(':')
+        if len(parts) != 3 or not parts[1].isdigit() or not parts[2].isdigit():
+            return None
+        nodes.append((parts[0], int(parts[1]), int(parts[2])))
+    return nodes
@@ -0,0 +1,304 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import zlib
+import argparse
+import threading
+import my_sock as msock
+
+try:
+    import zstandard
+except ImportError:                             # zlib only
+    zstandard = None
+
+#-------
+# Global settings
+#-------
+
+_zlib_level = 6
+_zlib_wbits = -12                               # raw deflate, 4 KB window: small messages, cheap copies
+_zlib_mem   = 4                                 # memLevel, likewise
+_zlib_dict  = 1 << 12                           # last bytes of a dictionary zlib uses, its window
+_zstd_level = 3
+_min_bytes  = 64                                # payloads sent as they are, too small to gain
+_max_bytes  = 64 << 20                          # largest payload decompressed
+
+_codecs    = {msock._opt_zlib: msock._flag_zlib, msock._opt_zstd: msock._flag_zstd}
+_zip_flags = msock._flag_zlib | msock._flag_zstd
+_dict_id   = msock._dict_fmt                    # crc32 of a dictionary, in the ext of a frame
+_dict_suffix = '.dict'
+_dict_bytes  = 16 << 10                         # size of the dictionaries trained
+
+#-------
+# Dictionaries
+#-------
+
+class Dictionaries:
+    """
+    Dictionaries of the topics, shared out of band by the broker and its
+    clients: the files "<topic>.dict" of "dict_dir", each one identified by
+    the crc32 of its bytes. They are raw content, typical messages of the
+    topic, usable by both zlib and zstd (see train()).
+    """
+
+    def __init__(self, dict_dir=None):
+        self.by_topic = {}                      # tpc --> (id, bytes)
+        self.by_id    = {}                      # id --> bytes
+        if dict_dir is None:
+            return
+        for name in sorted(os.listdir(dict_dir)):
+            if not name.endswith(_dict_suffix):
+                continue
+            with open(os.path.join(dict_dir, name), 'rb') as f:
+                data = f.read()
+            did = zlib.crc32(data)
+            self.by_topic[name[:-len(_dict_suffix)]] = did, data
+            self.by_id[did] = data
+
+    def __len__(self):
+        return len(self.by_id)
+
+#------
+
+def train(samples, size=_dict_bytes):
+    """
+    Builds a raw content dictionary out of sample messages, the most
+    recent last as zlib only uses the end of a dictionary.
+    Returns:
+        bytes, of the dictionary, at most "size"
+    """
+    seen, parts, n = set(), [], 0
+    for s in reversed(samples):
+        if s in seen:
+            continue
+        seen.add(s)
+        parts.append(s)
+        n += len(s)
+        if n >= size:
+            break
+    return b''.join(reversed(parts))[-size:]
+
+#-------
+# Compression
+#-------
+
+class Codec:
+    """
+    Compresses payloads with codec "name", "_opt_zlib" or "_opt_zstd",
+    with the dictionaries of their topics when given "dicts". Payloads
+    under "_min_bytes", or not getting smaller, are left as they are.
+    The compressors are built once per dictionary: zlib ones are primed
+    with it and copied for each payload, zstd ones reused under a lock.
+    """
+
+    def __init__(self, name, dicts=None):
+        self.name  = name
+        self.flag  = _codecs[name]
+        self.dicts = dicts
+        self.primed = {}                        # dictionary id, None for none --> compressor
+        self.lock  = threading.Lock()
+
+    def compressor(self, did, data):
+        c = self.primed.get(did)
+        if c is not None:
+            return c
+        if self.name == msock._opt_zstd:
+            d = zstandard.ZstdCompressionDict(data) if data else None
+            c = zstandard.ZstdCompressor(_zstd_level, dict_data=d)
+        elif data:
+            c = zlib.compressobj(_zlib_level, zlib.DEFLATED, _zlib_wbits, _zlib_mem,
+                                 zdict=data[-_zlib_dict:])
+        else:
+            c = zlib.compressobj(_zlib_level, zlib.DEFLATED, _zlib_wbits, _zlib_mem)
+        self.primed[did] = c
+        return c
+
+    def pack(self, tpc, payload):
+        """
+        Compresses the payload of a message to topic "tpc" (str).
+        Returns:
+            None,                if left as it is
+            (flags, ext, data),  of the compressed frame, when normal
+        """
+        if len(payload) < _min_bytes:
+            return None
+        did, data = None, None
+        if self.dicts:
+            did, data = self.dicts.by_topic.get(tpc, (None, None))
+        with self.lock:
+            c = self.compressor(did, data)
+            if self.name == msock._opt_zstd:
+                packed = c.compress(payload)
+            else:
+                c = c.copy()
+                packed = c.compress(payload) + c.flush()
+        if len(packed) >= len(payload):
+            return None
+        if did is None:
+            return self.flag, b'', packed
+        return self.flag | msock._flag_dict, _dict_id.pack(did), packed
+
+    def msg_parts(self, btpc, tpc, payload):
+        """
+        Builds a compressed "msg" frame for a subscriber (see
+        my_sock.msg_parts()), topic "btpc" being bytes and "tpc" str.
+        Returns:
+            None,                if the payload is left as it is
+            (buffer, ..),        of the frame, when normal
+        """
+        packed = self.pack(tpc, payload)
+        if packed is None:
+            return None
+        flags, ext, data = packed
+        return (msock._bin_hdr.pack(msock._bin_cmds['msg'], flags, len(btpc), len(ext), len(data)),
+                btpc, ext, data)
+
+#------
+
+_shared = {}                                    # (name, dicts) --> Codec, see codec()
+_unpackers = {}                                 # dictionary id, None for none --> zstd decompressor
+_unpack_lock = threading.Lock()
+
+def available():
+    """
+    Returns:
+        the codecs available here, zstd only if the zstandard package is
+    """
+    return (msock._opt_zstd, msock._opt_zlib) if zstandard is not None else (msock._opt_zlib,)
+
+#------
+
+def accept(opts, dicts=None):
+    """
+    Filters the "_hello" options "opts" a broker supports: of the codecs,
+    only the first one available, and only along with "_opt_bin";
+    "_opt_dict" only along with a codec and if there are "dicts".
+    Returns:
+        [option, ..], those accepted, in order
+    """
+    codec = None
+    if msock._opt_bin in opts:
+        codec = next((o for o in opts if o in _codecs and o in available()), None)
+    return [o for o in opts
+            if o == codec or o == msock._opt_dict and codec is not None and bool(dicts) or
+               o not in _codecs and o != msock._opt_dict]
+
+#------
+
+def codec(opts, dicts=None):
+    """
+    Returns:
+        None,  if the accepted options "opts" have no codec
+        Codec, shared by the connections with the same options
+    """
+    name = next((o for o in opts if o in _codecs), None)
+    if name is None:
+        return None
+    dicts = dicts if msock._opt_dict in opts and dicts else None
+    c = _shared.get((name, id(dicts)))
+    if c is None:
+        c = _shared[(name, id(dicts))] = Codec(name, dicts)
+    return c
+
+#------
+
+def repack(flags, ext, btpc, payload, dicts=None):
+    """
+    Turns a compressed "pub" frame, of topic "btpc" (bytes) and compressed
+    "payload", into the "msg" frame subscribers of the same codec and
+    dictionaries may be sent as it is, dropping its sequence number and
+    any message key.
+    Returns:
+        (Codec, (buffer, ..)), the codec and the frame
+    """
+    o = msock._seq_fmt.size if flags & msock._flag_seq else 0
+    ext = ext[o:o + _dict_id.size] if flags & msock._flag_dict else b''
+    flags &= _zip_flags | msock._flag_dict
+    name = msock._opt_zstd if flags & msock._flag_zstd else msock._opt_zlib
+    c = codec((name, msock._opt_dict) if flags & msock._flag_dict else (name,), dicts)
+    return c, (msock._bin_hdr.pack(msock._bin_cmds['msg'], flags, len(btpc), len(ext), len(payload)),
+               btpc, ext, payload)
+
+#------
+
+def unpack(flags, ext, payload, dicts=None):
+    """
+    Decompresses the payload of a frame flagged "_flag_zlib" or
+    "_flag_zstd", with the dictionary whose id follows any sequence
+    number in "ext" when flagged "_flag_dict".
+    Returns:
+        None,  if it cannot be decompressed (unknown codec or dictionary,
+               corrupt or larger than "_max_bytes")
+        bytes, of the payload, when normal
+    """
+    did, data = None, None
+    if flags & msock._flag_dict:
+        o = msock._seq_fmt.size if flags & msock._flag_seq else 0
+        if len(ext) < o + _dict_id.size or dicts is None:
+            return None
+        did = _dict_id.unpack_from(ext, o)[0]
+        data = dicts.by_id.get(did)
+        if data is None:
+            return None
+    try:
+        if flags & msock._flag_zlib:
+            d = zlib.decompressobj(-15, zdict=data[-_zlib_dict:]) if data else zlib.decompressobj(-15)
+            out = d.decompress(payload, _max_bytes)
+            return None if d.unconsumed_tail else out
+        if flags & msock._flag_zstd and zstandard is not None:
+            with _unpack_lock:
+                d = _unpackers.get(did)
+                if d is None:
+                    zd = zstandard.ZstdCompressionDict(data) if data else None
+                    d = _unpackers[did] = zstandard.ZstdDecompressor(dict_data=zd)
+                return d.decompress(payload, max_output_size=_max_bytes)
+    except Exception as err:                    # zlib.error, zstandard.ZstdError
+        print("!! ERROR in decompressing, <%s>" % err)
+    return None
+
+#-------
+# Training dictionaries
+#-------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Trains the dictionary of a topic')
+    parser.add_argument('-d', type=str, metavar='dir', required=True, dest='dict_dir',
+                        help='Directory of the dictionaries, given to the broker and clients')
+    parser.add_argument('-t', type=str, metavar='topic', required=True, dest='topic')
+    parser.add_argument('-f', type=argparse.FileType('rb'), metavar='file', dest='samples',
+                        help='Sample messages, one per line')
+    parser.add_argument('-l', type=str, metavar='dir', dest='log_dir',
+                        help='Topic logs of the broker (-l), sampling the last messages of topic')
+    parser.add_argument('-b', type=int, metavar='bytes', default=_dict_bytes, dest='size',
+                        help='Size of the dictionary (default %(default)s)')
+    d = parser.parse_args()
+    if (d.samples is None) == (d.log_dir is None):
+        parser.error('one of -f and -l is needed')
+
+    if d.samples is not None:
+        samples = [l.rstrip(b'\n') for l in d.samples]
+    else:
+        import topiclog
+        import async_broker
+        store = topiclog.LogStore(d.log_dir, async_broker._settings)
+        log = store.get(d.topic, create=False)
+        samples, offset = [], 0
+        if log is not None:
+            offset = max(log.start(), log.end() - 10 * d.size // _min_bytes)
+        while log is not None and offset < log.end():
+            recs, offset = log.read(offset, 1 << 20)
+            samples += [bytes(payload) for off, ts, payload in recs]
+            if not recs:
+                break
+        store.close()
+    if not samples:
+        print("No samples of %s" % d.topic)
+        sys.exit(-1)
+
+    data = train(samples, d.size)
+    os.makedirs(d.dict_dir, exist_ok=True)
+    path = os.path.join(d.dict_dir, d.topic + _dict_suffix)
+    with open(path, 'wb') as f:
+        f.write(data)
+    print("Wrote %s, %d bytes out of %d samples, id %d" % (path, len(data), len(samples), zlib.crc32(data)))
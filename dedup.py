@@ -0,0 +1,109 @@
+import time
+from collections import OrderedDict
+
+#-------
+# Global settings
+#-------
+
+_window    = 1024                               # sequence numbers of a producer tracked behind its highest
+_producers = 100000                             # producers tracked, the least recently seen forgotten
+_key_secs  = 60                                 # secs a message key is remembered, by default
+_keys      = 1000000                            # message keys remembered at most
+
+#-------
+# Idempotent producers
+#-------
+
+class Producers:
+    """
+    Dedup windows of idempotent producers, the publishers that number
+    their messages with sequence numbers unique for their producer id,
+    across connections and reconnections. For every producer it keeps
+    the highest sequence number seen and a bitmask of which of the
+    "window" numbers behind it were seen, as in the anti-replay window of
+    IPsec, so messages sent again after a lost ack are told apart from
+    messages still to come, even out of order. Numbers older than the
+    window are taken as sent again.
+    At most "max_producers" are tracked, the least recently seen one being
+    forgotten to make room; each one costs a few hundred bytes.
+    """
+
+    def __init__(self, window=_window, max_producers=_producers):
+        self.window = window
+        self.full   = (1 << window) - 1
+        self.max_producers = max_producers
+        self.seen   = OrderedDict()             # producer --> [highest seq, bitmask], recent last
+
+    def __len__(self):
+        return len(self.seen)
+
+    def duplicate(self, producer, seq):
+        """
+        Records sequence number "seq" of "producer".
+        Returns:
+            True,  if it was seen before, or is too old to tell
+            False, when normal
+        """
+        w = self.seen.get(producer)
+        if w is None:
+            if len(self.seen) >= self.max_producers:
+                self.seen.popitem(last=False)
+            w = self.seen[producer] = [0, 0]
+        else:
+            self.seen.move_to_end(producer)
+        high = w[0]
+        if seq > high:
+            shift = seq - high
+            w[1] = ((w[1] << shift) | 1) & self.full if shift < self.window else 1
+            w[0] = seq
+            return False
+        bit = high - seq
+        if bit >= self.window or w[1] >> bit & 1:
+            return True
+        w[1] |= 1 << bit
+        return False
+
+#-------
+# Message keys
+#-------
+
+class KeyCache:
+    """
+    Message keys seen in the last "secs" secs, per topic: a message whose
+    key was seen within that time is a duplicate. As every key lives as
+    long, the keys expire in the order they were first seen, so they are
+    kept in that order and expired from the front, lazily, as messages
+    come; past "max_keys" the oldest go first, whether expired or not.
+    A key is remembered from the first message carrying it, duplicates
+    not extending its life.
+    """
+
+    def __init__(self, secs=_key_secs, max_keys=_keys):
+        self.secs     = secs
+        self.max_keys = max_keys
+        self.expiry   = OrderedDict()           # (tpc, key) --> time.monotonic() it expires, oldest first
+
+    def __len__(self):
+        return len(self.expiry)
+
+    def duplicate(self, tpc, key, now=None):
+        """
+        Records "key" of a message to topic "tpc".
+        Returns:
+            True,  if seen within the last "secs" secs
+            False, when normal
+        """
+        if now is None:
+            now = time.monotonic()
+        expiry = self.expiry
+        while expiry:
+            oldest = next(iter(expiry))
+            if expiry[oldest] > now:
+                break
+            del expiry[oldest]
+        if (tpc, key) in expiry:
+            return True
+        if len(expiry) >= self.max_keys:
+            del expiry[next(iter(expiry))]
+        expiry[(tpc, key)] = now + self.secs
+        return False
@@ -0,0 +1,280 @@
+import json
+import bisect
+
+#-------
+# Global settings
+#-------
+
+_equal      = '='
+_range_ops  = ('>', '>=', '<', '<=')
+_ops        = ('>=', '<=', '=', '>', '<')       # as looked for in a predicate, longest first
+_set_sep    = ','                               # "field=v1,v2", any of the values
+_path_sep   = '.'                               # "field.sub", a field of a nested object
+_quote      = '"'                               # "field="12"", a string rather than a number
+_true       = ('true',)                         # keys of the JSON literals, equal to no string or number
+_false      = ('false',)
+_null       = ('null',)
+_words      = {'true': _true, 'false': _false, 'null': _null}
+_missing    = object()
+_no_ranges  = (((), ()),) * len(_range_ops)     # (bounds, sids) per range op
+
+#-------
+# Filters
+#-------
+
+def value_key(v):
+    """
+    Returns:
+        the key a JSON value is indexed and compared by: a float for
+        numbers, "_true", "_false" and "_null" for those, apart from the
+        strings "true", "false" and "null", the string itself for strings,
+        None for what cannot be compared (objects, arrays)
+    """
+    if v is True or v is False or v is None:
+        return _true if v is True else _false if v is False else _null
+    if isinstance(v, (int, float)):
+        return float(v)
+    if isinstance(v, str):
+        return v
+    return None
+
+#------
+
+def parse_value(word):
+    """
+    Returns:
+        the key of a value of a predicate (see value_key()): a number
+        unless quoted, true, false or null unquoted, or else a string
+    """
+    if len(word) >= 2 and word[0] == _quote and word[-1] == _quote:
+        return word[1:-1]
+    if word in _words:
+        return _words[word]
+    try:
+        return float(word)
+    except ValueError:
+        return word
+
+#------
+
+class Filter:
+    """
+    Conjunction of predicates on the fields of JSON object messages, each
+    one a word (see parse()):
+        field=value          equal to a number, "string" (quoted), true,
+                             false, null, or any other word as a string
+        field=v1,v2,..       equal to any of the values, an "in" set
+        field>n, >=, <, <=   in a range, n a number
+    where "field" may be a path "a.b" into nested objects. Messages which
+    are not JSON objects, or lack a field, match no predicate on it.
+        preds --> ((field, path, op, value), ..), value a frozenset for "="
+    """
+
+    def __init__(self, preds):
+        self.preds = preds
+
+    def __len__(self):
+        return len(self.preds)
+
+    def matches(self, doc):
+        """
+        Evaluates the filter on its own, on message fields "doc" (see
+        fields()), as FilterIndex.match() does for many filters at once.
+        Returns:
+            True, if every predicate holds
+        """
+        if doc is None:
+            return False
+        for field, path, op, value in self.preds:
+            x = value_key(lookup(doc, path))
+            if op == _equal:
+                if x not in value:
+                    return False
+            elif (type(x) is not float or op == '>' and not x > value or op == '>=' and not x >= value or
+                  op == '<' and not x < value or op == '<=' and not x <= value):
+                return False
+        return True
+
+#------
+
+def parse(words):
+    """
+    Parses the predicates of a filter, the words after "msock._where".
+    Returns:
+        None,   if invalid, without predicates or with a range of a non number
+        Filter, when normal
+    """
+    preds = []
+    for word in words:
+        op = next((o for o in _ops if o in word), None)
+        if op is None:
+            return None
+        field, value = word.split(op, 1)
+        if not field or not value or any(not p for p in field.split(_path_sep)):
+            return None
+        path = tuple(field.split(_path_sep))
+        if op == _equal:
+            value = frozenset(parse_value(v) for v in value.split(_set_sep))
+        else:
+            value = parse_value(value)
+            if type(value) is not float:
+                return None
+        preds.append((field, path, op, value))
+    return Filter(tuple(preds)) if preds else None
+
+#------
+
+def fields(payload):
+    """
+    Returns:
+        None, if "payload" is not a JSON object
+        dict, of its fields, when normal
+    """
+    try:
+        doc = json.loads(bytes(payload) if isinstance(payload, memoryview) else payload)
+    except (ValueError, UnicodeDecodeError):
+        return None
+    return doc if isinstance(doc, dict) else None
+
+#------
+
+def lookup(doc, path):
+    """
+    Returns:
+        the value of field "path" of "doc", "_missing" if it has none
+    """
+    v = doc
+    for p in path:
+        if not isinstance(v, dict):
+            return _missing
+        v = v.get(p, _missing)
+        if v is _missing:
+            return _missing
+    return v
+
+#-------
+# Predicate index
+#-------
+
+class FilterIndex:
+    """
+    Filters of the subscriptions to one topic or pattern, grouped by field
+    and value, so that matching a message costs the subscriptions it may
+    match rather than an evaluation of every filter. Each filter is indexed
+    by one of its predicates, its access predicate: the equality with the
+    fewest values and, among those, the fewest subscriptions already under
+    them, or else a range:
+        equal  --> field --> {value key: (sid, ..)}, of "=" predicates and sets
+        ranges --> field --> ((bounds, sids), ..), per op of "_range_ops",
+                   sorted by bound
+        fields --> ((field, path), ..), of every access predicate
+        uses   --> field --> access predicates on it
+        subs   --> sid --> (conn, Filter)
+    For every field indexed, the value of a message looks up the sids whose
+    access predicate it satisfies, and a bisection per range op finds those
+    of the ranges it falls into, as a prefix or suffix of the bounds; the
+    filters of those candidates alone are then evaluated in full.
+    Changes, made under the lock of the registry, replace the tuples and
+    the dict entries rather than change them, so the publish paths match
+    without locking.
+    """
+
+    def __init__(self):
+        self.equal  = {}
+        self.ranges = {}
+        self.fields = ()
+        self.uses   = {}
+        self.subs   = {}
+
+    def __len__(self):
+        return len(self.subs)
+
+    def access(self, flt):
+        """
+        Returns:
+            (field, path, op, value), the access predicate of Filter "flt"
+        """
+        def load(pred):
+            field, path, op, value = pred
+            if op != _equal:
+                return (1, 0, 0)
+            values = self.equal.get(field, {})
+            return (0, len(value), sum(len(values.get(v, ())) for v in value))
+        return min(flt.preds, key=load)
+
+    def add(self, sid, conn, flt):
+        """
+        Adds the Filter "flt" of subscriber "sid" on connection "conn".
+        """
+        field, path, op, value = pred = self.access(flt)
+        self.subs[sid] = (conn, flt, pred)
+        if op == _equal:
+            values = self.equal.setdefault(field, {})
+            for v in value:
+                values[v] = values.get(v, ()) + (sid,)
+        else:
+            ranges = list(self.ranges.get(field, _no_ranges))
+            i = _range_ops.index(op)
+            bounds, sids = ranges[i]
+            j = bisect.bisect(bounds, value)
+            ranges[i] = (bounds[:j] + (value,) + bounds[j:], sids[:j] + (sid,) + sids[j:])
+            self.ranges[field] = tuple(ranges)
+        self.uses[field] = self.uses.get(field, 0) + 1
+        self.fields = tuple((f, tuple(f.split(_path_sep))) for f in self.uses)
+
+    def remove(self, sid):
+        """
+        Removes the filter of subscriber "sid", if any.
+        """
+        entry = self.subs.pop(sid, None)
+        if entry is None:
+            return
+        field, path, op, value = entry[2]
+        if op == _equal:
+            values = self.equal[field]
+            for v in value:
+                sids = tuple(s for s in values[v] if s != sid)
+                if sids:
+                    values[v] = sids
+                else:
+                    del values[v]
+            if not values:
+                del self.equal[field]
+        else:
+            ranges = list(self.ranges[field])
+            i = _range_ops.index(op)
+            kept = [(b, s) for b, s in zip(*ranges[i]) if s != sid]
+            ranges[i] = (tuple(b for b, s in kept), tuple(s for b, s in kept))
+            if ranges == list(_no_ranges):
+                del self.ranges[field]
+            else:
+                self.ranges[field] = tuple(ranges)
+        self.uses[field] -= 1
+        if not self.uses[field]:
+            del self.uses[field]
+        self.fields = tuple((f, tuple(f.split(_path_sep))) for f in self.uses)
+
+    def match(self, doc):
+        """
+        Returns:
+            [(sid, conn), ..], the subscriptions whose filter the message
+            of fields "doc" (see fields()) satisfies
+        """
+        matched = []
+        subs = self.subs
+        for field, path in self.fields:
+            x = value_key(lookup(doc, path))
+            if x is None:
+                continue
+            values = self.equal.get(field)
+            found = values.get(x, ()) if values is not None else ()
+            ranges = self.ranges.get(field) if type(x) is float else None
+            if ranges is not None:
+                (gt, gt_sids), (ge, ge_sids), (lt, lt_sids), (le, le_sids) = ranges
+                found += (gt_sids[:bisect.bisect_left(gt, x)] + ge_sids[:bisect.bisect_right(ge, x)] +
+                          lt_sids[bisect.bisect_right(lt, x):] + le_sids[bisect.bisect_left(le, x):])
+            for sid in found:
+                entry = subs.get(sid)
+                if entry is not None and (len(entry[1]) == 1 or entry[1].matches(doc)):
+                    matched.append((sid, entry[0]))
+        return matched
@@ -0,0 +1,136 @@
+import my_sock as msock
+
+#-------
+# Global settings
+#-------
+
+_idle_secs = 0                                  # secs a connection may stay silent, 0 for ever
+_tick_secs = 1.0                                # granularity of the deadlines, expired() due as often
+
+#-------
+# Deadlines of the connections
+#-------
+
+class IdleTimer:
+    """
+    Deadlines of the connections of a broker, each one due once it has not
+    been heard from for its timeout: "idle_secs", or "_ping_grace" times the
+    interval of a client that declared it pings (see my_sock.ping_secs()).
+    The deadlines sit in a hashed timing wheel of "tick_secs" slots, one
+    dict of the connections due per slot, so that the whole set costs one
+    call of expired() per tick, whatever the connections, rather than a
+    timer each. touch() only records the time a connection was heard from:
+    once its slot is due, a connection heard from meanwhile moves to the
+    slot of its new deadline, and the others are handed out to be evicted.
+    A busy connection thus costs a move per timeout, not per message.
+    A connection the broker stops reading, e.g. a publisher held back by
+    a full subscriber queue, cannot be heard from: suspend() takes it out
+    of the wheel, keeping its timeout, until resume() starts it anew.
+        conns     --> conn --> [timeout, heard, slot]
+        slots     --> slot --> {conn: None}, in the order added
+        suspended --> conn --> timeout
+    Times are those of time.monotonic().
+    Not locked: the threads broker serializes the calls (see broker.py).
+    """
+
+    def __init__(self, idle_secs=_idle_secs, tick_secs=_tick_secs, now=0.0):
+        self.idle_secs = idle_secs
+        self.tick_secs = tick_secs
+        self.conns = {}
+        self.slots = {}
+        self.suspended = {}
+        self.swept = int(now // tick_secs)      # slots up to this one have been handed out
+
+    def __len__(self):
+        return len(self.conns)
+
+    def slot(self, deadline):
+        """
+        Returns:
+            the slot of "deadline", the first one starting after it
+        """
+        return max(int(deadline // self.tick_secs) + 1, self.swept + 1)
+
+    def add(self, conn, now, timeout=None):
+        """
+        Starts, or restarts with a new "timeout" (default "idle_secs"), the
+        deadline of "conn", heard from at "now"; 0 for none.
+        """
+        self.remove(conn)
+        if timeout is None:
+            timeout = self.idle_secs
+        if timeout <= 0:
+            return
+        s = self.slot(now + timeout)
+        self.conns[conn] = [timeout, now, s]
+        self.slots.setdefault(s, {})[conn] = None
+
+    def touch(self, conn, now):
+        """
+        Records that "conn" was heard from at "now".
+        """
+        entry = self.conns.get(conn)
+        if entry is not None:
+            entry[1] = now
+
+    def remove(self, conn):
+        self.suspended.pop(conn, None)
+        entry = self.conns.pop(conn, None)
+        if entry is not None:
+            slot = self.slots.get(entry[2])
+            if slot is not None:
+                slot.pop(conn, None)
+
+    def suspend(self, conn):
+        """
+        Stops the deadline of "conn", not read for now, until resume().
+        """
+        entry = self.conns.get(conn)
+        if entry is not None:
+            self.remove(conn)
+            self.suspended[conn] = entry[0]
+
+    def resume(self, conn, now):
+        """
+        Restarts the deadline of "conn" suspended, read again from "now".
+        """
+        timeout = self.suspended.pop(conn, None)
+        if timeout is not None:
+            self.add(conn, now, timeout)
+
+    def expired(self, now):
+        """
+        Hands out the connections past their deadline at "now", no longer
+        tracked, and moves those heard from since to their new slot.
+        Returns:
+            [conn, ..], to evict
+        """
+        dead = []
+        last = int(now // self.tick_secs)
+        if last - self.swept > len(self.slots):  # long asleep, only the slots in use
+            due = sorted(s for s in self.slots if s <= last)
+        else:
+            due = range(self.swept + 1, last + 1)
+        self.swept = max(self.swept, last)
+        for s in due:
+            for conn in self.slots.pop(s, ()):
+                entry = self.conns[conn]
+                deadline = entry[1] + entry[0]
+                if deadline <= now:
+                    del self.conns[conn]
+                    dead.append(conn)
+                else:
+                    entry[2] = self.slot(deadline)
+                    self.slots.setdefault(entry[2], {})[conn] = None
+        return dead
+
+#------
+
+def ping_timeout(opts):
+    """
+    Returns:
+        None, if the "_hello" options "opts" declare no ping interval
+        secs, the timeout of a client pinging every "_opt_ping=secs"
+    """
+    secs = msock.ping_secs(opts)
+    return secs * msock._ping_grace if secs is not None else None
@@ -0,0 +1,82 @@
+import asyncio
+import selectors
+try:
+    import uvloop
+except ImportError:                             # asyncio loops only
+    uvloop = None
+
+#-------
+# Global settings
+#-------
+
+_loop      = 'asyncio'                          # event loop of the asyncio mode, by default
+_selectors = {'poll': 'PollSelector', 'select': 'SelectSelector'}  # loop --> selectors class name
+_loops     = ('asyncio', 'uvloop') + tuple(_selectors)
+
+#-------
+# Event loops of the asyncio mode
+#-------
+#
+# The asyncio broker, and the asyncio clients, run on any of these loops:
+#   asyncio   the default loop of asyncio, a selector loop over the best
+#             selector of the platform (epoll on Linux, kqueue on BSD and
+#             macOS), so there is no epoll or kqueue loop of its own
+#   uvloop    the libuv loop of the uvloop package, if installed
+#   poll, select
+#             an asyncio.SelectorEventLoop over that selector, unless it is
+#             the best one of the platform already
+# All of them are level triggered: the transports of asyncio read once
+# per readiness event, and rely on being told again while data is left,
+# so an edge triggered loop would need transports of its own draining
+# every socket, which the protocols of async_broker.py do not run on.
+# Both asyncio, from Python 3.12 on, and uvloop keep the buffers written
+# to a transport until sent: async_broker.py never writes views of the
+# buffers it reuses (see outq.detached()), so every loop is safe.
+
+def available():
+    """
+    Returns:
+        (loop, ..), the names of the loops usable here, of "_loops"
+    """
+    return tuple(name for name in _loops if loop_factory(name) is not None)
+
+#------
+
+def loop_factory(name):
+    """
+    Returns:
+        None,     if loop "name" is unknown or unavailable here
+        callable, returning a new event loop of "name", when normal
+    """
+    if name == 'asyncio':
+        return asyncio.new_event_loop
+    if name == 'uvloop':
+        return uvloop.new_event_loop if uvloop is not None else None
+    selector = getattr(selectors, _selectors.get(name, ''), None)
+    if selector is None or selector is selectors.DefaultSelector:   # "asyncio" already
+        return None
+    return lambda: asyncio.SelectorEventLoop(selector())
+
+#------
+
+def run(coro, name=_loop):
+    """
+    Runs coroutine "coro" to completion, as asyncio.run() does, on a new
+    event loop "name", which must be available (see available()).
+    Returns:
+        what "coro" returns
+    """
+    factory = loop_factory(name)
+    if name == 'asyncio':
+        return asyncio.run(coro)
+    if hasattr(asyncio, 'Runner'):              # Python 3.11 on
+        with asyncio.Runner(loop_factory=factory) as runner:
+            return runner.run(coro)
+    loop = factory()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        asyncio.set_event_loop(None)
+        loop.close()
@@ -0,0 +1,200 @@
+import time
+import threading
+import http.server
+
+#-------
+# Global settings
+#-------
+
+_quiet = 0                                      # verbosity levels: errors only
+_info  = 1                                      # connections, subscriptions and other commands
+_debug = 2                                      # every message published
+
+verbosity = _info                               # set by the broker, "-v"
+
+_sub_bits   = 7                                 # Histogram buckets per power of two, as bits
+_quantiles  = (0.5, 0.9, 0.99, 0.999)           # reported of every Histogram
+_max_topics = 10000                             # topics counted apart, the others under "_other"
+_other      = '_other'
+_prefix     = 'broker_'                         # of every metric name
+
+#-------
+# Logging
+#-------
+
+def log(level, msg):
+    """
+    Prints "msg" if the verbosity is at least "level". Per message logs
+    should rather test the verbosity themselves, before formatting "msg".
+    """
+    if verbosity >= level:
+        print(msg)
+
+#-------
+# Metrics
+#-------
+
+class Histogram:
+    """
+    HDR-style histogram of non-negative integers, e.g. usecs: values below
+    2**"_sub_bits" are counted exactly, larger ones in buckets as wide as
+    1/2**("_sub_bits" - 1) of their values, all in one list of counts
+    indexed by shifting the value, so record() neither searches nor
+    allocates but to grow the list up to the largest value recorded.
+    """
+
+    def __init__(self):
+        self.counts = []
+        self.total  = 0
+        self.max    = 0
+
+    def record(self, v, n=1):
+        """
+        Counts "n" occurrences of value "v".
+        """
+        shift = v.bit_length() - _sub_bits
+        i = v if shift <= 0 else (shift << _sub_bits) + (v >> shift)
+        if i >= len(self.counts):
+            self.counts.extend([0] * (i + 1 - len(self.counts)))
+        self.counts[i] += n
+        self.total += n
+        if v > self.max:
+            self.max = v
+
+    def quantile(self, q):
+        """
+        Returns:
+            the value below which a fraction "q" of the values recorded lie,
+            to the precision of its bucket, 0 if none was recorded
+        """
+        target, seen = q * self.total, 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if c and seen >= target:
+                shift = i >> _sub_bits
+                if shift == 0:
+                    return i
+                low = (i & ((1 << _sub_bits) - 1)) << shift
+                return min(low + (1 << shift) // 2, self.max)
+        return 0
+
+#------
+
+class Metrics:
+    """
+    Counters, gauges and histograms of a broker, updated in place on the
+    hot path (counters[name] += 1) and only formatted when scraped (see
+    render()). Messages and bytes are also counted per topic, in the
+    [msgs, bytes] lists of "topics" (see topic()), whose rates render()
+    works out since the previous scrape.
+    Under the threads broker, concurrent updates may now and then be lost;
+    nothing is locked for the sake of the hot path.
+    """
+
+    def __init__(self, counters, gauges=(), histograms=()):
+        self.counters   = dict.fromkeys(counters, 0)
+        self.gauges     = dict.fromkeys(gauges, 0)
+        self.histograms = {name: Histogram() for name in histograms}
+        self.topics     = {}                    # tpc --> [msgs, bytes]
+        self.last       = (time.monotonic(), {})    # previous scrape: time, tpc --> (msgs, bytes)
+
+    def topic(self, tpc):
+        """
+        Returns:
+            the [msgs, bytes] counters of topic "tpc", created on first use,
+            those of "_other" past "_max_topics" topics
+        """
+        counts = self.topics.get(tpc)
+        if counts is None:
+            if len(self.topics) >= _max_topics:
+                tpc = _other
+            counts = self.topics.setdefault(tpc, [0, 0])
+        return counts
+
+    def render(self, gauges=None, queues=(), rings=()):
+        """
+        Formats every metric as "name{label="value"} value" lines, the
+        text format of Prometheus, along with the extra "gauges", the
+        stats of the subscriber queues and those of the topic rings,
+            queues --> [(sid, outq.OutQueue), ..]
+            rings  --> [(tpc, msgs, payload bytes, memory), ..] (see retain.RingStore.stats())
+        Returns:
+            str, of the lines
+        """
+        lines = ['%s%s_total %d' % (_prefix, name, v) for name, v in self.counters.items()]
+        lines += ['%s%s %d' % (_prefix, name, v) for name, v in self.gauges.items()]
+        lines += ['%s%s %d' % (_prefix, name, v) for name, v in (gauges or {}).items()]
+
+        for name, h in self.histograms.items():
+            for q in _quantiles:
+                lines.append('%s%s{quantile="%g"} %d' % (_prefix, name, q, h.quantile(q)))
+            lines.append('%s%s_max %d' % (_prefix, name, h.max))
+            lines.append('%s%s_count %d' % (_prefix, name, h.total))
+
+        now, before = time.monotonic(), self.last[1]
+        secs = max(now - self.last[0], 1e-9)
+        counts = {tpc: tuple(c) for tpc, c in list(self.topics.items())}
+        for tpc, (msgs, nbytes) in sorted(counts.items()):
+            msgs0, nbytes0 = before.get(tpc, (0, 0))
+            label = '{topic="%s"}' % tpc.replace('\\', '\\\\').replace('"', '\\"')
+            lines.append('%stopic_msgs_total%s %d' % (_prefix, label, msgs))
+            lines.append('%stopic_bytes_total%s %d' % (_prefix, label, nbytes))
+            lines.append('%stopic_msgs_per_sec%s %.1f' % (_prefix, label, (msgs - msgs0) / secs))
+            lines.append('%stopic_bytes_per_sec%s %.1f' % (_prefix, label, (nbytes - nbytes0) / secs))
+        self.last = (now, counts)
+
+        for tpc, msgs, nbytes, memory in sorted(rings):
+            label = '{topic="%s"}' % tpc.replace('\\', '\\\\').replace('"', '\\"')
+            lines.append('%sring_msgs%s %d' % (_prefix, label, msgs))
+            lines.append('%sring_bytes%s %d' % (_prefix, label, nbytes))
+            lines.append('%sring_memory%s %d' % (_prefix, label, memory))
+
+        for sid, q in queues:
+            depth, nbytes, dropped, peak = q.stats()
+            label = '{sub="%s"}' % sid
+            lines.append('%squeue_depth%s %d' % (_prefix, label, depth))
+            lines.append('%squeue_bytes%s %d' % (_prefix, label, nbytes))
+            lines.append('%squeue_dropped_total%s %d' % (_prefix, label, dropped))
+            lines.append('%squeue_peak%s %d' % (_prefix, label, peak))
+        return '\n'.join(lines) + '\n'
+
+#-------
+# HTTP endpoint
+#-------
+
+def serve(host, port, render):
+    """
+    Serves "GET /metrics" on host:port from a thread of its own, replying
+    with the text returned by "render()".
+    Returns:
+        None, if the port cannot be bound
+        the http.server.ThreadingHTTPServer, when normal
+    """
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            try:
+                body = bytes(render(), 'utf-8')
+            except Exception as err:
+                self.send_error(500, str(err))
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+            pass
+
+    try:
+        srv = http.server.ThreadingHTTPServer((host, port), Handler)
+    except OSError as err:
+        print("!! ERROR, cannot serve metrics on %s:%d <%s>" % (host, port, err))
+        return None
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    print("Broker> metrics on http://%s:%d/metrics" % (host, port))
+    return srv
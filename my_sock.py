@@ -1,5 +1,8 @@
 
+import time
 import socket
+import struct
+import collections
 
 #------- 
 # Global settings
@@ -8,15 +11,75 @@ import socket
 _delim   = '\n'                                   # ends messages written/read from socket
 _str_enc = 'utf-8'                                # en/decoder string messages
 _ack     = 'OK'                                   # standard acknowledgement
+_backlog = 1024                                   # pending connections queued by listen()
+
+_bdelim  = bytes(_delim, _str_enc)                # "_delim" as found in the received bytes
+_rbuf_size     = 65536                            # initial size of a FrameReader buffer
+_rbuf_min_free = 4096                             # free space ensured before each read
+
+_hello   = 'hello'                                # first command of a client, negotiating options
+_opt_bin = 'bin'                                  # option switching both sides to binary frames
+_opt_node = 'node'                                # option of the links between the nodes of a cluster
+_opt_credit = 'credit'                            # option of publishers sending only what the broker grants
+_credit  = 'CREDIT'                               # "CREDIT n", grant up to the n-th message of a publisher
+_opt_zlib = 'zlib'                                # options compressing payloads (see compress.py),
+_opt_zstd = 'zstd'                                # the first one asked for, along with "_opt_bin"
+_opt_dict = 'dict'                                # option compressing with the dictionaries of the topics
+_opt_idem = 'idem'                                # "idem=producer", option of idempotent publishers
+_opt_sep  = '='                                   # separates an option from its value
+_last     = 'last'                                # "sub tpc last K", the last K messages kept first
+_where    = 'where'                               # "sub tpc where pred ..", the messages matching only
+_opt_hdr  = 'hdr'                                 # option of subscribers sent the headers of the messages
+_opt_ping = 'ping'                                # "ping=secs", option of clients pinging at least every secs
+_ping     = 'ping'                                # "id ping" or a "ping" frame, answered with "_pong"
+_pong     = 'PONG'
+_ping_grace = 1.5                                 # pings a client may miss before it counts as dead
+_keepalive_probes = 4                             # TCP keepalive probes before a silent peer counts as dead
+
+_bin_hdr   = struct.Struct('!BBHHI')              # cmd, flags, topic len, ext len, payload len
+_max_frame = 64 << 20                             # bytes of a frame or text line at most, the connection closed past it
+_bin_cmds  = {'pub': 1, 'sub': 2, 'unsub': 3, 'msg': 4, _ack: 5, 'pubbatch': 6, 'fetch': 7,
+              'credit': 8, _ping: 9, _pong: 10}
+_bin_names = {code: cmd for cmd, code in _bin_cmds.items()}
+
+_flag_seq  = 0x01                                 # ext starts with an 8 byte sequence number
+_flag_zlib = 0x04                                 # payload compressed with zlib (raw deflate)
+_flag_zstd = 0x08                                 # payload compressed with zstd
+_flag_dict = 0x10                                 # with a dictionary, its id in ext after any sequence number
+_flag_key  = 0x20                                 # message key in ext, after any sequence number and dictionary
+_flag_hdr  = 0x40                                 # headers in ext, after any sequence number, dictionary and key
+_seq_fmt   = struct.Struct('!Q')
+_dict_fmt  = struct.Struct('!I')                  # id of the dictionary of "_flag_dict"
+_key_len   = struct.Struct('!H')                  # length of the key of "_flag_key", before it
+_hdr_fmt   = struct.Struct('!BQQQH')              # headers: priority, publish, ingress and egress usecs,
+                                                  # producer length, the producer id following
+_hdr_egress = 17                                  # offset of the egress usecs in "_hdr_fmt"
+_ts_fmt    = struct.Struct('!Q')                  # usecs since the epoch, 0 for unknown
+_priorities = 4                                   # message priorities, 0 (bulk, the default) .. 3
+_seq_sep   = ':'                                  # text publishers send "pid:seq" as first word
+
+_tpc_sep   = '.'                                  # separates the levels of hierarchical topics
+_wild_one  = '*'                                  # pattern level matching any one level
+_wild_many = '#'                                  # last pattern level, matching any levels left
+
+# Headers of a message: priority, publish, ingress and egress times, in
+# usecs since the epoch (see now_us()), 0 where unknown, producer id and
+# message key, bytes, None for none
+Headers = collections.namedtuple('Headers', 'priority published ingress egress producer key')
+
+_batch_rec = struct.Struct('!HI')                 # topic len, payload len of each "pubbatch" message
+_iov_max   = 1024                                 # buffers per sendmsg()
 
 #------- 
 # Socket API
 #-------
 
-def create_socket_server(host, port):
+def create_socket_server(host, port, reuse_port=False):
     """
     Creates a socket at a server side (listener)
-    bound to a specific host and port.
+    bound to a specific host and port; with "reuse_port" several
+    processes may listen on the same port, the kernel spreading the
+    connections among them (SO_REUSEPORT).
     Returns:
         None,   on error
         socket, when normal
@@ -24,8 +87,10 @@ def create_socket_server(host, port):
     try:
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         sock.bind((host, port))
-        sock.listen(10)
+        sock.listen(_backlog)
     except Exception as err:
         print("!! ERROR in creating a socket, <%s>" % err)
         return None
@@ -52,6 +117,32 @@ def connect2socket(host, port):
 
 #-------
 
+def set_keepalive (sock, idle_secs, probes=_keepalive_probes):
+    """
+    Turns on TCP keepalive for a connection, probing a peer silent for
+    "idle_secs" every "idle_secs" / "probes", so that a peer gone without
+    closing is found dead within about twice "idle_secs", once nothing is
+    in flight to it. Options the platform lacks are left as they are.
+    Returns:
+        -1 on error
+        0  when normal
+    """
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(idle_secs)))
+        if hasattr(socket, 'TCP_KEEPINTVL'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, int(idle_secs / probes)))
+        if hasattr(socket, 'TCP_KEEPCNT'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, probes)
+    except OSError as err:
+        print("!! ERROR in setting keepalive, <%s>" % err)
+        return -1
+
+    return 0
+
+#-------
+
 def write2socket (sock, msg):
     """
     Writes a message to the socket adding "_delim" at the end.
@@ -70,11 +161,198 @@ def write2socket (sock, msg):
 
 #-------
 
-def send_ack (sock):
+def write_bytes (sock, data):
+    """
+    Writes already encoded bytes (a message or a frame) to the socket.
+    Returns:
+        -1        on error
+        len(data) when normal
+    """
+    try:
+       sock.sendall(data)
+    except Exception as err:
+       print("!! ERROR in writing to socket, <%s>" % err)
+       return -1
+
+    return len(data)
+
+#-------
+
+def write_vec (sock, bufs):
+    """
+    Writes a list of buffers with as few vectored writes (sendmsg) as
+    possible, i.e. one unless the socket cannot take them all at once.
+    Returns:
+        -1         on error
+        the number of bytes written, when normal
+    """
+    bufs  = [memoryview(b).cast('B') for b in bufs]
+    total = 0
+    try:
+        while bufs:
+            n = sock.sendmsg(bufs[:_iov_max])
+            total += n
+            while bufs and n >= len(bufs[0]):
+                n -= len(bufs[0])
+                bufs.pop(0)
+            if n:
+                bufs[0] = bufs[0][n:]
+    except Exception as err:
+        print("!! ERROR in writing to socket, <%s>" % err)
+        return -1
+
+    return total
+
+#-------
+
+def send_ack (sock, binary=False, seq=None):
     """
-    Sends an acknowledgement over a socket.
+    Sends an acknowledgement over a socket, as a frame if "binary".
+    With "seq" the ack is cumulative, acknowledging every message
+    up to and including sequence number "seq".
     """
-    return write2socket(sock, _ack)
+    if binary:
+        return write_bytes(sock, encode_frame(_ack, seq=seq))
+    if seq is None:
+        return write2socket(sock, _ack)
+    return write2socket(sock, '%s %d' % (_ack, seq))
+
+#-------
+
+def parse_ack (smsg):
+    """
+    Parses a text acknowledgement, "_ack" or "_ack seq".
+    Sequence numbers start from 1.
+    Returns:
+        None, if it is not an acknowledgement
+        0,    for a plain "_ack"
+        seq,  for a cumulative one
+    """
+    words = smsg.split(' ')
+    if words[0] != _ack or len(words) > 2:
+        return None
+    if len(words) == 1:
+        return 0
+    if not words[1].isdigit():
+        return None
+    return int(words[1])
+
+#-------
+
+def encode_credit (binary, limit):
+    """
+    Encodes a credit grant, letting a publisher send messages up to its
+    "limit"-th since connecting, counting every message of a "pubbatch".
+    Returns:
+        bytes, the text line "_credit limit", or a "credit" frame carrying
+        "limit" as sequence number if "binary"
+    """
+    if binary:
+        return encode_frame('credit', seq=limit)
+    return bytes('%s %d%s' % (_credit, limit, _delim), _str_enc)
+
+#------
+
+def parse_credit (smsg):
+    """
+    Parses a text credit grant, "_credit limit".
+    Returns:
+        None,  if it is not a credit grant
+        limit, when normal
+    """
+    words = smsg.split(' ')
+    if len(words) != 2 or words[0] != _credit or not words[1].isdigit():
+        return None
+    return int(words[1])
+
+#-------
+
+def is_pattern (tpc):
+    """
+    Returns:
+        True, if topic "tpc" has wildcard levels ("_wild_one", "_wild_many")
+    """
+    return any(l == _wild_one or l == _wild_many for l in tpc.split(_tpc_sep))
+
+#-------
+
+def matches (pattern, tpc):
+    """
+    Returns:
+        True, if topic "tpc" is topic or pattern "pattern", or matches it:
+        "_wild_one" matching any one level, "_wild_many" any levels left,
+        even none, as the broker does
+    """
+    levels = tpc.split(_tpc_sep)
+    plevels = pattern.split(_tpc_sep)
+    for i, p in enumerate(plevels):
+        if p == _wild_many:
+            return True
+        if i >= len(levels) or p != _wild_one and p != levels[i]:
+            return False
+    return len(plevels) == len(levels)
+
+#-------
+
+def valid_topic (tpc, pattern=False):
+    """
+    Checks a topic to publish to or, with "pattern", to subscribe to:
+    levels are separated by "_tpc_sep" and, in patterns only, may be
+    "_wild_one" or, as the last level, "_wild_many", e.g. "orders.*.eu"
+    or "orders.#"; pattern levels may not be empty.
+    Returns:
+        True, if valid
+    """
+    levels = tpc.split(_tpc_sep)
+    if not tpc:
+        return False
+    if not pattern:
+        return _wild_one not in levels and _wild_many not in levels
+    return '' not in levels and _wild_many not in levels[:-1]
+
+#-------
+
+def sub_options (words):
+    """
+    Parses the words following "sid sub|unsub tpc" (or the payload of a
+    binary "sub"/"unsub" split in words, where a single word stands for
+    'from word'), which may be:
+        nothing
+        'from offset|earliest|latest'
+        'group name [policy]'       of a consumer group
+        'last K'                    the last K messages kept of the topic,
+                                    given as frm '-K' (see last_count())
+        'where pred ..'             a filter of the messages (see filters.py)
+    Returns:
+        None, if invalid
+        (frm, group, policy, where), each None if not given, "where"
+        being the words of the predicates
+    """
+    if not words or words == ['']:
+        return None, None, None, None
+    if len(words) == 1:
+        return words[0], None, None, None
+    if len(words) == 2 and words[0] == 'from':
+        return words[1], None, None, None
+    if len(words) == 2 and words[0] == _last and words[1].isdigit():
+        return '-' + words[1], None, None, None
+    if len(words) in (2, 3) and words[0] == 'group' and words[1]:
+        return None, words[1], words[2] if len(words) == 3 else None, None
+    if len(words) >= 2 and words[0] == _where:
+        return None, None, None, words[1:]
+    return None
+
+#------
+
+def last_count (frm):
+    """
+    Returns:
+        None, if "frm" (see sub_options()) does not ask for the last messages
+        K,    of 'last K' (or 'from -K'), when normal
+    """
+    if frm is not None and frm[:1] == '-' and frm[1:].isdigit():
+        return int(frm[1:])
+    return None
 
 #-------
 
@@ -82,6 +360,9 @@ def read_from_socket (sock):
     """
     Reads a message from a socket.
     Messages end with "_delim" (see write2socket()).
+    Note:
+    A single recv() is assumed to return exactly one message, which does not
+    hold once messages are coalesced or split by TCP; use FrameReader instead.
     Returns:
         None, on error 
         msg,  a complete message without spaces and delimiters, when normal
@@ -100,6 +381,479 @@ def read_from_socket (sock):
 
 #------
 
+def encode_frame (cmd, tpc=b'', payload=b'', ext=b'', flags=0, seq=None):
+    """
+    Encodes a binary frame:
+        header  --> "_bin_hdr"
+        topic   --> tpc bytes
+        ext     --> extension bytes, their layout given by flags
+        payload --> raw bytes
+    Topic and payload may be given as str, encoded with "_str_enc".
+    A sequence number "seq" is stored first in ext, setting "_flag_seq".
+    Returns:
+        bytes of the frame
+    """
+    if seq is not None:
+        flags |= _flag_seq
+        ext = _seq_fmt.pack(seq) + ext
+    if isinstance(tpc, str):
+        tpc = bytes(tpc, _str_enc)
+    if isinstance(payload, str):
+        payload = bytes(payload, _str_enc)
+    hdr = _bin_hdr.pack(_bin_cmds[cmd], flags, len(tpc), len(ext), len(payload))
+    return b''.join((hdr, tpc, ext, payload))
+
+#------
+
+def decode_frame (frame):
+    """
+    Decodes a binary frame (see encode_frame()), without copying it.
+    Returns:
+        (cmd, flags, tpc, ext, payload), the last three as memoryviews
+    """
+    code, flags, tlen, elen, plen = _bin_hdr.unpack_from(frame)
+    o = _bin_hdr.size
+    return (_bin_names.get(code), flags,
+            frame[o:o + tlen], frame[o + tlen:o + tlen + elen], frame[o + tlen + elen:])
+
+#------
+
+def encode_batch (msgs):
+    """
+    Encodes the payload of a "pubbatch" frame, carrying the messages "msgs":
+        [(tpc, payload), ..]
+    each one as a "_batch_rec" header followed by the topic and payload.
+    Returns:
+        bytes of the batch
+    """
+    parts = []
+    for tpc, payload in msgs:
+        if isinstance(tpc, str):
+            tpc = bytes(tpc, _str_enc)
+        if isinstance(payload, str):
+            payload = bytes(payload, _str_enc)
+        parts += (_batch_rec.pack(len(tpc), len(payload)), tpc, payload)
+    return b''.join(parts)
+
+#------
+
+def iter_batch (batch):
+    """
+    Yields the messages of a "pubbatch" payload (see encode_batch()),
+    without copying them:
+        (tpc, payload), as memoryviews
+    """
+    o, n = 0, len(batch)
+    while o < n:
+        tlen, plen = _batch_rec.unpack_from(batch, o)
+        o += _batch_rec.size
+        yield batch[o:o + tlen], batch[o + tlen:o + tlen + plen]
+        o += tlen + plen
+
+#------
+
+def frame_seq (flags, ext):
+    """
+    Returns:
+        the sequence number in the ext of a frame, None if it has none
+    """
+    if flags & _flag_seq:
+        return _seq_fmt.unpack_from(ext)[0]
+    return None
+
+#------
+
+def frame_key (flags, ext):
+    """
+    Returns:
+        the message key in the ext of a frame, as bytes, None if it has none
+    """
+    if not flags & _flag_key:
+        return None
+    o = (_seq_fmt.size if flags & _flag_seq else 0) + (_dict_fmt.size if flags & _flag_dict else 0)
+    n = _key_len.unpack_from(ext, o)[0]
+    o += _key_len.size
+    return bytes(ext[o:o + n])
+
+#------
+
+def key_ext (key):
+    """
+    Encodes a message key, str or bytes, as the last part of the ext of a
+    frame flagged "_flag_key".
+    Returns:
+        bytes of the ext part
+    """
+    if isinstance(key, str):
+        key = bytes(key, _str_enc)
+    return _key_len.pack(len(key)) + key
+
+#------
+
+def now_us ():
+    """
+    Returns:
+        the time, in usecs since the epoch, of the headers of the messages
+    """
+    return time.time_ns() // 1000
+
+#------
+
+def hdr_ext (priority=0, published=None, producer=b''):
+    """
+    Encodes the headers of a message being published, "priority" from 0
+    to "_priorities" - 1, published at "published" usecs (now if None) by
+    "producer" (str or bytes), as the last part of the ext of a frame
+    flagged "_flag_hdr". The broker fills in the ingress and egress times.
+    Returns:
+        bytes of the ext part
+    """
+    if isinstance(producer, str):
+        producer = bytes(producer, _str_enc)
+    if published is None:
+        published = now_us()
+    return _hdr_fmt.pack(priority, published, 0, 0, len(producer)) + producer
+
+#------
+
+def frame_headers (flags, ext):
+    """
+    Returns:
+        None,    if the ext of a frame has no headers
+        Headers, along with the message key of the frame, when normal
+    """
+    if not flags & _flag_hdr:
+        return None
+    o = (_seq_fmt.size if flags & _flag_seq else 0) + (_dict_fmt.size if flags & _flag_dict else 0)
+    key = None
+    if flags & _flag_key:
+        n = _key_len.unpack_from(ext, o)[0]
+        key = bytes(ext[o + _key_len.size:o + _key_len.size + n])
+        o += _key_len.size + n
+    priority, published, ingress, egress, n = _hdr_fmt.unpack_from(ext, o)
+    o += _hdr_fmt.size
+    return Headers(priority, published, ingress, egress, bytes(ext[o:o + n]), key)
+
+#------
+
+def received_headers (hdrs, ingress, producer):
+    """
+    Completes the Headers "hdrs" of a message read by the broker at
+    "ingress" usecs, None for a message published without headers, its
+    producer defaulting to "producer" (str), e.g. the id of the publisher.
+    Returns:
+        Headers, to deliver along with the message (see hdr_parts())
+    """
+    if hdrs is None:
+        return Headers(0, 0, ingress, 0, bytes(producer or '', _str_enc), None)
+    return hdrs._replace(ingress=ingress, producer=hdrs.producer or bytes(producer or '', _str_enc))
+
+#------
+
+def group_key (key, hdrs, producer):
+    """
+    Returns:
+        the key "key-hash" consumer groups hash a message by: its message
+        "key" if any, or else its producer id, that of its Headers "hdrs"
+        or, without one, "producer" (str), e.g. the id of the publisher
+    """
+    if key is not None:
+        return key
+    if hdrs is not None and hdrs.producer:
+        return hdrs.producer
+    return producer
+
+#------
+
+def hdr_parts (tpc, payload, hdrs, flags=0, ext=b''):
+    """
+    Builds a "msg" frame carrying the Headers "hdrs", and their key, for a
+    subscriber negotiating "_opt_hdr", of a payload already flagged with
+    "flags" and "ext" if compressed (see compress.Codec.msg_parts()).
+    The header, topic and ext are copied into a bytearray of their own,
+    whose egress time is set once the frame is written (see outq.OutQueue).
+    Returns:
+        ((bytearray, payload), offset), the buffers of the frame and the
+        offset of its egress time in the first one
+    """
+    parts = [ext]
+    flags |= _flag_hdr
+    if hdrs.key is not None:
+        flags |= _flag_key
+        parts.append(key_ext(hdrs.key))
+    parts.append(_hdr_fmt.pack(hdrs.priority, hdrs.published, hdrs.ingress, hdrs.egress,
+                               len(hdrs.producer)))
+    parts.append(hdrs.producer)
+    ext = b''.join(parts)
+    head = bytearray(_bin_hdr.pack(_bin_cmds['msg'], flags, len(tpc), len(ext), len(payload)))
+    head += tpc
+    head += ext
+    return (head, payload), len(head) - len(hdrs.producer) - _hdr_fmt.size + _hdr_egress
+
+#------
+
+def idem_producer (opts):
+    """
+    Returns:
+        None,     if the "_hello" options "opts" ask for no idempotence
+        producer, the producer id of option "_opt_idem=producer"
+    """
+    for o in opts:
+        name, sep, producer = o.partition(_opt_sep)
+        if name == _opt_idem and sep and producer:
+            return producer
+    return None
+
+#------
+
+def ping_secs (opts):
+    """
+    Returns:
+        None, if the "_hello" options "opts" declare no ping interval
+        secs, of option "_opt_ping=secs", when normal
+    """
+    for o in opts:
+        name, sep, secs = o.partition(_opt_sep)
+        if name == _opt_ping and sep and secs.isdigit() and int(secs) > 0:
+            return int(secs)
+    return None
+
+#------
+
+def encode_pong (binary):
+    """
+    Returns:
+        bytes of the "_pong" answering a "_ping", a frame if "binary"
+    """
+    return encode_frame(_pong) if binary else bytes(_pong + _delim, _str_enc)
+
+#------
+
+def retag_frame (frame, cmd):
+    """
+    Rewrites in place a received frame as one of command "cmd", with no
+    flags and no extension, e.g. a "pub" as a "msg", so that it can be
+    forwarded without copying its payload. Only the header and the topic
+    are moved, over the dropped extension.
+    Returns:
+        memoryview, of the rewritten frame within "frame"
+    """
+    _, _, tlen, elen, plen = _bin_hdr.unpack_from(frame)
+    if elen:
+        o = _bin_hdr.size
+        frame[o + elen:o + elen + tlen] = frame[o:o + tlen].tobytes()
+        frame = frame[elen:]
+    _bin_hdr.pack_into(frame, 0, _bin_cmds[cmd], 0, tlen, 0, plen)
+    return frame
+
+#------
+
+def msg_parts (tpc, payload, binary, seq=None):
+    """
+    Builds a message for a subscriber, without copying topic and payload:
+    the text line "tpc msg" or, if "binary", a "msg" frame carrying "seq"
+    (e.g. the log offset of the message) when given.
+    Returns:
+        (buffer, ..), to be written in order
+    """
+    if not binary:
+        return tpc, b' ', payload, _bdelim
+    if seq is None:
+        return _bin_hdr.pack(_bin_cmds['msg'], 0, len(tpc), 0, len(payload)), tpc, payload
+    return (_bin_hdr.pack(_bin_cmds['msg'], _flag_seq, len(tpc), _seq_fmt.size, len(payload)),
+            tpc, _seq_fmt.pack(seq), payload)
+
+#------
+
+def write_frame (sock, cmd, tpc=b'', payload=b'', seq=None):
+    """
+    Writes a binary frame to the socket (see encode_frame()).
+    Returns:
+        -1          on error
+        len(frame)  when normal
+    """
+    return write_bytes(sock, encode_frame(cmd, tpc, payload, seq=seq))
+
+#------
+
+def negotiate (sock, reader, cid, opts):
+    """
+    Sends the "_hello" command of client "cid" asking for options "opts",
+    e.g. ("bin",). The broker acks with the options it accepted, which
+    apply from then on; a broker that does not know an option omits it.
+    Returns:
+        None, on error
+        set,  of the accepted options, when normal
+    """
+    if write2socket(sock, ' '.join((cid, _hello) + tuple(opts))) == -1:
+        return None
+
+    smsg = reader.read_msg()
+    if smsg is None:
+        return None
+    words = smsg.split(' ')
+    if words[0] != _ack:
+        print("!! ERROR, invalid reply to %s <%s>" % (_hello, smsg))
+        return None
+
+    accepted = set(words[1:])
+    if _opt_bin in accepted:
+        reader.binary = True
+    return accepted
+
+#------
+
+class FrameReader:
+    """
+    Buffered reader of "_delim" terminated frames, one per connection,
+    or of binary frames (see encode_frame()) once "binary" is set.
+    The bytes are received straight into a persistent buffer which is only
+    compacted or grown when it runs out of free space, so every read may
+    complete any number of frames and a frame may span any number of reads.
+    Frames are handed out as memoryviews over the buffer and are valid until
+    the buffer is filled again.
+    The buffer is filled either from the passed socket (fill()) or by an
+    asyncio.BufferedProtocol (get_buffer() / buffer_updated()).
+    A frame, or a text line, over "_max_frame" bytes sets "oversized"
+    instead of growing the buffer to it: the connection is to be closed.
+    """
+
+    def __init__(self, sock=None, size=_rbuf_size):
+        self.sock  = sock
+        self.buf   = bytearray(size)
+        self.view  = memoryview(self.buf)
+        self.start = 0                          # first byte of the next frame
+        self.scan  = 0                          # where the search of "_delim" resumes
+        self.end   = 0                          # end of the bytes received so far
+        self.need  = 0                          # bytes missing from a partial binary frame
+        self.binary = False
+        self.oversized = False                  # a frame over "_max_frame" was announced or read
+
+    def get_buffer(self, sizehint=-1):
+        """
+        Returns the free part of the buffer, where the next bytes are received.
+        """
+        if self.start == self.end:
+            self.start = self.scan = self.end = 0
+        need = max(sizehint, _rbuf_min_free, self.need)
+        if len(self.buf) - self.end < need:
+            n = self.end - self.start
+            if self.start > 0 and len(self.buf) - n >= need:
+                self.buf[:n] = self.buf[self.start:self.end]
+            else:
+                buf = bytearray(max(2 * len(self.buf), n + need))
+                buf[:n] = self.view[self.start:self.end]
+                self.buf, self.view = buf, memoryview(buf)
+            self.scan -= self.start
+            self.start, self.end = 0, n
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        """
+        Accounts for "nbytes" received in the buffer returned by get_buffer().
+        """
+        self.end += nbytes
+
+    def next_frame(self):
+        """
+        Returns:
+            None,       if no complete frame is buffered, or if "oversized"
+            memoryview, of the next frame without "_delim", when normal
+        """
+        if self.oversized:
+            return None
+        if self.binary:
+            n = self.end - self.start
+            size = _bin_hdr.size
+            if n >= size:
+                _, _, tlen, elen, plen = _bin_hdr.unpack_from(self.buf, self.start)
+                size += tlen + elen + plen
+                if size > _max_frame:
+                    print("!! ERROR, frame of %d bytes over %d" % (size, _max_frame))
+                    self.oversized = True
+                    return None
+            if n < size:
+                self.need = size - n
+                return None
+            frame = self.view[self.start:self.start + size]
+            self.start = self.scan = self.start + size
+            self.need = 0
+            return frame
+
+        i = self.buf.find(_bdelim, self.scan, self.end)
+        if i < 0:
+            self.scan = self.end
+            if self.end - self.start > _max_frame:
+                print("!! ERROR, line over %d bytes" % _max_frame)
+                self.oversized = True
+            return None
+        frame = self.view[self.start:i]
+        self.start = self.scan = i + 1
+        return frame
+
+    def frames(self):
+        """
+        Yields every complete frame buffered.
+        """
+        frame = self.next_frame()
+        while frame is not None:
+            yield frame
+            frame = self.next_frame()
+
+    def fill(self):
+        """
+        Receives from the socket whatever is available, blocking if nothing is.
+        Returns:
+            -1 on error, "oversized" included
+            0  when the connection is closed
+            the number of bytes received, when normal
+        """
+        if self.oversized:
+            return -1
+        try:
+            n = self.sock.recv_into(self.get_buffer())
+        except Exception as err:
+            print("!! ERROR in reading from socket, <%s>" % err)
+            return -1
+
+        if n == 0:
+            print("!! ERROR, socket connection broken")
+            return 0
+
+        self.buffer_updated(n)
+        return n
+
+    def read_frame(self):
+        """
+        Reads the next frame from the socket, keeping any further bytes
+        received for the following calls.
+        Returns:
+            None,       on error
+            memoryview, of the frame (see next_frame()), when normal
+        """
+        frame = self.next_frame()
+        while frame is None:
+            if self.fill() <= 0:
+                return None
+            frame = self.next_frame()
+
+        return frame
+
+    def read_msg(self):
+        """
+        Reads the next text message from the socket, as read_from_socket() does.
+        Returns:
+            None, on error
+            msg,  a complete message without spaces and delimiters, when normal
+        """
+        frame = self.read_frame()
+        if frame is None:
+            return None
+
+        return str(frame, _str_enc).strip()
+
+#------
+
 def term_socket (sock):
     """
     Terminates a socket, in terms of disallowed future reads and writes, 
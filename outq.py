@@ -0,0 +1,248 @@
+import threading
+from collections import deque
+import my_sock as msock
+
+#-------
+# Global settings
+#-------
+
+_policies = ('block', 'drop-oldest', 'drop-newest', 'disconnect')
+
+_queued  = 0                                    # put() results
+_full    = 1                                    # queued over the bound, block the publisher
+_dropped = 2                                    # queued, dropping older or this message
+_overflow = 3                                   # not queued, disconnect the subscriber
+
+#-------
+# Outbound queues of subscribers
+#-------
+
+class OutQueue:
+    """
+    Bounded queue of the messages waiting to be written to one subscriber,
+    each one a tuple of buffers, bounded both in messages and in bytes.
+    Messages wait in one lane per priority (see my_sock._priorities) and
+    take() hands out the higher lanes first, so urgent messages overtake
+    the bulk ones queued before them; order is kept within a lane.
+    When full, "policy" decides what put() does:
+        block        queues the message and asks to block the publisher
+        drop-oldest  drops the oldest messages to make room
+        drop-newest  drops the message, or the newest of a lower lane
+        disconnect   asks to disconnect the subscriber
+    where dropping takes the messages of the lower lanes first, and never
+    those of a higher lane than the message put.
+    A message may carry a "stamp", the offset in its first buffer, a
+    bytearray, where take() writes the time it is written out, in usecs
+    (see my_sock.hdr_parts()).
+    """
+
+    def __init__(self, max_msgs, max_bytes, policy):
+        self.max_msgs  = max_msgs
+        self.max_bytes = max_bytes
+        self.policy    = policy
+        self.lanes     = tuple(deque() for _ in range(msock._priorities))  # (parts, size, stamp)
+        self.count     = 0                      # messages queued, in every lane
+        self.nbytes    = 0
+        self.dropped   = 0                      # messages dropped so far
+        self.peak      = 0                      # highest depth so far
+        self.stamped   = 0                      # messages queued with a stamp
+        self.attached  = [0] * len(self.lanes)   # newest messages per lane that detach() has not copied
+
+    def __len__(self):
+        return self.count
+
+    def full(self):
+        return self.count >= self.max_msgs or self.nbytes >= self.max_bytes
+
+    def low(self):
+        """
+        Returns:
+            True, when drained enough to unblock the publishers (half way)
+        """
+        return self.count <= self.max_msgs // 2 and self.nbytes <= self.max_bytes // 2
+
+    def drop(self, priority, newest=False):
+        """
+        Drops a message of the lowest lane up to "priority", its oldest
+        one or its "newest".
+        Returns:
+            False, if those lanes are empty
+        """
+        i = next((i for i in range(priority + 1) if self.lanes[i]), None)
+        if i is None:
+            return False
+        lane = self.lanes[i]
+        parts, size, stamp = lane.pop() if newest else lane.popleft()
+        self.attached[i] = min(self.attached[i], len(lane))
+        self.count -= 1
+        self.nbytes -= size
+        self.stamped -= stamp is not None
+        self.dropped += 1
+        return True
+
+    def put(self, parts, size, bounded=True, priority=0, stamp=None):
+        """
+        Queues the buffers "parts" of a message of "size" bytes and
+        "priority", ignoring the bounds when not "bounded" (messages about
+        to be written), with the "stamp" offset of its egress time if any.
+        Returns:
+            _queued, _full, _dropped or _overflow (see the settings above)
+        """
+        res = _queued
+        if bounded and self.full():
+            if self.policy == 'disconnect':
+                return _overflow
+            if self.policy == 'block':
+                res = _full
+            else:
+                newest = self.policy == 'drop-newest'
+                while self.full() and self.drop(priority - newest, newest):
+                    pass
+                if self.full():
+                    self.dropped += 1
+                    return _dropped
+                res = _dropped
+
+        self.lanes[priority].append((parts, size, stamp))
+        self.count += 1
+        self.nbytes += size
+        self.attached[priority] += 1
+        if stamp is not None:
+            self.stamped += 1
+        if self.count > self.peak:
+            self.peak = self.count
+        return res
+
+    def take(self):
+        """
+        Empties the queue, stamping the messages that carry a stamp.
+        Returns:
+            the buffers of all the queued messages, higher lanes first
+        """
+        if self.stamped:
+            now = msock.now_us()
+            for lane in self.lanes:
+                for parts, size, stamp in lane:
+                    if stamp is not None:
+                        msock._ts_fmt.pack_into(parts[0], stamp, now)
+            self.stamped = 0
+        bufs = []
+        for i in range(len(self.lanes) - 1, -1, -1):
+            lane = self.lanes[i]
+            if lane:
+                bufs += [b for parts, size, stamp in lane for b in parts]
+                lane.clear()
+                self.attached[i] = 0
+        self.count = self.nbytes = 0
+        return bufs
+
+    def detach(self):
+        """
+        Copies the queued buffers that are views of reusable buffers (see
+        detached()), to stay queued while those are reused.
+        """
+        for i, lane in enumerate(self.lanes):
+            for j in range(len(lane) - min(self.attached[i], len(lane)), len(lane)):
+                parts, size, stamp = lane[j]
+                lane[j] = detached(parts), size, stamp
+            self.attached[i] = 0
+
+    def stats(self):
+        """
+        Returns:
+            (depth, bytes, dropped, peak)
+        """
+        return self.count, self.nbytes, self.dropped, self.peak
+
+#------
+
+class ThreadedOutQueue(OutQueue):
+    """
+    OutQueue shared by publisher threads, calling put_wait(), and the writer
+    thread of the subscriber, calling take_wait().
+    """
+
+    def __init__(self, max_msgs, max_bytes, policy):
+        super().__init__(max_msgs, max_bytes, policy)
+        self.cond   = threading.Condition()
+        self.closed = False
+
+    def put_wait(self, parts, size, bounded=True, priority=0, stamp=None):
+        """
+        Queues a message, waiting until the queue drains when "block"ing.
+        Returns:
+            _queued, _dropped or _overflow, as put() does
+        """
+        with self.cond:
+            res = self.put(parts, size, bounded, priority, stamp)
+            self.cond.notify_all()
+            if res == _full:
+                self.cond.wait_for(lambda: self.closed or self.low())
+                res = _queued
+        return res
+
+    def wait_low(self):
+        """
+        Waits until the queue has drained half way (see low()), or is closed.
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.closed or self.low())
+
+    def take_wait(self):
+        """
+        Waits for queued messages and empties the queue.
+        Returns:
+            None, once closed
+            the buffers of all the queued messages, when normal
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.closed or self.count)
+            if self.closed:
+                return None
+            bufs = self.take()
+            self.cond.notify_all()
+        return bufs
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+#------
+
+def detached(bufs):
+    """
+    Copies the buffers "bufs" that are views of a bytearray, e.g. the
+    receive buffer of a connection, which its next read reuses; views of
+    immutable buffers, such as the mapped segments of a log, are kept.
+    Returns:
+        [buffer, ..], safe to hold on to
+    """
+    return [bytes(b) if type(b) is memoryview and type(b.obj) is bytearray else b for b in bufs]
+
+#------
+
+def credit_window(window, queued, budget):
+    """
+    Sizes the credit window of a publisher, "window" messages shrunk in
+    proportion as the subscriber queues fill "budget" with "queued" bytes.
+    Returns:
+        0, once "queued" reaches "budget"
+        the messages the publisher may send past those received, otherwise
+    """
+    if queued >= budget:
+        return 0
+    return max(1, window * (budget - queued) // budget)
+
+#------
+
+def format_stats(counters, queues):
+    """
+    Formats broker counters and the stats of the subscriber queues,
+        queues --> [(sid, OutQueue), ..]
+    as "name=value" words.
+    """
+    words = ['%s=%s' % kv for kv in counters.items()]
+    for sid, q in queues:
+        words.append('sub.%s=%d/%d/%d/%d' % ((sid,) + q.stats()))
+    return ' '.join(words)
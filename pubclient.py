@@ -0,0 +1,363 @@
+import os
+import time
+import socket
+import itertools
+import threading
+import collections
+from concurrent.futures import Future
+import my_sock as msock
+import registry
+import compress
+
+#-------
+# Global settings
+#-------
+
+_window     = 10000                             # messages of a connection sent and not yet acked
+_queue_msgs = 1000                              # messages of a connection waiting to be sent
+_write_msgs = 1024                              # messages written at most per write
+
+#-------
+# Publisher connections
+#-------
+
+class Connection:
+    """
+    One connection of a Publisher to the broker, as publisher "pid".
+    publish() queues the messages, each one numbered and encoded at once,
+    and the writer thread writes whatever is queued in one go, so a busy
+    connection writes many messages per syscall. Every message carries its
+    sequence number and the broker acks them cumulatively: the ack thread
+    resolves the futures of every message up to the acked one, in order.
+    At most "_window" messages are in flight, and with "_opt_credit" no more
+    than the broker granted credit for (see my_sock.encode_credit()).
+    Binary messages are compressed with codec "compression", and the
+    dictionaries "dicts" if given, when the broker accepts them.
+    With a "producer" id the connection asks to be an idempotent producer,
+    so the broker drops whatever it already got of the messages numbered
+    by this connection.
+    With "ping_secs" the writer thread pings the broker once it had nothing
+    to write for "ping_secs", if the broker agrees, and the connection
+    counts as lost once nothing was read from the broker for
+    my_sock._ping_grace pings.
+    Once the connection is lost the messages not yet acked fail with
+    ConnectionError, as do those published to it later: whether the broker
+    got them is unknown, so they are not sent again.
+    """
+
+    def __init__(self, host, port, pid, binary, credit, compression=None, dicts=None, producer=None,
+                 ping_secs=None):
+        self.pid    = pid
+        self.sock   = msock.connect2socket(host, port)
+        if self.sock is None:
+            raise ConnectionError("cannot connect to the broker at %s:%d" % (host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = msock.FrameReader(self.sock)
+        self.credit = False                     # credit granted by the broker
+        self.codec  = None                      # compress.Codec, if the broker accepts one
+        self.ping_secs = None                   # secs between pings, if the broker accepts them
+        opts = (msock._opt_bin,) * binary + (msock._opt_credit,) * credit
+        if binary and compression:
+            opts += (compression,) + (msock._opt_dict,) * bool(dicts)
+        if producer is not None:
+            opts += (msock._opt_idem + msock._opt_sep + producer,)
+        if ping_secs:
+            opts += ('%s%s%d' % (msock._opt_ping, msock._opt_sep, ping_secs),)
+        if opts:
+            accepted = msock.negotiate(self.sock, self.reader, pid, opts)
+            if accepted is None:
+                self.sock.close()
+                raise ConnectionError("cannot negotiate with the broker")
+            self.credit = msock._opt_credit in accepted
+            self.codec  = compress.codec(accepted, dicts)
+            self.ping_secs = msock.ping_secs(accepted)
+        self.cond    = threading.Condition()
+        self.queued  = collections.deque()      # (seq, bytes) waiting to be written
+        self.pending = collections.deque()      # (seq, Future) written or queued, not yet acked
+        self.seq     = 0                        # sequence number of the last message published
+        self.sent    = 0                        # sequence number of the last message written
+        self.acked   = 0                        # highest sequence number acked
+        self.limit   = 0                        # credit granted, up to the limit-th message
+        self.error   = None                     # ConnectionError, once lost or closed
+        self.heard   = time.monotonic()         # of the last read from the broker
+        self.threads = [threading.Thread(target=self.writer, daemon=True),
+                        threading.Thread(target=self.ack_reader, daemon=True)]
+        for t in self.threads:
+            t.start()
+
+    def publish(self, tpc, payload, key=None, priority=None):
+        """
+        Queues a message, waiting while "_queue_msgs" messages are queued;
+        binary messages carry their "key", if any, and headers of their
+        "priority", if any (see my_sock.hdr_ext()).
+        Returns:
+            Future, resolved once the broker acked the message
+        """
+        fut = Future()
+        with self.cond:
+            self.cond.wait_for(lambda: self.error or len(self.queued) < _queue_msgs)
+            if self.error:
+                fut.set_exception(self.error)
+                return fut
+            self.seq += 1
+            self.queued.append((self.seq, self.encode(tpc, payload, self.seq, key, priority)))
+            self.pending.append((self.seq, fut))
+            self.cond.notify_all()
+        return fut
+
+    def encode(self, tpc, payload, seq, key=None, priority=None):
+        if self.reader.binary:
+            packed = self.codec and self.codec.pack(str(tpc, msock._str_enc), payload)
+            flags, ext = 0, b''
+            if packed:
+                flags, ext, payload = packed
+            if key is not None:
+                flags, ext = flags | msock._flag_key, ext + msock.key_ext(key)
+            if priority is not None:
+                flags, ext = flags | msock._flag_hdr, ext + msock.hdr_ext(priority, None, self.pid)
+            return msock.encode_frame('pub', tpc, payload, ext, flags, seq)
+        return b'%s%s%d pub %s %s%s' % (bytes(self.pid, msock._str_enc), bytes(msock._seq_sep, 'ascii'),
+                                        seq, tpc, payload, msock._bdelim)
+
+    def sendable(self):
+        """
+        Returns:
+            the number of queued messages that may be written now
+        """
+        n = min(len(self.queued), _write_msgs, self.acked + _window - self.sent)
+        if self.credit:
+            n = min(n, self.limit - self.sent)
+        return n
+
+    def writer(self):
+        """
+        Writes the queued messages, as many at once as may be written,
+        or a ping after "ping_secs" without any.
+        """
+        while True:
+            with self.cond:
+                ready = self.cond.wait_for(lambda: self.error or self.sendable() > 0, self.ping_secs)
+                if self.error:
+                    return
+                if ready:
+                    bufs = [self.queued.popleft()[1] for _ in range(self.sendable())]
+                    self.sent += len(bufs)
+                    self.cond.notify_all()
+                elif time.monotonic() - self.heard > self.ping_secs * msock._ping_grace:
+                    bufs = None
+                elif self.reader.binary:
+                    bufs = [msock.encode_frame(msock._ping)]
+                else:
+                    bufs = [bytes('%s %s%s' % (self.pid, msock._ping, msock._delim), msock._str_enc)]
+            if bufs is None:
+                self.fail(ConnectionError("broker silent for too long"))
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                return
+            if msock.write_vec(self.sock, bufs) == -1:
+                self.fail(ConnectionError("cannot write to the broker"))
+                return
+
+    def ack_reader(self):
+        """
+        Reads the acks and credit grants of the broker until the connection
+        is lost.
+        """
+        while True:
+            seq = self.read()
+            if seq is None:
+                self.fail(ConnectionError("disconnected from the broker"))
+                return
+            done = []
+            with self.cond:
+                self.acked = max(self.acked, seq)
+                while self.pending and self.pending[0][0] <= self.acked:
+                    done.append(self.pending.popleft()[1])
+                self.cond.notify_all()
+            for fut in done:
+                fut.set_result(None)
+
+    def read(self):
+        """
+        Reads the next ack, applying the credit grants read before it and
+        skipping the answers to pings.
+        Returns:
+            None, on error
+            seq,  the sequence number acked, when normal
+        """
+        while True:
+            frame = self.reader.next_frame()
+            if frame is None:
+                try:                            # quietly, unlike FrameReader.fill(), once closed
+                    n = self.sock.recv_into(self.reader.get_buffer())
+                except OSError:
+                    n = 0
+                if n == 0:
+                    return None
+                self.reader.buffer_updated(n)
+                self.heard = time.monotonic()
+                continue
+            if self.reader.binary:
+                cmd, flags, tpc, ext, payload = msock.decode_frame(frame)
+                seq = msock.frame_seq(flags, ext)
+                if cmd == msock._pong:
+                    continue
+                if cmd == 'credit':
+                    self.grant(seq or 0)
+                    continue
+                if cmd == msock._ack and seq is not None:
+                    return seq
+            else:
+                smsg = str(frame, msock._str_enc).strip()
+                if smsg == msock._pong:
+                    continue
+                limit = msock.parse_credit(smsg)
+                if limit is not None:
+                    self.grant(limit)
+                    continue
+                seq = msock.parse_ack(smsg)
+                if seq:
+                    return seq
+            print("Publisher> Unexpected reply from broker <%s>" % bytes(frame))
+            return None
+
+    def grant(self, limit):
+        with self.cond:
+            self.limit = max(self.limit, limit)
+            self.cond.notify_all()
+
+    def fail(self, err):
+        """
+        Fails the messages not yet acked with "err", and those published later.
+        """
+        with self.cond:
+            if self.error is None:
+                self.error = err
+            failed = [fut for seq, fut in self.pending]
+            self.pending.clear()
+            self.queued.clear()
+            self.cond.notify_all()
+        for fut in failed:
+            fut.set_exception(err)
+
+    def wait_acked(self, seq, timeout=None):
+        """
+        Waits until every message up to "seq" has been acked, or failed.
+        Returns:
+            False, if "timeout" secs passed first
+            True,  when normal
+        """
+        with self.cond:
+            return self.cond.wait_for(lambda: self.error or self.acked >= seq, timeout)
+
+    def close(self):
+        self.fail(ConnectionError("publisher closed"))
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        for t in self.threads:
+            t.join()
+        self.sock.close()
+
+#-------
+# Publisher client
+#-------
+
+class Publisher:
+    """
+    Thread-safe client of the publisher port of a broker, as publisher
+    "pid", over a pool of "connections" connections sending in parallel,
+    using binary frames if "binary" and broker credit if "credit", when the
+    broker supports them.
+    publish() returns a concurrent.futures.Future resolved once the broker
+    acked the message. Messages published with the same "key" go over the
+    same connection, and so reach the broker in the order published; the
+    others are spread over the connections in turn, in no given order.
+    Note that the broker keys "key-hash" consumer groups by publisher id,
+    the same "pid" on every connection, not by these keys.
+    With "compression", "zlib" or "zstd", binary payloads are compressed,
+    with the dictionaries of "dict_dir" if given (see compress.py), if the
+    broker accepts the codec.
+    With "idempotent" every connection is an idempotent producer, of an id
+    of its own, and binary messages carry their key, so that a broker
+    deduplicating message keys drops those whose key it saw lately.
+    Binary messages published with a "priority" carry headers: the
+    priority, the time published and "pid" as producer id. Their priority
+    lets them overtake those of lower priorities queued to the subscribers
+    (see outq.OutQueue), and subscribers asking for headers also get the
+    times the broker read them and wrote them out (see subclient.py).
+    With "ping_secs" idle connections ping the broker, and fail once it
+    stays silent (see Connection).
+    """
+
+    def __init__(self, host, port, pid, connections=1, binary=True, credit=True,
+                 compression=None, dict_dir=None, idempotent=False, ping_secs=None):
+        self.conns = []
+        self.idempotent = idempotent
+        dicts = compress.Dictionaries(dict_dir) if dict_dir else None
+        token = os.urandom(4).hex()
+        try:
+            for i in range(max(connections, 1)):
+                producer = '%s.%s.%d' % (pid, token, i) if idempotent else None
+                self.conns.append(Connection(host, port, pid, binary, credit, compression, dicts,
+                                             producer, ping_secs))
+        except ConnectionError:
+            self.close()
+            raise
+        self.turn = itertools.count()           # next connection of unkeyed messages
+
+    def publish(self, tpc, payload, key=None, priority=None):
+        """
+        Publishes "payload", bytes or str, to topic "tpc", waiting while the
+        connection it goes over has "_queue_msgs" messages queued, with
+        headers of "priority", 0 (bulk) to my_sock._priorities - 1, if given.
+        Returns:
+            Future, resolved with None once acked, or failed with
+            ConnectionError if the connection is lost first
+        Raises:
+            ValueError, for a pattern, a text payload of many lines or a
+                        priority out of range
+        """
+        if isinstance(tpc, str):
+            tpc = bytes(tpc, msock._str_enc)
+        if isinstance(payload, str):
+            payload = bytes(payload, msock._str_enc)
+        if not msock.valid_topic(str(tpc, msock._str_enc)):
+            raise ValueError("cannot publish to %r" % tpc)
+        if priority is not None and not 0 <= priority < msock._priorities:
+            raise ValueError("invalid priority %r" % priority)
+        if key is not None:
+            conn = self.conns[registry._hash(str(key)) % len(self.conns)]
+        else:
+            conn = self.conns[next(self.turn) % len(self.conns)]
+        if not conn.reader.binary and msock._bdelim in payload:
+            raise ValueError("text payloads cannot span lines")
+        return conn.publish(tpc, payload, key if self.idempotent else None, priority)
+
+    def flush(self, timeout=None):
+        """
+        Waits until every message published so far has been acked, or failed.
+        Returns:
+            False, if "timeout" secs passed first
+            True,  when normal
+        """
+        last = [conn.seq for conn in self.conns]
+        return all([conn.wait_acked(seq, timeout) for conn, seq in zip(self.conns, last)])
+
+    def close(self, timeout=None):
+        """
+        Flushes, then closes the connections; messages still not acked fail.
+        """
+        self.flush(timeout)
+        for conn in self.conns:
+            conn.close()
+        self.conns = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
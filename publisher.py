@@ -1,9 +1,12 @@
 #!/usr/bin/python3
 
+import os
 import sys
 import my_sock as msock
+import compress
 import argparse 
 import time 
+import threading
 
 #------- 
 # Global settings
@@ -14,9 +17,36 @@ _pub_port = None
 _host = "localhost"
 _broker_port = None
 _pub_file    = None
+_binary      = False                            # binary frames asked with "-b"
+_window      = 0                                # messages in flight with "-w", 0 waits each ack
+_max_batch   = 0                                # messages per "pubbatch" with "-B", 0 for none
+_linger      = 0.005                            # secs a batch waits to fill, "-L" in msecs
+_credit      = False                            # credit asked with "-c", then granted by the broker
+_compression = None                             # codec asked with "-z", along with "-b"
+_dict_dir    = None                             # compression dictionaries, "-d"
+_codec       = None                             # compress.Codec, once the broker accepted "-z"
+_idem        = False                            # idempotent, with "-I"
+_producer    = None                             # producer id with "-I", the same over every connection
+_ack_secs    = 5.0                              # secs waiting an ack before sending again, "-T"
+_retries     = 3                                # times a message is sent again, with "-I"
+_priority    = None                             # priority of the headers sent with "-P", along with "-b"
 
 _pub_cmds = []                                  # commands in the file
 _sock = None                                    # socket to broker
+_reader = None                                  # FrameReader over "_sock"
+
+_seq       = 0                                  # sequence number of the last message sent
+_acked     = 0                                  # highest sequence number acked
+_ack_error = False                              # acks can no longer be read
+_sent      = 0                                  # messages sent, counting those of batches
+_limit     = 0                                  # credit granted, up to the limit-th message
+_throttled = 0.0                                # secs waiting for credit
+_acks_cond = threading.Condition()              # signals acks to send() when pipelining
+_send_lock = threading.Lock()                   # send() runs also from the linger timer
+
+_batch       = []                               # (tpc, msg) of the batch being filled
+_batch_lock  = threading.Lock()
+_batch_timer = None                             # sends "_batch" once "_linger" expires
 
 #------- 
 # Command line arguments parsing
@@ -28,7 +58,8 @@ def parse_args ():
     storing them in the respective global variables.
     """
     
-    global  _pub_id, _pub_port, _host, _broker_port, _pub_file
+    global  _pub_id, _pub_port, _host, _broker_port, _pub_file, _binary, _window
+    global  _max_batch, _linger, _credit, _compression, _dict_dir, _idem, _ack_secs, _priority
 
     parser  = argparse.ArgumentParser()
     parser.add_argument('-i', type=str, metavar='ID', nargs=1, required=True,
@@ -50,6 +81,45 @@ def parse_args ():
     parser.add_argument('-f', type=argparse.FileType('r'), metavar='file', nargs=1, 
                               dest='pub_file', 
                               help='Pub commands to execute')
+
+    parser.add_argument('-b', action='store_true', dest='binary',
+                              help='Use binary frames, if the broker supports them')
+
+    parser.add_argument('-w', type=int, metavar='N', default=0,
+                              dest='window',
+                              help='Pipeline up to N messages not yet acked (default 0, wait each ack)')
+
+    parser.add_argument('-B', type=int, metavar='N', default=0,
+                              dest='max_batch',
+                              help='Publish in batches of up to N messages (default 0, no batches)')
+
+    parser.add_argument('-L', type=float, metavar='msecs', default=_linger * 1000,
+                              dest='linger',
+                              help='Msecs a batch waits for more messages (default %g)' % (_linger * 1000))
+
+    parser.add_argument('-c', action='store_true', dest='credit',
+                              help='Send only what the broker grants credit for, if it supports it')
+
+    parser.add_argument('-z', type=str, metavar='codec', default=None,
+                              choices=tuple(compress._codecs), dest='compression',
+                              help='Compress binary frames with codec, if the broker supports it')
+
+    parser.add_argument('-d', type=str, metavar='dir', default=None,
+                              dest='dict_dir',
+                              help='Compression dictionaries of the topics (see compress.py)')
+
+    parser.add_argument('-I', action='store_true', dest='idem',
+                              help='Publish idempotently, sending a message again when its ack is late '
+                                   '(without -w and -c), if the broker supports it')
+
+    parser.add_argument('-T', type=float, metavar='secs', default=_ack_secs,
+                              dest='ack_secs',
+                              help='Secs waiting an ack before sending again, with -I (default %g)' % _ack_secs)
+
+    parser.add_argument('-P', type=int, metavar='N', default=None,
+                              choices=range(msock._priorities), dest='priority',
+                              help='Send binary frames with headers, of priority N (0 bulk .. %d), '
+                                   'the publish time and the producer id' % (msock._priorities - 1))
     
     d = parser.parse_args()
    
@@ -57,6 +127,16 @@ def parse_args ():
     _pub_port = d.pub_port[0]
     _broker_port = d.broker_port[0]
     _pub_file    = d.pub_file[0].name if d.pub_file is not None else None
+    _binary      = d.binary
+    _window      = max(d.window, 0)
+    _max_batch   = d.max_batch
+    _linger      = d.linger / 1000
+    _credit      = d.credit
+    _compression = d.compression
+    _dict_dir    = d.dict_dir
+    _idem        = d.idem
+    _ack_secs    = d.ack_secs
+    _priority    = d.priority
 
 #-------
 
@@ -118,6 +198,10 @@ def parse_command (cmd):
         print('Publisher> Invalid command, first word (sleep time) should be int')
         return None
     
+    if not msock.valid_topic(words[2]):
+        print('Publisher> Invalid command, cannot publish to pattern %s' % words[2])
+        return None
+    
     return int(words[0]), words[1], words[2], ' '.join(words[3:])
 
 #------
@@ -149,26 +233,283 @@ def exec_cmd (cmd):
     """
     Executes a command from file or keyboard:
         sleep, what, tpc, msg
+    With "-B" published messages are gathered in batches (see add_to_batch()).
     """
     slp, what, tpc, msg = cmd
     
     print("\t\tSleeping for %d secs" % slp)
     time.sleep(slp)
-    
-    print("\t\tWriting to topic %s, msg=<%s>" % (tpc, msg))
-    smsg = ' '.join((_pub_id, what, tpc, msg))
-    n = msock.write2socket(_sock, smsg)
-    if n == -1:
-        print("Publisher> Cannot write to socket .. Quiting")   
-        sys.exit(-2)
-    
-    smsg = msock.read_from_socket(_sock)      # _ack
-    print("Publisher> Received from broker <%s>" % smsg)    
-    if smsg != msock._ack:
-        print("Publisher> Invalid ack")
+
+    if _max_batch > 1 and what == 'pub':
+        add_to_batch(tpc, msg)
+        return
+
+    if send(what, tpc, msg) == -1:
         sys.exit(-2)
+
+#------
+
+def send (what, tpc, msg, batch=None):
+    """
+    Sends a message, or the messages of "batch" as a "pubbatch":
+        [(tpc, msg), ..]
+    Without a window, each message waits its ack before the next one is sent.
+    With a window "_window" messages may be in flight, each one carrying its
+    sequence number so that ackthread() can match the broker's cumulative acks.
+    With "_credit" messages are sent, in flight as well, while the broker
+    granted credit for more than "_sent" messages, whatever the window.
+    With "_idem" every message carries its sequence number as well and,
+    without window and credit, is sent again until acked (see resend()).
+    Returns:
+        -1 on error
+        0  when normal
+    """
+    global _seq, _sent, _throttled
+
+    with _send_lock:
+        seq = None
+        if _window > 0 or _credit:
+            with _acks_cond:
+                if _credit and not _ack_error and _sent >= _limit:
+                    t0 = time.monotonic()
+                    _acks_cond.wait_for(lambda: _ack_error or _sent < _limit)
+                    _throttled += time.monotonic() - t0
+                if _window > 0:
+                    _acks_cond.wait_for(lambda: _ack_error or _seq - _acked < _window)
+            if _ack_error:
+                print("Publisher> Cannot read acks from broker .. Quiting")
+                return -1
+            _seq += 1
+            seq = _seq
+            _sent += len(batch) if batch is not None else 1
+        elif _idem:
+            _seq += 1
+            seq = _seq
+
+        if batch is not None:
+            what, tpc, msg = 'pubbatch', str(len(batch)), '<batch>'
+            print("\t\tWriting batch of %s msgs" % tpc)
+        else:
+            print("\t\tWriting to topic %s, msg=<%s>" % (tpc, msg))
+        data = encode(what, tpc, msg, batch, seq)
+        n = msock.write_bytes(_sock, data)
+        if n == -1 and not _idem:
+            print("Publisher> Cannot write to socket .. Quiting")   
+            return -1
+
+        if _window > 0 or _credit:
+            print("Publisher> Sent msg #%d for topic %s: %s" % (seq, tpc, msg))
+            return 0
         
+        if (resend(data) if _idem else read_ack()) is None:
+            print("Publisher> Invalid ack")
+            return -1
+            
     print("Publisher> Published msg for topic %s: %s" % (tpc, msg))
+    return 0
+
+#------
+
+def encode (what, tpc, msg, batch, seq):
+    """
+    Encodes a message, or the messages of "batch" as a "pubbatch", as text
+    lines or as a binary frame, compressed as a whole with "_codec" when
+    negotiated and worth it, and with "_priority" carrying headers (see
+    my_sock.hdr_ext()), those of a batch applying to each of its messages.
+    Returns:
+        bytes, to be written
+    """
+    pid = _pub_id if seq is None else '%s%s%d' % (_pub_id, msock._seq_sep, seq)
+    if _reader.binary:
+        if batch is not None:
+            tpc, payload = '', msock.encode_batch(batch)
+        else:
+            payload = bytes(msg, msock._str_enc)
+        packed = _codec.pack(tpc, payload) if _codec is not None else None
+        flags, ext = 0, b''
+        if packed is not None:
+            flags, ext, payload = packed
+        if _priority is not None:
+            producer = _producer if _idem else _pub_id
+            flags, ext = flags | msock._flag_hdr, ext + msock.hdr_ext(_priority, None, producer)
+        return msock.encode_frame(what, tpc, payload, ext, flags, seq)
+    if batch is not None:
+        smsg = msock._delim.join([' '.join((pid, what, tpc))] +
+                                 [' '.join(m) for m in batch])
+    else:
+        smsg = ' '.join((pid, what, tpc, msg))
+    return bytes(smsg + msock._delim, msock._str_enc)
+
+#------
+
+def resend (data):
+    """
+    Waits for the ack of a message of an idempotent publisher, "data" as
+    written, writing it again over a new connection whenever none comes
+    within "_ack_secs" secs, up to "_retries" times; the broker acks the
+    copies of what it already got without publishing them again.
+    Returns:
+        None, if never acked
+        as read_ack(), when normal
+    """
+    for retry in range(_retries + 1):
+        if retry:
+            print("Publisher> No ack within %g secs, sending again (%d/%d)" % (_ack_secs, retry, _retries))
+            try:
+                msock.term_socket(_sock)
+            except OSError:
+                pass
+            if connect() is None or msock.write_bytes(_sock, data) == -1:
+                time.sleep(_ack_secs)
+                continue
+        ack = read_ack()
+        if ack is not None:
+            return ack
+    return None
+
+#------
+
+def connect ():
+    """
+    Connects to the broker, negotiating the options asked for; with
+    "_idem" and no window nor credit, reads wait at most "_ack_secs" secs.
+    Returns:
+        None, on error
+        set,  of the accepted options, empty if none was asked for
+    """
+    global _sock, _reader
+
+    _sock = msock.connect2socket(_host, _broker_port)
+    if _sock is None:
+        print("Publisher> Cannot connect to broker")
+        return None
+    _reader = msock.FrameReader(_sock)
+    opts = (msock._opt_bin,) * _binary + (msock._opt_credit,) * _credit
+    if _binary and _compression:
+        opts += (_compression,) + (msock._opt_dict,) * bool(_dict_dir)
+    if _idem:
+        opts += (msock._opt_idem + msock._opt_sep + _producer,)
+    if not opts:
+        return set()
+    if _idem and _window == 0 and not _credit:
+        _sock.settimeout(_ack_secs)
+    opts = msock.negotiate(_sock, _reader, _pub_id, opts)
+    if opts is None:
+        print("Publisher> Cannot negotiate with broker")
+    return opts
+
+#------
+
+def add_to_batch (tpc, msg):
+    """
+    Adds a message to the batch being filled, which is sent as one
+    "pubbatch" when it reaches "_max_batch" messages or "_linger" secs
+    after its first message, whichever comes first.
+    """
+    global _batch_timer
+
+    with _batch_lock:
+        _batch.append((tpc, msg))
+        full = len(_batch) >= _max_batch
+        if not full and len(_batch) == 1:
+            _batch_timer = threading.Timer(_linger, flush_batch)
+            _batch_timer.daemon = True
+            _batch_timer.start()
+    if full:
+        flush_batch()
+
+#------
+
+def flush_batch ():
+    """
+    Sends the batch being filled, if any.
+    """
+    global _batch
+
+    with _batch_lock:
+        batch, _batch = _batch, []
+        if _batch_timer is not None:
+            _batch_timer.cancel()
+    if batch and send('pub', '', '', batch) == -1:
+        print("Publisher> Cannot send batch of %d messages" % len(batch))
+
+#------
+
+def read_ack ():
+    """
+    Reads an ack from the broker, applying the credit grants read before it.
+    Returns:
+        None, on error or if not an ack
+        0,    for a plain ack
+        seq,  for a cumulative ack up to sequence number seq
+    """
+    while True:
+        if _reader.binary:
+            frame = _reader.read_frame()
+            if frame is None:
+                return None
+            cmd, flags, tpc, ext, payload = msock.decode_frame(frame)
+            print("Publisher> Received from broker <%s>" % cmd)
+            if cmd == 'credit':
+                add_credit(msock.frame_seq(flags, ext) or 0)
+                continue
+            if cmd != msock._ack:
+                return None
+            return msock.frame_seq(flags, ext) or 0
+
+        smsg = _reader.read_msg()
+        print("Publisher> Received from broker <%s>" % smsg)
+        if smsg is None:
+            return None
+        limit = msock.parse_credit(smsg)
+        if limit is None:
+            return msock.parse_ack(smsg)
+        add_credit(limit)
+
+#------
+
+def add_credit (limit):
+    """
+    Applies a credit grant, letting send() go on up to the limit-th message.
+    """
+    global _limit
+
+    with _acks_cond:
+        _limit = max(_limit, limit)
+        _acks_cond.notify_all()
+
+#------
+
+def ackthread ():
+    """
+    Reads the acks of pipelined messages, releasing room in the window.
+    A plain ack, from a broker not acking cumulatively, acks the oldest
+    message in flight.
+    """
+    global _acked, _ack_error
+
+    while True:
+        seq = read_ack()
+        with _acks_cond:
+            if seq is None:
+                _ack_error = True
+            else:
+                _acked = seq if seq > 0 else _acked + 1
+            _acks_cond.notify_all()
+        if seq is None:
+            break
+
+#------
+
+def wait_acks ():
+    """
+    Waits until every pipelined message has been acked.
+    """
+    with _acks_cond:
+        _acks_cond.wait_for(lambda: _ack_error or _acked >= _seq)
+    print("Publisher> %d messages acked" % _acked)
+    if _credit:
+        print("Publisher> Throttled for %.3f secs waiting for credit" % _throttled)
 
 #------
 
@@ -199,13 +540,35 @@ if __name__ == "__main__":
     parse_args()
     get_file_cmds()
     
-    _sock = msock.connect2socket(_host, _broker_port)
-    if _sock is None:
-        print("Publisher> Cannot connect to broker .. Quiting")
+    _producer = '%s.%s' % (_pub_id, os.urandom(4).hex())
+    opts = connect()
+    if opts is None:
+        print("Publisher> .. Quiting")
         sys.exit(-1)
+    dicts = compress.Dictionaries(_dict_dir) if _dict_dir else None
+    if _binary or _credit or _idem:
+        if _binary:
+            print("Publisher> Binary frames %s" % ("on" if _reader.binary else "not supported"))
+        if _credit:
+            _credit = msock._opt_credit in opts
+            print("Publisher> Credit %s" % ("on" if _credit else "not supported"))
+        if _binary and _compression:
+            _codec = compress.codec(opts, dicts)
+            print("Publisher> Compression %s" % (_codec.name if _codec else "not supported"))
+        if _idem:
+            _idem = msock.idem_producer(opts) is not None
+            print("Publisher> Idempotence %s" % ("on" if _idem else "not supported"))
+            if not _idem:
+                _sock.settimeout(None)
+    
+    if _window > 0 or _credit:
+        threading.Thread(target=ackthread, daemon=True).start()
     
     exec_file_cmds()
     exec_keyboard_commands()
+    flush_batch()
+    if _window > 0 or _credit:
+        wait_acks()
     
     msock.term_socket(_sock)
     
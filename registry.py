@@ -0,0 +1,506 @@
+import hashlib
+import bisect
+import itertools
+import threading
+import my_sock as msock
+import filters
+
+#-------
+# Global settings
+#-------
+
+_max_cached = 1 << 17                           # resolved topics cached before clearing them all
+_group_policies = ('round-robin', 'least-outstanding', 'key-hash')
+_ring_points    = 64                            # points of each member on the "key-hash" ring
+
+#-------
+# Subscription registry
+#-------
+
+def _hash(s):
+    """
+    Returns:
+        a 64 bit hash of "s", str or bytes, the same in every process
+        (crc32 clusters keys differing in their last characters)
+    """
+    if isinstance(s, str):
+        s = bytes(s, msock._str_enc)
+    return int.from_bytes(hashlib.blake2b(s, digest_size=8).digest(), 'big')
+
+#------
+
+class _Node:
+    """
+    Node of the trie of wildcard patterns, one level per edge;
+    "pattern" is set on the node where a subscribed pattern ends.
+    The trie of the topics cached in snapshots uses it too, "pattern"
+    being then the topic ending there.
+    """
+    __slots__ = ('children', 'pattern')
+
+    def __init__(self):
+        self.children = {}
+        self.pattern  = None
+
+#------
+
+class Group:
+    """
+    Consumer group "name" of topic "tpc": each message published to the
+    topic goes to one of its members, picked by "policy":
+        round-robin        --> each member in turn
+        least-outstanding  --> the member with the fewest messages not yet
+                               written to it, in turn among equals
+        key-hash           --> the member owning the key of the message on a
+                               ring of "_ring_points" hashes per member, so
+                               the messages of a key stay with one member and
+                               a change of members moves only the keys of
+                               the member joining or leaving
+    "members" and "ring" are immutable tuples, rebuilt by rebalance() on
+    every change of members, so pick() reads them without locking.
+    """
+
+    def __init__(self, tpc, name, policy):
+        self.tpc     = tpc
+        self.name    = name
+        self.policy  = policy
+        self.conns   = {}                       # sid --> conn
+        self.members = ()                       # ((sid, conn), ..), sorted by sid
+        self.ring    = ((), ())                 # (hashes, owners), sorted by hash
+        self.turn    = itertools.count()
+
+    def rebalance(self):
+        """
+        Reassigns the messages of the group after members joined or left.
+        """
+        self.members = tuple(sorted(self.conns.items(), key=lambda m: m[0]))
+        if self.policy == 'key-hash':
+            points = sorted((_hash('%s#%d' % (sid, i)), k)
+                            for k, (sid, conn) in enumerate(self.members)
+                            for i in range(_ring_points))
+            self.ring = (tuple(h for h, k in points),
+                         tuple(self.members[k] for h, k in points))
+
+    def pick(self, key, load):
+        """
+        Picks the member for a message with "key", str or bytes,
+        "load(conn)" giving the messages outstanding on "conn".
+        Returns:
+            (sid, conn), or None if the group has no members
+        """
+        members = self.members
+        n = len(members)
+        if n <= 1:
+            return members[0] if n else None
+        if self.policy == 'key-hash':
+            hashes, owners = self.ring
+            i = bisect.bisect(hashes, _hash(key or ''))
+            return owners[i % len(owners)]
+        i = next(self.turn) % n
+        if self.policy == 'round-robin':
+            return members[i]
+        best, least = None, None
+        for m in members[i:] + members[:i]:
+            out = load(m[1])
+            if least is None or out < least:
+                best, least = m, out
+                if not out:
+                    break
+        return best
+
+#------
+
+class SubRegistry:
+    """
+    Subscriptions of subscribers to topics and to wildcard patterns of
+    hierarchical topics (see msock.valid_topic()):
+        members  --> tpc  --> {sid: conn}, one subscription per sid and topic or pattern
+        by_conn  --> conn --> {(tpc, sid), ..}, reverse index of each connection
+        trie     --> _Node, root of the subscribed patterns
+        snapshot --> tpc  --> ((sid, conn), ..), resolved subscribers of published topics
+        topics   --> _Node, root of the trie of the topics resolved, at most "_max_cached"
+        uses     --> pattern --> {tpc, ..}, snapshots including the subscribers of pattern
+        groups   --> tpc  --> (Group, ..), consumer groups of the topic, replaced on change
+        filters  --> tpc  --> filters.FilterIndex, of the subscriptions to the topic or
+                     pattern with a filter, in "members" too but left out of "snapshot"
+        indexes  --> tpc  --> (FilterIndex, ..), of published topics, resolved along with
+                     "snapshot" while there are filters
+    Group members are also in "by_conn", as (tpc, sid, name).
+    Changes are serialized by "lock" and cost O(1), plus the trie depth for
+    patterns: they only drop the snapshots of the changed topic, or of the
+    topics matched by the changed pattern, rebuilt by the next subscribers()
+    of the topic, so a burst of changes costs a single rebuild. A new
+    pattern finds the topics it matches by walking the trie of "topics"
+    along it, in time bound by those topics rather than by all the cached
+    ones. Rebuilding
+    walks the trie, in time bound by the topic depth rather than by the
+    number of patterns. Snapshots are immutable tuples, replaced
+    (copy-on-write) rather than changed, so publish paths read them
+    without taking the lock.
+    """
+
+    def __init__(self):
+        self.lock      = threading.Lock()
+        self.members   = {}
+        self.by_conn   = {}
+        self.trie      = _Node()
+        self.npatterns = 0
+        self.snapshot  = {}
+        self.topics    = _Node()
+        self.ntopics   = 0
+        self.uses      = {}
+        self.groups    = {}
+        self.filters   = {}
+        self.indexes   = {}
+
+    def subscribers(self, tpc):
+        """
+        Returns:
+            ((sid, conn), ..), the subscribers of topic "tpc", maybe empty,
+            always empty for patterns
+        """
+        snap = self.snapshot.get(tpc)
+        if snap is None:
+            if not self.npatterns and tpc not in self.members or msock.is_pattern(tpc):
+                return ()
+            with self.lock:
+                snap = self._resolve(tpc)
+        return snap
+
+    def filtered(self, tpc, payload, subs=()):
+        """
+        Matches a message to topic "tpc" against the filters of the
+        subscriptions to it and to the patterns matching it, its payload
+        parsed once for all of them (see filters.FilterIndex), leaving out
+        the connections of "subs", those subscribers() returned.
+        Returns:
+            ((sid, conn), ..), the filtered subscribers of the message
+        """
+        indexes = self.indexes.get(tpc)
+        if indexes is None:
+            if not self.filters or msock.is_pattern(tpc):
+                return ()
+            with self.lock:
+                self._resolve(tpc)
+                indexes = self.indexes.get(tpc, ())
+        if not indexes:
+            return ()
+        doc = filters.fields(payload)
+        if doc is None:
+            return ()
+        found = []
+        conns = {conn for sid, conn in subs}
+        for index in indexes:
+            for sid, conn in index.match(doc):
+                if conn not in conns:
+                    conns.add(conn)
+                    found.append((sid, conn))
+        return tuple(found)
+
+    def _resolve(self, tpc):
+        """
+        Caches the subscribers of topic "tpc" and of the patterns matching
+        it; a connection subscribed to both gets the message once. Those
+        with a filter are left to filtered(), through the FilterIndex of
+        the topic and of each pattern.
+        """
+        if self.ntopics >= _max_cached:
+            self.snapshot.clear()
+            self.indexes.clear()
+            self.uses.clear()
+            self.topics, self.ntopics = _Node(), 0
+        node = self.topics
+        for level in tpc.split(msock._tpc_sep):
+            node = node.children.setdefault(level, _Node())
+        if node.pattern is None:
+            node.pattern = tpc
+            self.ntopics += 1
+        index = self.filters.get(tpc)
+        indexes = [index] if index is not None else []
+        subs = {(sid, conn): None for sid, conn in self.members.get(tpc, {}).items()
+                if index is None or sid not in index.subs}
+        if self.npatterns:
+            conns = {conn for sid, conn in subs}
+            for pattern in self._match(tpc.split(msock._tpc_sep)):
+                self.uses.setdefault(pattern, set()).add(tpc)
+                index = self.filters.get(pattern)
+                if index is not None:
+                    indexes.append(index)
+                for sid, conn in self.members[pattern].items():
+                    if conn not in conns and (index is None or sid not in index.subs):
+                        conns.add(conn)
+                        subs[(sid, conn)] = None
+        if self.filters:
+            self.indexes[tpc] = tuple(indexes)
+        snap = self.snapshot[tpc] = tuple(subs)
+        return snap
+
+    def _match(self, levels):
+        """
+        Returns:
+            [pattern, ..], the subscribed patterns matching topic "levels"
+        """
+        found = []
+        nodes = [self.trie]
+        for level in levels:
+            nxt = []
+            for node in nodes:
+                children = node.children
+                many = children.get(msock._wild_many)
+                if many is not None:
+                    found.append(many.pattern)
+                child = children.get(level)
+                if child is not None:
+                    nxt.append(child)
+                child = children.get(msock._wild_one)
+                if child is not None:
+                    nxt.append(child)
+            nodes = nxt
+            if not nodes:
+                return found
+        for node in nodes:                      # "a.#" matches "a" too
+            if node.pattern is not None:
+                found.append(node.pattern)
+            many = node.children.get(msock._wild_many)
+            if many is not None:
+                found.append(many.pattern)
+        return found
+
+    def subscribe(self, tpc, sid, conn, where=None):
+        """
+        Subscribes "sid" on connection "conn" to topic or pattern "tpc",
+        to the messages matching filters.Filter "where" only if given.
+        A subscription of "sid" on another connection, e.g. the one it had
+        before reconnecting, moves to "conn"; one already on "conn" keeps
+        "where" as its filter instead of the one it had.
+        Returns:
+            None,  if "tpc" is not a valid pattern
+            False, if "sid" was already subscribed on "conn"
+            True,  when normal
+            conn,  the other connection, if the subscription moved from it
+        """
+        if not msock.valid_topic(tpc, pattern=True):
+            return None
+        moved = True
+        with self.lock:
+            subs = self.members.get(tpc)
+            if subs is not None and sid in subs:
+                if subs[sid] is conn:
+                    self._drop_filter(tpc, sid)
+                    if where is not None:
+                        self.filters.setdefault(tpc, filters.FilterIndex()).add(sid, conn, where)
+                    self._invalidate(tpc)
+                    return False
+                moved = subs[sid]
+                self._remove(tpc, subs, sid)
+                subs = self.members.get(tpc)
+            if subs is None:
+                subs = self.members[tpc] = {}
+                if msock.is_pattern(tpc):
+                    self._add_pattern(tpc)
+            subs[sid] = conn
+            if where is not None:
+                self.filters.setdefault(tpc, filters.FilterIndex()).add(sid, conn, where)
+            self.by_conn.setdefault(conn, set()).add((tpc, sid))
+            self._invalidate(tpc)
+        return moved
+
+    def unsubscribe(self, tpc, sid):
+        """
+        Unsubscribes "sid" from topic or pattern "tpc".
+        Returns:
+            False, if "sid" was not subscribed
+            True,  when normal
+        """
+        with self.lock:
+            subs = self.members.get(tpc)
+            if subs is None or sid not in subs:
+                return False
+            self._remove(tpc, subs, sid)
+        return True
+
+    def consumer_groups(self, tpc):
+        """
+        Returns:
+            (Group, ..), the consumer groups of topic "tpc", maybe empty
+        """
+        return self.groups.get(tpc, ())
+
+    def join(self, tpc, name, sid, conn, policy='round-robin'):
+        """
+        Adds "sid" on connection "conn" to consumer group "name" of topic
+        "tpc", created with "policy" by its first member, and rebalances it.
+        A member "sid" on another connection moves to "conn".
+        Returns:
+            None,  if "tpc" is not a topic or "policy" is unknown
+            False, if "sid" was already a member on "conn"
+            Group, when normal
+        """
+        if not msock.valid_topic(tpc) or policy not in _group_policies:
+            return None
+        with self.lock:
+            groups = self.groups.get(tpc, ())
+            group = next((g for g in groups if g.name == name), None)
+            if group is not None and sid in group.conns:
+                if group.conns[sid] is conn:
+                    return False
+                old = group.conns[sid]
+                pairs = self.by_conn.get(old)
+                if pairs is not None:
+                    pairs.discard((tpc, sid, name))
+                    if not pairs:
+                        del self.by_conn[old]
+            if group is None:
+                group = Group(tpc, name, policy)
+                self.groups[tpc] = groups + (group,)
+            group.conns[sid] = conn
+            self.by_conn.setdefault(conn, set()).add((tpc, sid, name))
+            group.rebalance()
+        return group
+
+    def leave(self, tpc, name, sid):
+        """
+        Removes "sid" from consumer group "name" of topic "tpc".
+        Returns:
+            None,  if "sid" was not a member
+            Group, when normal, rebalanced over the members left
+        """
+        with self.lock:
+            group = next((g for g in self.groups.get(tpc, ()) if g.name == name), None)
+            if group is None or sid not in group.conns:
+                return None
+            self._leave(group, sid)
+        return group
+
+    def drop(self, conn):
+        """
+        Removes every subscription made on connection "conn".
+        Returns:
+            [(tpc, sid) or (tpc, sid, group name), ..], the subscriptions
+            and group memberships removed
+        """
+        with self.lock:
+            pairs = self.by_conn.pop(conn, ())
+            for pair in pairs:
+                if len(pair) == 3:
+                    self._drop_member(conn, *pair)
+                    continue
+                tpc, sid = pair
+                subs = self.members.get(tpc)
+                if subs is not None and subs.get(sid) is conn:
+                    self._remove(tpc, subs, sid)
+        return list(pairs)
+
+    def _remove(self, tpc, subs, sid):
+        conn = subs.pop(sid)
+        self._drop_filter(tpc, sid)
+        pairs = self.by_conn.get(conn)
+        if pairs is not None:
+            pairs.discard((tpc, sid))
+            if not pairs:
+                del self.by_conn[conn]
+        self._invalidate(tpc)
+        if not subs:
+            del self.members[tpc]
+            if msock.is_pattern(tpc):
+                self._remove_pattern(tpc)
+
+    def _drop_filter(self, tpc, sid):
+        index = self.filters.get(tpc)
+        if index is not None:
+            index.remove(sid)
+            if not index:
+                del self.filters[tpc]
+                if not self.filters:
+                    self.indexes.clear()
+
+    def _drop_member(self, conn, tpc, sid, name):
+        for group in self.groups.get(tpc, ()):
+            if group.name == name and group.conns.get(sid) is conn:
+                self._leave(group, sid)
+
+    def _leave(self, group, sid):
+        conn = group.conns.pop(sid)
+        pairs = self.by_conn.get(conn)
+        if pairs is not None:
+            pairs.discard((group.tpc, sid, group.name))
+            if not pairs:
+                del self.by_conn[conn]
+        group.rebalance()
+        if not group.conns:
+            groups = tuple(g for g in self.groups[group.tpc] if g is not group)
+            if groups:
+                self.groups[group.tpc] = groups
+            else:
+                del self.groups[group.tpc]
+
+    def _invalidate(self, tpc):
+        if msock.is_pattern(tpc):
+            for t in self.uses.pop(tpc, ()):
+                self.snapshot.pop(t, None)
+                self.indexes.pop(t, None)
+        else:
+            self.snapshot.pop(tpc, None)
+            self.indexes.pop(tpc, None)
+
+    def _add_pattern(self, pattern):
+        """
+        Adds "pattern" to the trie and drops the snapshots it now matches.
+        """
+        node = self.trie
+        levels = pattern.split(msock._tpc_sep)
+        for level in levels:
+            node = node.children.setdefault(level, _Node())
+        node.pattern = pattern
+        self.npatterns += 1
+        for tpc in self._cached(levels):
+            self.snapshot.pop(tpc, None)
+            self.indexes.pop(tpc, None)
+
+    def _cached(self, levels):
+        """
+        Returns:
+            [tpc, ..], the topics of the trie of "topics" matching
+            pattern "levels"
+        """
+        nodes = [self.topics]
+        for level in levels:
+            if level == msock._wild_many:       # the last level, "a.#" matching "a" too
+                found = []
+                while nodes:
+                    node = nodes.pop()
+                    if node.pattern is not None:
+                        found.append(node.pattern)
+                    nodes.extend(node.children.values())
+                return found
+            if level == msock._wild_one:
+                nodes = [child for node in nodes for child in node.children.values()]
+            else:
+                nodes = [node.children[level] for node in nodes if level in node.children]
+        return [node.pattern for node in nodes if node.pattern is not None]
+
+    def _remove_pattern(self, pattern):
+        """
+        Removes "pattern" from the trie, with the nodes left unused.
+        """
+        levels = pattern.split(msock._tpc_sep)
+        path = [self.trie]
+        for level in levels:
+            path.append(path[-1].children[level])
+        path[-1].pattern = None
+        for i in range(len(levels), 0, -1):
+            if path[i].children or path[i].pattern is not None:
+                break
+            del path[i - 1].children[levels[i - 1]]
+        self.npatterns -= 1
+
+    def conns(self):
+        """
+        Returns:
+            [(sid, conn), ..], one per connection with subscriptions
+        """
+        with self.lock:
+            return [(next(iter(pairs))[1], conn) for conn, pairs in self.by_conn.items()]
+
+    def __len__(self):
+        return len(self.members)
@@ -0,0 +1,171 @@
+import array
+from collections import OrderedDict
+
+#-------
+# Global settings
+#-------
+
+_ring_msgs   = 0                                # messages kept per topic, 0 for no rings
+_ring_bytes  = 1 << 20                          # payload bytes kept per topic at most
+_ring_memory = 256 << 20                        # bytes of all the rings, the coldest dropped past it
+_min_bytes   = 256                              # first buffer of a ring, doubled as it fills
+_index_bytes = 8                                # per message kept, its start and length
+
+#-------
+# Ring of a topic
+#-------
+
+class TopicRing:
+    """
+    The last messages published to a topic, at most "max_msgs" of them
+    and "max_bytes" payload bytes (under 4 GB), copied one after the other
+    into a single bytearray used as a circular buffer: a payload not
+    fitting before its end is written back at its start, and the oldest
+    payloads it overwrites are dropped. Their starts and lengths are kept
+    in two arrays, oldest first from index "head", trimmed once half of
+    them are dropped, so a message costs its payload and 8 bytes.
+    The buffer starts small and doubles as the payloads kept need it, up
+    to "max_bytes". "memory" accounts for the buffer and the arrays.
+    """
+
+    def __init__(self, max_msgs=_ring_msgs, max_bytes=_ring_bytes):
+        self.max_msgs  = max_msgs
+        self.max_bytes = max_bytes
+        self.buf    = bytearray(min(_min_bytes, max_bytes))
+        self.starts = array.array('I')
+        self.lens   = array.array('I')
+        self.head   = 0                         # index of the oldest message in "starts" and "lens"
+        self.count  = 0                         # messages kept, from "head" on
+        self.end    = 0                         # where the next payload is written in "buf"
+        self.nbytes = 0                         # payload bytes kept
+        self.memory = len(self.buf)
+
+    def __len__(self):
+        return self.count
+
+    def drop(self):
+        """
+        Drops the oldest message.
+        """
+        self.nbytes -= self.lens[self.head]
+        self.head += 1
+        self.count -= 1
+        if self.count == 0 or self.head >= 64 and self.head >= self.count:
+            del self.starts[:self.head], self.lens[:self.head]
+            self.memory -= self.head * _index_bytes
+            self.head = 0
+
+    def grow(self, n):
+        """
+        Doubles the buffer, at least to fit "n" more bytes, at most to
+        "max_bytes", copying the payloads kept to its start.
+        """
+        buf = bytearray(min(self.max_bytes, max(2 * len(self.buf), self.nbytes + n)))
+        o = 0
+        for i in range(self.head, len(self.starts)):
+            s, l = self.starts[i], self.lens[i]
+            buf[o:o + l] = self.buf[s:s + l]
+            self.starts[i] = o
+            o += l
+        self.memory += len(buf) - len(self.buf)
+        self.buf, self.end = buf, o
+
+    def append(self, payload):
+        """
+        Keeps a copy of "payload", the newest message, dropping the oldest
+        ones to make room. A payload larger than "max_bytes" is not kept,
+        and neither is anything older, no longer the last messages.
+        """
+        n = len(payload)
+        if n > self.max_bytes:
+            while self.count:
+                self.drop()
+            return
+        while self.count >= self.max_msgs:
+            self.drop()
+        if not self.count:
+            self.end = 0
+        if self.end + n > len(self.buf):
+            if len(self.buf) < self.max_bytes:
+                self.grow(n)
+            if self.end + n > len(self.buf):    # wraps, dropping those after the end
+                while self.count and self.starts[self.head] >= self.end:
+                    self.drop()
+                self.end = 0
+        start, end = self.end, self.end + n
+        while self.count and start <= self.starts[self.head] < end:
+            self.drop()
+        self.buf[start:end] = payload
+        self.starts.append(start)
+        self.lens.append(n)
+        self.count += 1
+        self.end = end
+        self.nbytes += n
+        self.memory += _index_bytes
+
+    def last(self, k):
+        """
+        Returns:
+            [bytes, ..], copies of the last "k" payloads, oldest first
+        """
+        first = len(self.starts) - min(k, self.count)
+        return [bytes(self.buf[self.starts[i]:self.starts[i] + self.lens[i]])
+                for i in range(first, len(self.starts))]
+
+#-------
+# Rings of every topic
+#-------
+
+class RingStore:
+    """
+    TopicRings of the topics published to, each one created on the first
+    message of its topic, along with the memory they take, the sum of
+    their TopicRing.memory. Past "max_memory" the rings of the topics
+    published to least recently are dropped, whole, until back under it;
+    their next message starts them over.
+    Not locked: the threads broker serializes the calls (see broker.py).
+    """
+
+    def __init__(self, max_msgs=_ring_msgs, max_bytes=_ring_bytes, max_memory=_ring_memory):
+        self.max_msgs   = max_msgs
+        self.max_bytes  = max_bytes
+        self.max_memory = max_memory
+        self.rings   = OrderedDict()            # tpc --> TopicRing, published to least recently first
+        self.memory  = 0
+        self.evicted = 0                        # rings dropped for "max_memory"
+
+    def __len__(self):
+        return len(self.rings)
+
+    def append(self, tpc, payload):
+        """
+        Keeps "payload", the newest message of topic "tpc" (str).
+        """
+        ring = self.rings.get(tpc)
+        if ring is None:
+            ring = self.rings[tpc] = TopicRing(self.max_msgs, self.max_bytes)
+            before = 0
+        else:
+            self.rings.move_to_end(tpc)
+            before = ring.memory
+        ring.append(payload)
+        self.memory += ring.memory - before
+        while self.memory > self.max_memory and len(self.rings) > 1:
+            _, cold = self.rings.popitem(last=False)
+            self.memory -= cold.memory
+            self.evicted += 1
+
+    def last(self, tpc, k):
+        """
+        Returns:
+            [bytes, ..], the last "k" payloads kept of topic "tpc", oldest first
+        """
+        ring = self.rings.get(tpc)
+        return ring.last(k) if ring is not None else []
+
+    def stats(self):
+        """
+        Returns:
+            [(tpc, msgs, payload bytes, memory), ..], of every ring
+        """
+        return [(tpc, r.count, r.nbytes, r.memory) for tpc, r in list(self.rings.items())]
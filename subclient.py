@@ -0,0 +1,414 @@
+import time
+import asyncio
+import collections
+import my_sock as msock
+import compress
+
+#-------
+# Global settings
+#-------
+
+_retry_secs     = 0.5                           # first wait before reconnecting, doubled each time
+_retry_max_secs = 8.0                           # up to this
+_queue_msgs     = 10000                         # messages a messages() iterator holds unconsumed
+_line_limit     = 1 << 24                       # longest text message read
+
+# A message received: topic (str), payload (bytes), offset, the log
+# offset of a replayed binary message, else None, and headers, the
+# my_sock.Headers of a live message when asked for, else None
+Message = collections.namedtuple('Message', 'topic payload offset headers', defaults=(None,))
+
+#-------
+# Asyncio subscriber client
+#-------
+
+class Subscriber:
+    """
+    Asyncio client of the subscriber port of a broker, as subscriber "sid",
+    asking for binary frames with "binary". subscribe(), unsubscribe() and
+    fetch() return once the broker acked them; the messages received are
+    handed to the callbacks registered with on(), and to the iterators of
+    messages(), of every topic or pattern they match.
+    Once the connection is lost it connects again, unless not "reconnect",
+    waiting "_retry_secs" and twice as long each time up to "_retry_max_secs",
+    and subscribes again to what it was subscribed to; a subscription from
+    an offset then resumes from the offset the broker committed for "sid",
+    one to the 'last K' messages gets them again.
+    Commands pending when the connection is lost raise ConnectionError.
+    With "compression", "zlib" or "zstd", binary messages may come
+    compressed, with the dictionaries of "dict_dir" if given (see
+    compress.py), and are decompressed before they are handed over.
+    With "headers", along with "binary", live messages come with their
+    headers: priority, producer id and key, and the times they were
+    published, read by the broker and written out to this subscriber
+    (see hops()).
+    With "ping_secs" it pings the broker every "ping_secs", if it agrees,
+    and counts the connection as lost once the broker, answering pings
+    if nothing else, was silent for my_sock._ping_grace pings (see ping()).
+    """
+
+    def __init__(self, host, port, sid, binary=False, reconnect=True, compression=None, dict_dir=None,
+                 headers=False, ping_secs=None):
+        self.host      = host
+        self.port      = port
+        self.sid       = sid
+        self.binary    = binary
+        self.reconnect = reconnect
+        self.compression = compression
+        self.dicts     = compress.Dictionaries(dict_dir) if dict_dir else None
+        self.headers   = headers
+        self.ping_secs = ping_secs
+        self.heard     = 0.0                    # time.monotonic() of the last read from the broker
+        self.framed    = False                  # binary frames negotiated
+        self.hdr       = False                  # headers negotiated
+        self.pinging   = False                  # pings negotiated
+        self.codec     = None                   # codec negotiated, "zlib" or "zstd"
+        self.reader    = None                   # asyncio.StreamReader, while connected
+        self.writer    = None
+        self.task      = None                   # running run()
+        self.closed    = False
+        self.subs      = {}                     # (tpc, group) --> options, acked subscriptions
+        self.handlers  = {}                     # tpc --> [callback or asyncio.Queue, ..]
+        self.acks      = collections.deque()    # futures of "sub" / "unsub", None if unawaited
+        self.fetches   = collections.deque()    # futures of "fetch"
+
+    async def connect(self):
+        """
+        Connects to the broker and starts reading from it.
+        Raises:
+            OSError, if the broker cannot be reached
+        """
+        await self.open()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def open(self):
+        """
+        Opens the connection, negotiating binary frames, compression,
+        headers and pings, if asked to.
+        """
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port,
+                                                                 limit=_line_limit)
+        self.framed = self.hdr = self.pinging = False
+        self.codec  = None
+        self.heard  = time.monotonic()
+        opts = []
+        if self.binary:
+            opts += [msock._opt_bin] + [msock._opt_hdr] * self.headers
+        if self.binary and self.compression:
+            opts += [self.compression] + [msock._opt_dict] * bool(self.dicts)
+        if self.ping_secs:
+            opts += ['%s%s%d' % (msock._opt_ping, msock._opt_sep, self.ping_secs)]
+        if not opts:
+            return
+        self.writer.write(bytes('%s %s %s%s' % (self.sid, msock._hello, ' '.join(opts),
+                                                msock._delim), msock._str_enc))
+        words = str(await self.reader.readline(), msock._str_enc).split()
+        if not words or words[0] != msock._ack:
+            self.writer.close()
+            raise ConnectionError("invalid reply to %s" % msock._hello)
+        self.framed = msock._opt_bin in words[1:]
+        self.hdr    = msock._opt_hdr in words[1:]
+        self.codec  = next((o for o in words[1:] if o in compress._codecs), None)
+        self.pinging = msock.ping_secs(words[1:]) is not None
+
+    async def close(self):
+        """
+        Closes the connection for good, ending the messages() iterators.
+        """
+        self.closed = True
+        if self.writer is not None:
+            self.writer.close()
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        self.lost()
+        for hs in self.handlers.values():
+            for h in hs:
+                if isinstance(h, asyncio.Queue):
+                    end(h)
+
+    #------
+
+    async def subscribe(self, tpc, options=None, callback=None):
+        """
+        Subscribes to topic or pattern "tpc"; "options" are the words
+        after the topic of "sid sub tpc", e.g. "from earliest", "last 1"
+        or "group name key-hash". With "callback" also calls it on every
+        message of "tpc" (see on()).
+        """
+        if callback is not None:
+            self.on(tpc, callback)
+        await self.command('sub', tpc, options)
+        self.subs[(tpc, group_of(options))] = options
+
+    async def unsubscribe(self, tpc, options=None):
+        """
+        Unsubscribes from topic or pattern "tpc", or with "options"
+        "group name" leaves that consumer group.
+        """
+        await self.command('unsub', tpc, options)
+        self.subs.pop((tpc, group_of(options)), None)
+
+    async def fetch(self, tpc, offset):
+        """
+        Replays the logged messages of topic "tpc" from "offset" on, as
+        much as the broker sends at once, handed over as any message.
+        Returns:
+            the offset to fetch next
+        """
+        return await self.command('fetch', tpc, offset)
+
+    def on(self, tpc, callback):
+        """
+        Calls "callback(Message)" on every message of topic or pattern "tpc",
+        in the order received; a coroutine function is run as a task.
+        """
+        self.handlers.setdefault(tpc, []).append(callback)
+
+    def off(self, tpc, callback):
+        """
+        Stops calling a callback registered with on().
+        """
+        hs = self.handlers.get(tpc, [])
+        if callback in hs:
+            hs.remove(callback)
+        if not hs:
+            self.handlers.pop(tpc, None)
+
+    async def messages(self, tpc):
+        """
+        Iterates over the messages of topic or pattern "tpc" received from
+        now on, until close(). While "_queue_msgs" messages wait for the
+        iteration, reading from the broker waits too.
+        """
+        q = asyncio.Queue(_queue_msgs)
+        self.on(tpc, q)
+        try:
+            while True:
+                msg = await q.get()
+                if msg is None:
+                    return
+                yield msg
+        finally:
+            self.off(tpc, q)
+
+    #------
+
+    async def command(self, cmd, tpc, arg=None):
+        """
+        Sends "sub", "unsub" or "fetch", and waits for its ack.
+        Returns:
+            None, for "sub" and "unsub"
+            the offset to fetch next, for "fetch"
+        Raises:
+            ConnectionError, if not connected or disconnected meanwhile
+        """
+        if self.writer is None:
+            raise ConnectionError("not connected to the broker")
+        fut = asyncio.get_running_loop().create_future()
+        self.send(cmd, tpc, arg, fut)
+        return await fut
+
+    def send(self, cmd, tpc, arg, fut):
+        """
+        Writes a command, "fut" being the future of its ack, or None.
+        Fetches are acked with an offset, apart from "sub" and "unsub", as
+        the broker may ack these before the replies of earlier fetches.
+        """
+        (self.fetches if cmd == 'fetch' else self.acks).append(fut)
+        if self.framed and cmd == 'fetch':
+            self.writer.write(msock.encode_frame(cmd, tpc, seq=arg))
+        elif self.framed:
+            self.writer.write(msock.encode_frame(cmd, tpc, arg or b''))
+        else:
+            words = (self.sid, cmd, tpc) if arg is None else (self.sid, cmd, tpc, str(arg))
+            self.writer.write(bytes(' '.join(words) + msock._delim, msock._str_enc))
+
+    async def run(self):
+        """
+        Reads from the broker until closed, connecting again when lost.
+        """
+        while not self.closed:
+            pinger = None
+            if self.pinging:
+                pinger = asyncio.get_running_loop().create_task(self.ping(self.writer))
+            try:
+                await self.read()
+            except (OSError, EOFError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                pass
+            finally:
+                if pinger is not None:
+                    pinger.cancel()
+            self.lost()
+            if self.closed or not self.reconnect:
+                return
+            await self.resume()
+
+    async def ping(self, writer):
+        """
+        Pings the broker every "ping_secs" over "writer", the connection it
+        was started for, aborting it once nothing was read from the broker
+        for my_sock._ping_grace pings, for run() to connect again.
+        """
+        while True:
+            await asyncio.sleep(self.ping_secs)
+            if time.monotonic() - self.heard > self.ping_secs * msock._ping_grace:
+                print("Subscriber> Broker silent for too long, disconnecting")
+                writer.transport.abort()
+                return
+            if self.framed:
+                writer.write(msock.encode_frame(msock._ping))
+            else:
+                writer.write(bytes('%s %s%s' % (self.sid, msock._ping, msock._delim), msock._str_enc))
+
+    async def read(self):
+        """
+        Reads messages and acks until the connection is closed, and the
+        answers of the broker to ping(), only heard.
+        """
+        reader = self.reader
+        while True:
+            if self.framed:
+                hdr = await reader.readexactly(msock._bin_hdr.size)
+                _, _, tlen, elen, plen = msock._bin_hdr.unpack(hdr)
+                cmd, flags, tpc, ext, payload = msock.decode_frame(
+                    hdr + await reader.readexactly(tlen + elen + plen))
+                self.heard = time.monotonic()
+                seq = msock.frame_seq(flags, ext)
+                if cmd == msock._pong:
+                    continue
+                if cmd == msock._ack:
+                    self.acked(seq)
+                    continue
+                if flags & compress._zip_flags:
+                    payload = compress.unpack(flags, ext, payload, self.dicts)
+                    if payload is None:
+                        print("Subscriber> Cannot decompress a message of %s, dropped" %
+                              str(tpc, msock._str_enc))
+                        continue
+                await self.dispatch(Message(str(tpc, msock._str_enc), bytes(payload), seq,
+                                            msock.frame_headers(flags, ext)))
+                continue
+            line = await reader.readuntil(msock._bdelim)
+            self.heard = time.monotonic()
+            smsg = str(line, msock._str_enc).strip()
+            if smsg == msock._pong:
+                continue
+            ack = msock.parse_ack(smsg)
+            if ack is not None:                 # _ack OR _ack next offset of "fetch"
+                self.acked(None if smsg == msock._ack else ack)
+                continue
+            tpc, _, msg = smsg.partition(' ')
+            await self.dispatch(Message(tpc, bytes(msg, msock._str_enc), None))
+
+    def acked(self, offset):
+        """
+        Resolves the oldest pending "sub" or "unsub", or with "offset" the
+        oldest pending "fetch".
+        """
+        pending = self.acks if offset is None else self.fetches
+        if pending:
+            fut = pending.popleft()
+            if fut is not None and not fut.done():
+                fut.set_result(offset)
+
+    async def dispatch(self, msg):
+        """
+        Hands a message to the callbacks and iterators of every topic or
+        pattern it matches.
+        """
+        for tpc, hs in list(self.handlers.items()):
+            if not msock.matches(tpc, msg.topic):
+                continue
+            for h in list(hs):
+                if isinstance(h, asyncio.Queue):
+                    await h.put(msg)
+                    continue
+                res = h(msg)
+                if asyncio.iscoroutine(res):
+                    asyncio.get_running_loop().create_task(res)
+
+    def lost(self):
+        """
+        Forgets the connection, failing the commands still pending.
+        """
+        if self.writer is not None:
+            self.writer.close()
+            print("Subscriber> Disconnected from broker")
+        self.reader = self.writer = None
+        for pending in (self.acks, self.fetches):
+            while pending:
+                fut = pending.popleft()
+                if fut is not None and not fut.done():
+                    fut.set_exception(ConnectionError("disconnected from the broker"))
+
+    async def resume(self):
+        """
+        Connects again, until it succeeds or is closed, then subscribes again
+        to what it was subscribed to, without waiting for the acks.
+        """
+        delay = _retry_secs
+        while not self.closed:
+            await asyncio.sleep(delay)
+            try:
+                await self.open()
+                break
+            except OSError:
+                delay = min(delay * 2, _retry_max_secs)
+        if self.closed:
+            return
+        print("Subscriber> Reconnected to broker, subscribing again to %d topics" % len(self.subs))
+        for (tpc, group), options in self.subs.items():
+            opts = msock.sub_options(options.split(' ')) if options else None
+            if opts is not None and opts[0] is not None and msock.last_count(opts[0]) is None:
+                options = None                  # resume from the committed offset
+            self.send('sub', tpc, options, None)
+
+#------
+
+def group_of(options):
+    """
+    Returns:
+        the consumer group named in subscription "options", None if none
+    """
+    opts = msock.sub_options(options.split(' ')) if options else None
+    return opts[1] if opts is not None else None
+
+#------
+
+def end(q):
+    """
+    Ends the messages() iteration over queue "q".
+    """
+    try:
+        q.put_nowait(None)
+    except asyncio.QueueFull:
+        asyncio.get_running_loop().create_task(q.put(None))
+
+#------
+
+def hops(msg, received=None):
+    """
+    Breaks down the latency of a Message received with headers, at
+    "received" usecs since the epoch, or now (see my_sock.now_us()), into
+    its hops. Times of different hosts compare only as well as their
+    clocks are in sync.
+    Returns:
+        None,                     if the message has no headers
+        (publish, broker, write), the usecs from being published to being
+                                  read by the broker, from then to being
+                                  written out to this subscriber, and from
+                                  then to being received, None for a hop
+                                  whose start is unknown
+    """
+    h = msg.headers
+    if h is None:
+        return None
+    if received is None:
+        received = msock.now_us()
+    return (h.ingress - h.published if h.published and h.ingress else None,
+            h.egress - h.ingress if h.ingress and h.egress else None,
+            received - h.egress if h.egress else None)
@@ -1,10 +1,13 @@
 #!/usr/bin/python3
 
 import sys
-import time 
+import asyncio
 import my_sock as msock
+import subclient
+import compress
+import filters
+import loops
 import argparse
-import threading
 
 #------- 
 # Global settings
@@ -15,12 +18,15 @@ _sub_port = None
 _host     = "localhost"
 _broker_port = None
 _sub_file    = None
+_binary      = False                        # binary frames asked with "-b"
+_compression = None                         # codec asked with "-z", along with "-b"
+_dict_dir    = None                         # compression dictionaries, "-d"
+_headers     = False                        # headers asked with "-t", along with "-b"
+_ping_secs   = None                         # secs between pings of the broker, "-k"
+_loop        = loops._loop                  # event loop run on, "-l"
 
 _sub_cmds = []                              # commands in the file
-_sock = None                                # socket to broker
-
-_num_smsgs = 0                              # for ensuring that messages to broker
-_num_acks  = 0                              # are sent after acks of previous messages
+_client   = None                            # subclient.Subscriber connected to the broker
 
 
 #------- 
@@ -28,7 +34,8 @@ _num_acks  = 0                              # are sent after acks of previous me
 #-------
 
 def parse_args ():
-    global  _sub_id, _sub_port, _host, _broker_port, _sub_file
+    global  _sub_id, _sub_port, _host, _broker_port, _sub_file, _binary, _compression, _dict_dir
+    global  _headers, _ping_secs, _loop
     
     parser  = argparse.ArgumentParser()
     parser.add_argument('-i', type=str, metavar='ID', nargs=1, required=True,
@@ -50,6 +57,27 @@ def parse_args ():
     parser.add_argument('-f', type=argparse.FileType('r'), metavar='file', nargs=1, 
                               dest='sub_file', 
                               help='Sub commands to execute')
+
+    parser.add_argument('-b', action='store_true', dest='binary',
+                              help='Use binary frames, if the broker supports them')
+
+    parser.add_argument('-z', type=str, metavar='codec', default=None,
+                              choices=tuple(compress._codecs), dest='compression',
+                              help='Receive binary frames compressed with codec, if the broker supports it')
+
+    parser.add_argument('-d', type=str, metavar='dir', default=None,
+                              dest='dict_dir',
+                              help='Compression dictionaries of the topics (see compress.py)')
+
+    parser.add_argument('-t', action='store_true', dest='headers',
+                              help='Receive the headers of binary messages, printing their latency per hop')
+    parser.add_argument('-k', type=int, metavar='secs', default=None,
+                              dest='ping_secs',
+                              help='Ping the broker every secs, reconnecting once it stays silent')
+    parser.add_argument('-l', type=str, metavar='loop', default=_loop,
+                              choices=loops.available(), dest='loop',
+                              help='Event loop to run on, of %s (default %%(default)s)' %
+                                   ', '.join(loops.available()))
     
     d = parser.parse_args()
 
@@ -58,6 +86,12 @@ def parse_args ():
     _host        = d.broker_ip[0]
     _broker_port = d.broker_port[0]
     _sub_file    = d.sub_file[0].name
+    _binary      = d.binary
+    _compression = d.compression
+    _dict_dir    = d.dict_dir
+    _headers     = d.headers
+    _ping_secs   = d.ping_secs
+    _loop        = d.loop
 
 #------
 
@@ -66,7 +100,7 @@ def get_file_cmds():
     """
     Reads a passed file containing the subscriber's commands and stores the
     commands in global variable "_sub_cmds":
-        [(sleep, cmd, tpc), ..]
+        [(sleep, cmd, tpc, arg), ..]
     """
     global _sub_cmds
     
@@ -90,15 +124,22 @@ def parse_command (cmd):
     The command should be:
         sleep     --> int
         what      --> str 
-        topic     --> str
+        topic     --> str, a topic or a pattern as "orders.*.eu" or "orders.#"
+        arg       --> for 'fetch', int, the offset of the first logged message to replay
+                      for 'sub', optional 'from' and an offset, 'earliest' or 'latest',
+                      or 'last' and the number of the last messages kept to get first,
+                      or 'where' and the predicates of a filter, e.g. 'status=ok,pending amount>=100'
+                      for 'sub' or 'unsub', optional 'group' and a group name, then
+                      for 'sub' an optional policy: round-robin, least-outstanding, key-hash
             OR
         'quit'
     It also validates the above expected structure.
     
     Returns:
-        - None                      invalid command
-        - (slp, what, tpc)          valid   command, not 'quit'
-        - (0, 'quit', '')           valid   command, if  'quit'
+        - None                          invalid command
+        - (slp, what, tpc, arg)         valid   command, not 'quit', arg None if not given,
+                                        else the words after the topic for 'sub'/'unsub'
+        - (0, 'quit', '', None)         valid   command, if  'quit'
     """
     words  = cmd.split(' ')
     nwords = len(words)
@@ -108,7 +149,7 @@ def parse_command (cmd):
             print('Subscriber> Invalid command, expected (single) <quit>')
             return None
         
-        return 0, 'quit', ''
+        return 0, 'quit', '', None
     
     if nwords < 3:
         print('Subscriber> Invalid command, expected at least 3 words')
@@ -117,43 +158,65 @@ def parse_command (cmd):
     if not words[0].isnumeric():
         print('Subscriber> Invalid command, first word (sleep time) should be int')
         return None
+
+    if words[1] == 'fetch':
+        if nwords != 4 or not words[3].isdigit() or not msock.valid_topic(words[2]):
+            print('Subscriber> Invalid command, expected <sleep fetch topic offset>')
+            return None
+        return int(words[0]), words[1], words[2], int(words[3])
+
+    if nwords > 3 and words[3] in ('from', 'group', msock._last, msock._where):
+        opts = msock.sub_options(words[3:])
+        pattern = opts is not None and (msock.last_count(opts[0]) is not None or opts[3] is not None)
+        if (opts is None or not msock.valid_topic(words[2], pattern=pattern) or
+                opts[3] is not None and (words[1] != 'sub' or filters.parse(opts[3]) is None) or
+                words[1] != 'sub' and (words[1] != 'unsub' or opts[1] is None or opts[2])):
+            print('Subscriber> Invalid command, expected <sleep sub topic from offset|earliest|latest>,'
+                  ' <sleep sub topic last K>, <sleep sub topic where field=value|field>n ..>'
+                  ' or <sleep sub|unsub topic group name [policy]>')
+            return None
+        return int(words[0]), words[1], words[2], ' '.join(words[3:])
+
+    tpc = ' '.join(words[2:])
+    if not msock.valid_topic(tpc, pattern=True):
+        print('Subscriber> Invalid command, bad topic pattern %s' % tpc)
+        return None
     
-    return int(words[0]), words[1], ' '.join(words[2:])
+    return int(words[0]), words[1], tpc, None
 
-#------- 
-# Thread for reading from broker the published messages in the topics of interest
+#------
+# Handling the messages from the broker
 #-------
 
-def readthread ():
+def print_msg (msg):
     """
-    Reads from established socket to the broker the messages from the publishers
-    published for a topic where the subscriber has expressed interest.
+    Prints a message from the publishers, published for a topic where the
+    subscriber has expressed interest, and its headers, if any, with the
+    usecs it took from the publisher to the broker, through the broker
+    and to the subscriber.
     """
-    global _num_acks 
-    
-    while True:
-        smsg = msock.read_from_socket(_sock)      # tpc msg OR _ack
-        if smsg is None:
-            print("Subscriber> Disconnected from broker, cannot read from broker")
-            break
-        print("Subscriber> Received from broker <%s>" % smsg)    
-
-        words = smsg.split(' ')
-        if len(words) == 1:                     # _ack
-            _num_acks += 1
-            continue                            
-        tpc, msg = words[0], ' '.join(words[1:])
-        print("Subscriber> Received msg for topic %s: %s" % (tpc, msg))
+    text = str(msg.payload, msock._str_enc, 'replace')
+    if msg.offset is not None:
+        print("Subscriber> Received msg #%d for topic %s: %s" % (msg.offset, msg.topic, text))
+    else:
+        print("Subscriber> Received msg for topic %s: %s" % (msg.topic, text))
+    if msg.headers is not None:
+        h = msg.headers
+        usecs = ['-' if us is None else '%d' % us for us in subclient.hops(msg)]
+        print("\t\tpriority %d, producer %s%s, usecs to broker/through broker/to sub: %s" %
+              (h.priority, str(h.producer, msock._str_enc, 'replace'),
+               ', key %s' % str(h.key, msock._str_enc, 'replace') if h.key is not None else '',
+               '/'.join(usecs)))
 
 #------
 # Running the subscriber
 #-------
 
-def exec_file_cmds():
+async def exec_file_cmds():
     """
     Executes the commands found in the passed file, if any.
     The commands in the file are stored in the global var "_sub_cmds":
-        [(sleep, cmd, tpc), ..]
+        [(sleep, cmd, tpc, arg), ..]
     """
     print("Subscriber> Ready to exec %d commands" % len(_sub_cmds))
     i = 0
@@ -166,45 +229,56 @@ def exec_file_cmds():
             print("\t\tSkipping invalid command")
             continue
         
-        exec_cmd(cmd)
+        await exec_cmd(cmd)
         
 #------
 
-def exec_cmd (cmd):
+async def exec_cmd (cmd):
     """
-    Executes a command from file or keyboard:
-        sleep, what, tpc
+    Executes a command from file or keyboard, once the previous one has
+    been acked:
+        sleep, what, tpc, arg
     """
-    global _num_smsgs
-    slp, what, tpc = cmd
-    
-    while _num_acks < _num_smsgs:
-        print("\t\tWaiting to receive ack of previous msgs sent to broker")
-        time.sleep(1)
+    slp, what, tpc, arg = cmd
         
     print("\t\tSleeping for %d secs" % slp)
-    time.sleep(slp)
+    await asyncio.sleep(slp)
     
-    print("\t\tSubscribing to topic %s" % tpc)
-    smsg = ' '.join((_sub_id, what, tpc))
-    n = msock.write2socket(_sock, smsg)
-    if n == -1:
-        print("Subscriber> Cannot write to socket .. Quiting")   
-        sys.exit(-2)
+    if what == 'fetch':
+        print("\t\tFetching topic %s from offset %d" % (tpc, arg))
+    elif arg is not None:
+        print("\t\t%s topic %s %s" % (what, tpc, arg))
+    else:
+        print("\t\t%s %s %s" % (what, "pattern" if msock.is_pattern(tpc) else "topic", tpc))
+    try:
+        if what == 'fetch':
+            print("Subscriber> Fetched up to offset %d" % await _client.fetch(tpc, arg))
+        elif what == 'sub':
+            await _client.subscribe(tpc, arg)
+        elif what == 'unsub':
+            await _client.unsubscribe(tpc, arg)
+        else:
+            print("Subscriber> Invalid command %s" % what)
+    except ConnectionError:
+        print("Subscriber> Cannot send to broker, not connected")
     
-    _num_smsgs += 1
-        
 #------
 
-def exec_keyboard_commands ():
+async def exec_keyboard_commands ():
     """
     Executes the commands entered from keyboard:
-        sleep, cmd, tpc
+        sleep, cmd, tpc [offset | from offset | last K | where pred .. | group name [policy]]
             OR
         quit
     """
+    loop = asyncio.get_running_loop()
     while 1:
-        cmd = input('Enter: sleeptime, what, topic OR quit to quit> ')
+        try:
+            cmd = await loop.run_in_executor(None, input,
+                'Enter: sleeptime, what, topic [offset | from offset | last K | group name [policy]] '
+                'OR quit to quit> ')
+        except EOFError:
+            break
         res = parse_command(cmd)
         
         if res is None:
@@ -214,25 +288,44 @@ def exec_keyboard_commands ():
         if res[1] == 'quit':
             break
         
-        exec_cmd(res)
+        await exec_cmd(res)
 
 #------
 
-if __name__ == "__main__":
-    parse_args()
-    get_file_cmds()
-    
-    _sock = msock.connect2socket(_host, _broker_port)
-    if _sock is None:
+async def main ():
+    """
+    Connects to the broker, printing every message received, and executes
+    the commands of the file and then of the keyboard.
+    """
+    global _client
+
+    _client = subclient.Subscriber(_host, _broker_port, _sub_id, _binary,
+                                   compression=_compression, dict_dir=_dict_dir, headers=_headers,
+                                   ping_secs=_ping_secs)
+    _client.on(msock._wild_many, print_msg)
+    try:
+        await _client.connect()
+    except OSError:
         print("Subscriber> Cannot connect to broker .. Quiting")
         sys.exit(-1)
+    if _binary:
+        print("Subscriber> Binary frames %s" % ("on" if _client.framed else "not supported"))
+    if _binary and _compression:
+        print("Subscriber> Compression %s" % (_client.codec or "not supported"))
+    if _binary and _headers:
+        print("Subscriber> Headers %s" % ("on" if _client.hdr else "not supported"))
+    
+    await exec_file_cmds()
+    await exec_keyboard_commands()
     
-    r_sub = threading.Thread(target=readthread)
-    r_sub.start()
-     
-    exec_file_cmds()   
-    exec_keyboard_commands()
+    await _client.close()
+
+#------
+
+if __name__ == "__main__":
+    parse_args()
+    get_file_cmds()
     
-    msock.term_socket(_sock)                    # readthread stops
+    loops.run(main(), _loop)
     
-    print("\nSubscriber> Bye")
\ No newline at end of file
+    print("\nSubscriber> Bye")
@@ -0,0 +1,9 @@
+import os
+import sys
+
+#-------
+# Unit tests of the broker modules, run with "python -m pytest -q"
+#-------
+
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, _root)
@@ -0,0 +1,77 @@
+import dedup
+
+#-------
+# Producers
+#-------
+
+def test_in_order_and_sent_again():
+    p = dedup.Producers(window=8)
+    assert [p.duplicate('a', s) for s in (1, 2, 3)] == [False, False, False]
+    assert p.duplicate('a', 3) and p.duplicate('a', 1)
+    assert not p.duplicate('b', 1)                  # per producer
+
+def test_out_of_order_within_window():
+    p = dedup.Producers(window=8)
+    assert not p.duplicate('a', 5)
+    assert not p.duplicate('a', 2)
+    assert p.duplicate('a', 2)
+    assert not p.duplicate('a', 4)
+
+def test_window_edges():
+    p = dedup.Producers(window=8)
+    assert not p.duplicate('a', 10)
+    assert not p.duplicate('a', 3)                  # 7 behind, last one in the window
+    assert p.duplicate('a', 2)                      # 8 behind, too old to tell
+    assert p.duplicate('a', 3)
+
+def test_jump_past_window():
+    p = dedup.Producers(window=8)
+    for s in range(1, 9):
+        p.duplicate('a', s)
+    assert not p.duplicate('a', 100)
+    assert not p.duplicate('a', 93)                 # its bit was not carried over
+    assert p.duplicate('a', 8)
+
+def test_least_recently_seen_forgotten():
+    p = dedup.Producers(window=8, max_producers=2)
+    p.duplicate('a', 1)
+    p.duplicate('b', 1)
+    p.duplicate('a', 2)                             # "b" is now the least recent
+    p.duplicate('c', 1)
+    assert len(p) == 2
+    assert p.duplicate('a', 1)
+    assert not p.duplicate('b', 1)                  # forgotten, seen as new
+
+#-------
+# KeyCache
+#-------
+
+def test_key_within_ttl():
+    k = dedup.KeyCache(secs=10)
+    assert not k.duplicate('t', b'k', now=100)
+    assert k.duplicate('t', b'k', now=109.9)
+    assert not k.duplicate('u', b'k', now=101)      # per topic
+
+def test_key_expires():
+    k = dedup.KeyCache(secs=10)
+    k.duplicate('t', b'k', now=100)
+    k.duplicate('t', b'j', now=105)
+    assert not k.duplicate('t', b'k', now=110)      # expired at 110, remembered again
+    assert len(k) == 2
+    assert not k.duplicate('t', b'x', now=116)      # "j" expired too
+    assert len(k) == 2
+
+def test_duplicates_do_not_extend_ttl():
+    k = dedup.KeyCache(secs=10)
+    k.duplicate('t', b'k', now=100)
+    assert k.duplicate('t', b'k', now=108)
+    assert not k.duplicate('t', b'k', now=111)
+
+def test_max_keys_drops_oldest():
+    k = dedup.KeyCache(secs=60, max_keys=2)
+    k.duplicate('t', b'a', now=0)
+    k.duplicate('t', b'b', now=1)
+    k.duplicate('t', b'c', now=2)
+    assert len(k) == 2
+    assert not k.duplicate('t', b'a', now=3)        # dropped though not expired
+    assert k.duplicate('t', b'c', now=3)
@@ -0,0 +1,119 @@
+import json
+import filters
+import registry
+
+def doc(**fields):
+    return filters.fields(json.dumps(fields).encode())
+
+#-------
+# Values and parsing
+#-------
+
+def test_literals_apart_from_strings():
+    assert filters.value_key(True) != filters.value_key('true')
+    assert filters.value_key(None) != filters.value_key('null')
+    assert filters.value_key(False) != filters.value_key('false')
+    assert filters.value_key(True) != filters.value_key(1)
+    assert filters.parse_value('true') == filters.value_key(True)
+    assert filters.parse_value('"true"') == filters.value_key('true')
+    assert filters.parse_value('"12"') == '12' and filters.parse_value('12') == 12.0
+
+def test_parse_invalid():
+    assert filters.parse([]) is None
+    assert filters.parse(['a']) is None
+    assert filters.parse(['=1']) is None
+    assert filters.parse(['a.=1']) is None
+    assert filters.parse(['a>x']) is None
+    assert len(filters.parse(['a=1', 'b>=2'])) == 2
+
+def test_fields():
+    assert filters.fields(b'[1]') is None
+    assert filters.fields(b'not json') is None
+    assert filters.fields(memoryview(b'{"a": 1}')) == {'a': 1}
+
+#-------
+# Filter
+#-------
+
+def test_matches():
+    f = filters.parse(['region=eu,us', 'qty>=10', 'item.kind="42"'])
+    assert f.matches(doc(region='eu', qty=10, item={'kind': '42'}))
+    assert not f.matches(doc(region='eu', qty=9, item={'kind': '42'}))
+    assert not f.matches(doc(region='asia', qty=10, item={'kind': '42'}))
+    assert not f.matches(doc(region='eu', qty=10, item={'kind': 42}))
+    assert not f.matches(doc(region='eu', qty=10))
+    assert not f.matches(None)
+
+def test_matches_literals():
+    assert filters.parse(['ok=true']).matches(doc(ok=True))
+    assert not filters.parse(['ok=true']).matches(doc(ok='true'))
+    assert filters.parse(['ok="true"']).matches(doc(ok='true'))
+    assert not filters.parse(['ok="true"']).matches(doc(ok=True))
+    assert filters.parse(['v=null']).matches(doc(v=None))
+    assert not filters.parse(['v=null']).matches(doc(v='null'))
+    assert not filters.parse(['v=null']).matches(doc())
+
+def test_range_non_number():
+    f = filters.parse(['qty<5'])
+    assert f.matches(doc(qty=4.5))
+    assert not f.matches(doc(qty='4'))
+    assert not f.matches(doc(qty=True))
+
+#-------
+# FilterIndex
+#-------
+
+def index(**flts):
+    idx = filters.FilterIndex()
+    for sid, words in flts.items():
+        idx.add(sid, 'c' + sid, filters.parse(words.split(' ')))
+    return idx
+
+def matched(idx, **fields):
+    return sorted(sid for sid, conn in idx.match(doc(**fields)))
+
+def test_index_equal_and_ranges():
+    idx = index(a='x=1', b='x=1,2', c='x>1', d='x>=1', e='x<2', f='x<=1', g='y=1')
+    assert matched(idx, x=1) == ['a', 'b', 'd', 'e', 'f']
+    assert matched(idx, x=2) == ['b', 'c', 'd']
+    assert matched(idx, x=0) == ['e', 'f']
+    assert matched(idx, y=1) == ['g']
+    assert matched(idx, x='1') == []
+
+def test_index_agrees_with_filters():
+    flts = {'a': 'x=1 y>3', 'b': 'x=true', 'c': 'x="true"', 'd': 'y<=3 z=null', 'e': 'p.q=a,b'}
+    idx = index(**flts)
+    for fields in ({'x': 1, 'y': 4}, {'x': 1, 'y': 3}, {'x': True}, {'x': 'true'}, {'y': 3, 'z': None},
+                   {'y': 3, 'z': 'null'}, {'p': {'q': 'b'}}, {'p': 'q'}):
+        want = sorted(sid for sid, words in flts.items()
+                      if filters.parse(words.split(' ')).matches(doc(**fields)))
+        assert matched(idx, **fields) == want
+
+def test_index_remove():
+    idx = index(a='x=1', b='x=1', c='x>0')
+    idx.remove('a')
+    idx.remove('c')
+    idx.remove('zz')
+    assert matched(idx, x=1) == ['b']
+    assert 'x' not in idx.ranges
+    idx.remove('b')
+    assert len(idx) == 0 and not idx.equal and not idx.fields
+
+#-------
+# Subscriptions with filters
+#-------
+
+def test_resubscribe_replaces_filter():
+    r = registry.SubRegistry()
+    assert r.subscribe('t', 's', 'c', filters.parse(['x=1'])) is True
+    assert r.subscribe('t', 's', 'c', filters.parse(['x=2'])) is False
+    assert r.subscribers('t') == ()
+    assert r.filtered('t', b'{"x": 1}') == ()
+    assert r.filtered('t', b'{"x": 2}') == (('s', 'c'),)
+    assert len(r.filters['t']) == 1
+    r.subscribe('t', 's', 'c')                      # no filter any more
+    assert r.subscribers('t') == (('s', 'c'),)
+    assert not r.filters and r.filtered('t', b'{"x": 2}') == ()
+    r.subscribe('t', 's', 'c', filters.parse(['x=3']))
+    assert r.subscribers('t') == ()
+    assert r.filtered('t', b'{"x": 3}') == (('s', 'c'),)
@@ -0,0 +1,28 @@
+import idle
+
+def test_expires_unless_heard():
+    t = idle.IdleTimer(idle_secs=5, tick_secs=1)
+    t.add('a', 0)
+    t.add('b', 0)
+    t.touch('b', 4)
+    assert t.expired(5.5) == []
+    assert t.expired(6.5) == ['a']
+    assert t.expired(10.5) == ['b']
+    assert len(t) == 0
+
+def test_suspended_not_expired():
+    t = idle.IdleTimer(idle_secs=5, tick_secs=1)
+    t.add('a', 0, timeout=3)
+    t.suspend('a')
+    assert t.expired(100) == [] and len(t) == 0
+    t.resume('a', 100)
+    assert t.expired(102.5) == []
+    assert t.expired(104.5) == ['a']                # its own timeout kept
+
+def test_removed_while_suspended():
+    t = idle.IdleTimer(idle_secs=5, tick_secs=1)
+    t.add('a', 0)
+    t.suspend('a')
+    t.remove('a')
+    t.resume('a', 10)
+    assert len(t) == 0 and t.expired(100) == []
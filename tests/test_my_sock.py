@@ -0,0 +1,56 @@
+import my_sock as msock
+
+def feed(reader, data):
+    """
+    Receives "data" into "reader" as a BufferedProtocol would, in reads
+    of at most what get_buffer() offers.
+    """
+    while data:
+        buf = reader.get_buffer(-1)
+        n = min(len(buf), len(data))
+        buf[:n] = data[:n]
+        reader.buffer_updated(n)
+        data = data[n:]
+
+#-------
+# FrameReader
+#-------
+
+def test_text_lines_across_reads():
+    r = msock.FrameReader(size=16)
+    feed(r, b'a pub t one\nb pub')
+    assert [bytes(f) for f in r.frames()] == [b'a pub t one']
+    feed(r, b' t two\n\n')
+    assert [bytes(f) for f in r.frames()] == [b'b pub t two', b'']
+
+def test_binary_frames_across_reads():
+    r = msock.FrameReader(size=16)
+    r.binary = True
+    frames = [msock.encode_frame('pub', b't', b'x' * n, seq=n + 1) for n in (0, 5, 100)]
+    data = b''.join(frames)
+    feed(r, data[:7])
+    assert list(r.frames()) == [] and r.need > 0
+    feed(r, data[7:])
+    got = [msock.decode_frame(f) for f in r.frames()]
+    assert [bytes(p) for _, _, _, _, p in got] == [b'', b'x' * 5, b'x' * 100]
+    assert [msock.frame_seq(flags, ext) for _, flags, _, ext, _ in got] == [1, 6, 101]
+
+def test_oversized_frame_header():
+    r = msock.FrameReader()
+    r.binary = True
+    feed(r, msock._bin_hdr.pack(1, 0, 1, 0, msock._max_frame))
+    assert r.next_frame() is None and r.oversized
+    assert len(r.get_buffer(-1)) < msock._max_frame        # not grown to it
+    assert r.fill() == -1
+
+def test_oversized_line():
+    r = msock.FrameReader()
+    feed(r, b'x' * (msock._max_frame + 1))
+    assert r.next_frame() is None and r.oversized
+
+def test_largest_frame():
+    r = msock.FrameReader()
+    r.binary = True
+    frame = msock.encode_frame('pub', b't', b'x' * (msock._max_frame - msock._bin_hdr.size - 1))
+    feed(r, frame)
+    assert bytes(r.next_frame()) == frame and not r.oversized
@@ -0,0 +1,146 @@
+import threading
+import my_sock as msock
+import outq
+
+def put(q, *msgs, priority=0):
+    return [q.put((m,), len(m), priority=priority) for m in msgs]
+
+#-------
+# OutQueue
+#-------
+
+def test_higher_lanes_first():
+    q = outq.OutQueue(10, 1000, 'block')
+    put(q, b'a', b'b')
+    put(q, b'u', priority=3)
+    put(q, b'c')
+    put(q, b'm', priority=1)
+    assert len(q) == 5 and q.nbytes == 5
+    assert q.take() == [b'u', b'm', b'a', b'b', b'c']
+    assert len(q) == 0 and q.nbytes == 0 and q.take() == []
+
+def test_bounds():
+    q = outq.OutQueue(3, 10, 'block')
+    put(q, b'12345', b'1234')
+    assert not q.full()
+    put(q, b'1')
+    assert q.full()                                 # 10 bytes
+    q.take()
+    put(q, b'a', b'b', b'c')
+    assert q.full()                                 # 3 messages
+    assert q.put((b'x' * 100,), 100, bounded=False) == outq._queued
+    assert q.stats() == (4, 103, 0, 4)
+
+def test_block():
+    q = outq.OutQueue(2, 1000, 'block')
+    assert put(q, b'a', b'b', b'c') == [outq._queued, outq._queued, outq._full]
+    assert len(q) == 3 and not q.low()              # queued over the bound all the same
+    q.take()
+    assert q.low()
+
+def test_disconnect():
+    q = outq.OutQueue(2, 1000, 'disconnect')
+    assert put(q, b'a', b'b', b'c') == [outq._queued, outq._queued, outq._overflow]
+    assert q.take() == [b'a', b'b']
+
+def test_drop_oldest():
+    q = outq.OutQueue(3, 1000, 'drop-oldest')
+    assert put(q, b'a', b'b', b'c', b'd') == [outq._queued] * 3 + [outq._dropped]
+    assert q.take() == [b'b', b'c', b'd']
+    assert q.stats() == (0, 0, 1, 3)
+
+def test_drop_newest():
+    q = outq.OutQueue(3, 1000, 'drop-newest')
+    assert put(q, b'a', b'b', b'c', b'd') == [outq._queued] * 3 + [outq._dropped]
+    assert q.take() == [b'a', b'b', b'c']
+    assert q.dropped == 1
+
+def test_drop_lower_lanes_first():
+    q = outq.OutQueue(3, 1000, 'drop-oldest')
+    put(q, b'u', priority=2)
+    put(q, b'a', b'b')
+    assert put(q, b'v', priority=2) == [outq._dropped]
+    assert q.take() == [b'u', b'v', b'b']
+    q = outq.OutQueue(3, 1000, 'drop-newest')
+    put(q, b'u', priority=2)
+    put(q, b'a', b'b')
+    assert put(q, b'v', priority=2) == [outq._dropped]
+    assert q.take() == [b'u', b'v', b'a']           # the newest of the lower lane
+
+def test_never_drop_higher_lanes():
+    for policy in ('drop-oldest', 'drop-newest'):
+        q = outq.OutQueue(2, 1000, policy)
+        put(q, b'u', b'v', priority=3)
+        assert put(q, b'a') == [outq._dropped]
+        assert q.take() == [b'u', b'v'] and q.dropped == 1
+
+def test_stamped_on_take():
+    q = outq.OutQueue(10, 1000, 'block')
+    hdr = bytearray(b'xx' + bytes(msock._ts_fmt.size))
+    q.put((hdr, b'p'), len(hdr) + 1, stamp=2)
+    put(q, b'q')
+    before = msock.now_us()
+    bufs = q.take()
+    stamp, = msock._ts_fmt.unpack_from(bufs[0], 2)
+    assert before <= stamp <= msock.now_us() and q.stamped == 0
+
+#-------
+# Detaching views of reused buffers
+#-------
+
+def test_detached():
+    buf = bytearray(b'abcdef')
+    mapped = memoryview(b'ghi')
+    parts = outq.detached([memoryview(buf)[:3], mapped, b'jk'])
+    buf[:3] = b'xyz'
+    assert parts[0] == b'abc' and type(parts[0]) is bytes
+    assert parts[1] is mapped and parts[2] == b'jk'
+
+def test_detach_only_attached():
+    buf = bytearray(b'abcd')
+    view = memoryview(buf)
+    q = outq.OutQueue(10, 1000, 'block')
+    q.put((view[0:1],), 1)
+    q.detach()                                      # before the buffer is reused
+    first = q.lanes[0][0][0][0]
+    assert type(first) is bytes
+    q.put((view[1:2],), 1)
+    q.put((view[2:3],), 1, priority=1)
+    q.detach()
+    assert q.lanes[0][0][0][0] is first             # not copied again
+    buf[:] = b'wxyz'
+    assert q.take() == [b'c', b'a', b'b']
+
+#-------
+# ThreadedOutQueue
+#-------
+
+def test_put_wait_blocks_until_low():
+    q = outq.ThreadedOutQueue(4, 1000, 'block')
+    for m in (b'a', b'b', b'c', b'd'):
+        q.put_wait((m,), 1)
+    done = []
+    t = threading.Thread(target=lambda: done.append(q.put_wait((b'e',), 1)))
+    t.start()
+    t.join(0.1)
+    assert t.is_alive() and len(q) == 5
+    assert q.take_wait() == [b'a', b'b', b'c', b'd', b'e']
+    t.join(1)
+    assert done == [outq._queued]
+
+def test_close_wakes_waiters():
+    q = outq.ThreadedOutQueue(1, 1000, 'block')
+    q.put_wait((b'a',), 1)
+    empty = outq.ThreadedOutQueue(1, 1000, 'block')
+    got = []
+    threads = [threading.Thread(target=lambda: got.append(q.put_wait((b'b',), 1))),
+               threading.Thread(target=lambda: got.append(empty.take_wait()))]
+    for t in threads:
+        t.start()
+        t.join(0.1)
+        assert t.is_alive()
+    q.close()
+    empty.close()
+    for t in threads:
+        t.join(1)
+    assert got == [outq._queued, None] or got == [None, outq._queued]
@@ -0,0 +1,124 @@
+import registry
+
+#-------
+# Subscriptions and snapshots
+#-------
+
+def test_subscribe_unsubscribe():
+    r = registry.SubRegistry()
+    assert r.subscribe('a', 's1', 'c1') is True
+    assert r.subscribe('a', 's1', 'c1') is False
+    assert r.subscribe('a.', 's1', 'c1') is None
+    r.subscribe('a', 's2', 'c2')
+    assert r.subscribers('a') == (('s1', 'c1'), ('s2', 'c2'))
+    assert r.unsubscribe('a', 's1') and not r.unsubscribe('a', 's1')
+    assert r.subscribers('a') == (('s2', 'c2'),)
+    r.unsubscribe('a', 's2')
+    assert r.subscribers('a') == () and len(r) == 0 and not r.by_conn
+
+def test_snapshot_copy_on_write():
+    r = registry.SubRegistry()
+    r.subscribe('a', 's1', 'c1')
+    snap = r.subscribers('a')
+    assert r.subscribers('a') is snap               # cached
+    r.subscribe('b', 's2', 'c2')
+    assert r.subscribers('a') is snap               # other topics leave it
+    r.subscribe('a', 's2', 'c2')
+    assert snap == (('s1', 'c1'),)                  # replaced, not changed
+    assert r.subscribers('a') == (('s1', 'c1'), ('s2', 'c2'))
+
+def test_moved_to_new_conn():
+    r = registry.SubRegistry()
+    r.subscribe('a', 's1', 'old')
+    r.subscribe('b', 's1', 'old')
+    assert r.subscribe('a', 's1', 'new') == 'old'
+    assert r.subscribers('a') == (('s1', 'new'),)
+    assert r.drop('old') == [('b', 's1')]
+    assert r.subscribers('a') == (('s1', 'new'),) and r.subscribers('b') == ()
+
+#-------
+# Patterns
+#-------
+
+def test_patterns():
+    r = registry.SubRegistry()
+    r.subscribe('a.*.c', 'one', 'c1')
+    r.subscribe('a.#', 'many', 'c2')
+    r.subscribe('a.b.c', 'topic', 'c3')
+    assert sorted(r.subscribers('a.b.c')) == [('many', 'c2'), ('one', 'c1'), ('topic', 'c3')]
+    assert r.subscribers('a.b') == (('many', 'c2'),)
+    assert r.subscribers('a') == (('many', 'c2'),)  # "a.#" matches "a" too
+    assert r.subscribers('a.b.c.d') == (('many', 'c2'),)
+    assert r.subscribers('x.b.c') == ()
+    assert r.subscribers('a.#') == ()
+
+def test_pattern_once_per_conn():
+    r = registry.SubRegistry()
+    r.subscribe('a.b', 's', 'c')
+    r.subscribe('a.*', 's', 'c')
+    r.subscribe('#', 's', 'c')
+    assert r.subscribers('a.b') == (('s', 'c'),)
+
+def test_pattern_invalidates_matching_snapshots():
+    r = registry.SubRegistry()
+    r.subscribe('a.b', 's1', 'c1')
+    r.subscribe('z.#', 's0', 'c0')                  # topics without subscribers cached too
+    for tpc in ('a.b', 'a.x', 'b.b'):
+        r.subscribers(tpc)
+    r.subscribe('a.*', 's2', 'c2')
+    assert 'a.b' not in r.snapshot and 'a.x' not in r.snapshot
+    assert 'b.b' in r.snapshot
+    assert r.subscribers('a.x') == (('s2', 'c2'),)
+    r.unsubscribe('a.*', 's2')
+    assert r.subscribers('a.x') == () and r.subscribers('a.b') == (('s1', 'c1'),)
+    assert r.npatterns == 1 and list(r.trie.children) == ['z']
+
+def test_cache_cleared_when_full(monkeypatch):
+    monkeypatch.setattr(registry, '_max_cached', 3)
+    r = registry.SubRegistry()
+    r.subscribe('#', 's', 'c')
+    for i in range(5):
+        assert r.subscribers('t%d' % i) == (('s', 'c'),)
+    assert r.ntopics <= 3 and len(r.snapshot) <= 3
+
+#-------
+# Consumer groups
+#-------
+
+def test_group_join_leave():
+    r = registry.SubRegistry()
+    g = r.join('t', 'g', 's1', 'c1')
+    assert r.join('t', 'g', 's1', 'c1') is False
+    assert r.join('t.*', 'g', 's1', 'c1') is None
+    assert r.join('t', 'g', 's1', 'c1', policy='nope') is None
+    r.join('t', 'g', 's2', 'c2')
+    assert r.consumer_groups('t') == (g,) and g.members == (('s1', 'c1'), ('s2', 'c2'))
+    assert r.leave('t', 'g', 's1') is g and r.leave('t', 'g', 's1') is None
+    assert r.drop('c2') == [('t', 's2', 'g')]
+    assert r.consumer_groups('t') == () and not r.by_conn
+
+def test_round_robin():
+    r = registry.SubRegistry()
+    for sid in ('a', 'b', 'c'):
+        g = r.join('t', 'g', sid, 'c' + sid)
+    assert [g.pick(None, len)[0] for _ in range(6)] == ['a', 'b', 'c', 'a', 'b', 'c']
+
+def test_least_outstanding():
+    r = registry.SubRegistry()
+    for sid in ('a', 'b', 'c'):
+        g = r.join('t', 'g', sid, sid, policy='least-outstanding')
+    load = {'a': 5, 'b': 1, 'c': 3}
+    assert g.pick(None, load.get) == ('b', 'b')
+
+def test_key_hash_moves_only_leaving_keys():
+    r = registry.SubRegistry()
+    for sid in ('a', 'b', 'c'):
+        g = r.join('t', 'g', sid, sid, policy='key-hash')
+    keys = ['k%d' % i for i in range(300)]
+    before = {k: g.pick(k, None)[0] for k in keys}
+    assert set(before.values()) == {'a', 'b', 'c'}
+    assert all(g.pick(k, None)[0] == before[k] for k in keys)
+    r.leave('t', 'g', 'b')
+    after = {k: g.pick(k, None)[0] for k in keys}
+    assert all(after[k] == before[k] for k in keys if before[k] != 'b')
+    assert 'b' not in after.values()
@@ -0,0 +1,84 @@
+import retain
+
+#-------
+# TopicRing
+#-------
+
+def test_last_messages_oldest_first():
+    r = retain.TopicRing(max_msgs=3, max_bytes=1024)
+    for i in range(5):
+        r.append(b'm%d' % i)
+    assert len(r) == 3
+    assert r.last(10) == [b'm2', b'm3', b'm4']
+    assert r.last(2) == [b'm3', b'm4']
+    assert r.last(0) == []
+
+def test_grows_up_to_max_bytes():
+    r = retain.TopicRing(max_msgs=100, max_bytes=1000)
+    assert len(r.buf) == retain._min_bytes
+    for i in range(10):
+        r.append(bytes([i]) * 90)
+    assert len(r.buf) == 1000
+    assert r.last(10) == [bytes([i]) * 90 for i in range(10)]
+
+def test_wraparound_drops_overwritten():
+    r = retain.TopicRing(max_msgs=100, max_bytes=256)
+    for i in range(5):
+        r.append(bytes([i]) * 60)                   # 4 fit, the 5th wraps to the start
+    assert r.last(10) == [bytes([i]) * 60 for i in (1, 2, 3, 4)]
+    assert r.starts[r.head + 3] == 0
+    r.append(b'x' * 100)                            # overwrites 1 and 2
+    assert r.last(10) == [b'\x03' * 60, b'\x04' * 60, b'x' * 100]
+    assert r.nbytes == 220
+
+def test_wraparound_drops_past_end():
+    r = retain.TopicRing(max_msgs=100, max_bytes=256)
+    r.append(b'a' * 100)
+    r.append(b'b' * 100)
+    r.append(b'c' * 50)                             # ends at 250
+    r.append(b'd' * 120)                            # wraps over "a" and "b", "c" left past it
+    assert r.last(10) == [b'c' * 50, b'd' * 120]
+    r.append(b'e' * 150)                            # wraps, dropping "c" past the end and "d"
+    assert r.last(10) == [b'e' * 150]
+    assert r.nbytes == 150
+
+def test_too_large_payload_clears():
+    r = retain.TopicRing(max_msgs=10, max_bytes=100)
+    r.append(b'a')
+    r.append(b'x' * 101)
+    assert len(r) == 0 and r.last(5) == []
+    r.append(b'b')
+    assert r.last(5) == [b'b']
+
+def test_index_trimmed():
+    r = retain.TopicRing(max_msgs=10, max_bytes=1 << 16)
+    for i in range(1000):
+        r.append(b'%d' % i)
+    assert len(r.starts) < 200
+    assert r.last(3) == [b'997', b'998', b'999']
+    assert r.memory == len(r.buf) + len(r.starts) * retain._index_bytes
+
+#-------
+# RingStore
+#-------
+
+def test_store_per_topic():
+    s = retain.RingStore(max_msgs=2)
+    s.append('a', b'1')
+    s.append('b', b'2')
+    s.append('a', b'3')
+    s.append('a', b'4')
+    assert s.last('a', 5) == [b'3', b'4']
+    assert s.last('b', 5) == [b'2']
+    assert s.last('c', 5) == []
+
+def test_store_evicts_coldest():
+    s = retain.RingStore(max_msgs=10, max_bytes=1024,
+                         max_memory=3 * (retain._min_bytes + 2 * retain._index_bytes))
+    for tpc in ('a', 'b', 'c'):
+        s.append(tpc, b'x')
+    s.append('a', b'y')                             # "b" is now the coldest
+    s.append('d', b'z')
+    assert s.evicted == 1
+    assert s.last('b', 1) == [] and s.last('a', 2) == [b'x', b'y']
+    assert s.memory == sum(r.memory for r in s.rings.values()) <= s.max_memory
@@ -0,0 +1,143 @@
+import os
+import threading
+import topiclog
+
+def settings(**kw):
+    s = dict(log_fsync='never', log_fsync_ms=0, log_segment_bytes=1 << 20,
+             log_retention_bytes=0, log_retention_secs=0, offsets_commit_ms=0)
+    s.update(kw)
+    return s
+
+def segment(dirname, n, size=100):
+    seg = topiclog.Segment(dirname, 0)
+    seg.open()
+    for i in range(n):
+        seg.append(i, 1.0, bytes([i]) * size)
+    seg.close()
+    return seg
+
+def payloads(seg):
+    out = []
+    seg.read(0, 1 << 30, out)
+    seg.unmap()
+    return [bytes(p) for _, _, p in out]
+
+#-------
+# Segment recovery
+#-------
+
+def test_segment_reloaded(tmp_path):
+    segment(str(tmp_path), 100)
+    seg = topiclog.Segment(str(tmp_path), 0)
+    assert seg.next == 100 and seg.size == 100 * (topiclog._rec_hdr.size + 100)
+    assert len(seg.index) > 1
+    assert payloads(seg)[-1] == bytes([99]) * 100
+
+def test_torn_record_dropped(tmp_path):
+    old = segment(str(tmp_path), 10)
+    with open(old.path, 'ab') as f:
+        f.write(topiclog._rec_hdr.pack(10, 1.0, 100) + b'x' * 40)
+    seg = topiclog.Segment(str(tmp_path), 0)
+    assert seg.next == 10 and seg.size == old.size
+    assert os.path.getsize(seg.path) == old.size
+    seg.open()
+    seg.append(10, 1.0, b'after')
+    seg.close()
+    assert payloads(topiclog.Segment(str(tmp_path), 0))[-2:] == [bytes([9]) * 100, b'after']
+
+def test_torn_header_dropped(tmp_path):
+    old = segment(str(tmp_path), 10)
+    with open(old.path, 'ab') as f:
+        f.write(b'\0' * (topiclog._rec_hdr.size - 1))
+    seg = topiclog.Segment(str(tmp_path), 0)
+    assert seg.next == 10 and os.path.getsize(seg.path) == old.size
+
+def test_index_past_records_dropped(tmp_path):
+    old = segment(str(tmp_path), 200)
+    os.truncate(old.path, old.index[2][1] + 10)     # in the record of the third entry
+    seg = topiclog.Segment(str(tmp_path), 0)
+    assert seg.index == old.index[:2]
+    assert os.path.getsize(seg.idx_path) == 2 * topiclog._idx_rec.size
+    assert seg.next == old.index[2][0] and seg.size == old.index[2][1]
+    assert len(payloads(seg)) == seg.next
+
+def test_torn_index_entry_dropped(tmp_path):
+    old = segment(str(tmp_path), 200)
+    os.truncate(old.idx_path, 2 * topiclog._idx_rec.size + 5)
+    seg = topiclog.Segment(str(tmp_path), 0)
+    assert seg.index == old.index[:2]
+    assert os.path.getsize(seg.idx_path) == 2 * topiclog._idx_rec.size
+    assert seg.next == 200 and seg.size == old.size  # records after it scanned
+
+def test_index_lost(tmp_path):
+    old = segment(str(tmp_path), 50)
+    os.remove(old.idx_path)
+    seg = topiclog.Segment(str(tmp_path), 0)
+    assert seg.index == [] and seg.next == 50 and seg.size == old.size
+    assert len(payloads(seg)) == 50
+
+#-------
+# TopicLog
+#-------
+
+def test_log_reopened(tmp_path):
+    d = str(tmp_path / 't')
+    log = topiclog.TopicLog(d, settings(log_segment_bytes=200))
+    for i in range(30):
+        log.append(b'm%d' % i, ts=1.0)
+    log.close()
+    log = topiclog.TopicLog(d, settings(log_segment_bytes=200))
+    assert len(log.segments) > 1 and log.end() == 30
+    assert log.append(b'm30') == 30
+    msgs, nxt = log.read(25, 1 << 20)
+    assert [bytes(p) for _, _, p in msgs] == [b'm%d' % i for i in range(25, 31)] and nxt == 31
+    log.close()
+
+def test_log_retention(tmp_path):
+    log = topiclog.TopicLog(str(tmp_path / 't'), settings(log_segment_bytes=1000, log_retention_bytes=3000))
+    for i in range(100):
+        log.append(b'x' * 100)
+    assert sum(s.size for s in log.segments) <= 3000 + 1000
+    assert log.start() == log.segments[0].base > 0
+    msgs, nxt = log.read(0, 1 << 20)                # from the oldest kept
+    assert msgs[0][0] == log.start() and nxt == 100
+    log.close()
+
+#-------
+# OffsetStore
+#-------
+
+def test_offsets_reloaded(tmp_path):
+    path = str(tmp_path / 'offsets')
+    s = topiclog.OffsetStore(path, {'offsets_commit_ms': 0})
+    s.commit('s1', 'a', 5)
+    s.commit('s2', 'a', 7)
+    s.flush()
+    s.commit('s1', 'a', 6)
+    s.flush(force=True)
+    t = topiclog.OffsetStore(path, {'offsets_commit_ms': 0})
+    assert t.get('s1', 'a') == 6 and t.get('s2', 'a') == 7 and t.get('s1', 'b') is None
+
+def test_offsets_flushed_by_many_threads(tmp_path):
+    path = str(tmp_path / 'offsets')
+    s = topiclog.OffsetStore(path, {'offsets_commit_ms': 0})
+    errors = []
+
+    def commit(i):
+        try:
+            for n in range(300):
+                s.commit('s%d' % i, 't', n)
+                s.flush()
+        except Exception as err:
+            errors.append(err)
+
+    threads = [threading.Thread(target=commit, args=(i,)) for i in range(8)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    s.flush(force=True)
+    assert errors == []
+    assert not os.path.exists(path + '.tmp')
+    t = topiclog.OffsetStore(path, {'offsets_commit_ms': 0})
+    assert [t.get('s%d' % i, 't') for i in range(8)] == [299] * 8
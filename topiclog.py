@@ -0,0 +1,465 @@
+import os
+import mmap
+import time
+import bisect
+import struct
+import threading
+from urllib.parse import quote, unquote
+
+#-------
+# Global settings
+#-------
+
+_rec_hdr  = struct.Struct('!QdI')               # offset, timestamp, payload len of each record
+_idx_rec  = struct.Struct('!QQ')                # offset, position of a record in its segment
+_log_ext  = '.log'
+_idx_ext  = '.index'
+
+_index_every  = 4096                            # bytes of records between sparse index entries
+_file_buffer  = 1 << 16                         # write buffer of the active segment
+_retain_every = 60                              # secs between retention checks of sync()
+
+_fsync_policies = ('batch', 'interval', 'never')
+
+_offsets_file = '.offsets'                      # committed offsets, in the root of the logs
+_earliest = 'earliest'                          # "sub tpc from" the oldest logged message
+_latest   = 'latest'                            # "sub tpc from" the next published message
+
+#-------
+# Log segments
+#-------
+
+class Segment:
+    """
+    One file of a topic log, holding the records of consecutive offsets
+    from "base" on, each one a "_rec_hdr" followed by its payload, and a
+    sparse index file with a "_idx_rec" every "_index_every" bytes.
+    Only the last segment of a log is appended to; records are read
+    through a read-only memory map of the file, remapped as it grows.
+    """
+
+    def __init__(self, dirname, base):
+        name = '%020d' % base
+        self.path     = os.path.join(dirname, name + _log_ext)
+        self.idx_path = os.path.join(dirname, name + _idx_ext)
+        self.base  = base
+        self.next  = base                       # offset of the next record
+        self.size  = 0
+        self.index = []                         # [(offset, pos), ..]
+        self.file = self.idx_file = None        # appending, while active
+        self.rfile = self.mm = None             # mapping, once read
+        self.mapped = 0
+        if os.path.exists(self.path):
+            self.load()
+
+    def load(self):
+        """
+        Loads the index and scans the records after its last entry,
+        dropping a record torn by a crash at the end of the file, and the
+        index entries past the records kept, from the index file too.
+        """
+        idx_size = 0
+        if os.path.exists(self.idx_path):
+            with open(self.idx_path, 'rb') as f:
+                data = f.read()
+            idx_size = len(data)
+            n = idx_size - idx_size % _idx_rec.size
+            self.index = [_idx_rec.unpack_from(data, o) for o in range(0, n, _idx_rec.size)]
+        size = os.path.getsize(self.path)
+        while self.index and self.index[-1][1] >= size:
+            self.index.pop()
+        pos, self.next = (self.index[-1][1], self.index[-1][0]) if self.index else (0, self.base)
+        with open(self.path, 'rb') as f:
+            f.seek(pos)
+            data = f.read()
+        o = 0
+        while o + _rec_hdr.size <= len(data):
+            offset, ts, n = _rec_hdr.unpack_from(data, o)
+            if o + _rec_hdr.size + n > len(data):
+                break
+            self.next = offset + 1
+            o += _rec_hdr.size + n
+        self.size = pos + o
+        if self.size < size:
+            os.truncate(self.path, self.size)
+        while self.index and self.index[-1][1] >= self.size:
+            self.index.pop()
+        if idx_size > len(self.index) * _idx_rec.size:
+            os.truncate(self.idx_path, len(self.index) * _idx_rec.size)
+
+    def open(self):
+        self.file     = open(self.path, 'ab', buffering=_file_buffer)
+        self.idx_file = open(self.idx_path, 'ab')
+
+    def append(self, offset, ts, payload):
+        pos = self.size
+        if not self.index or pos - self.index[-1][1] >= _index_every:
+            self.index.append((offset, pos))
+            self.idx_file.write(_idx_rec.pack(offset, pos))
+        self.file.write(_rec_hdr.pack(offset, ts, len(payload)))
+        self.file.write(payload)
+        self.size += _rec_hdr.size + len(payload)
+        self.next = offset + 1
+
+    def flush(self, fsync=False):
+        """
+        Hands the buffered records to the OS and, with "fsync", to the disk.
+        """
+        if self.file is None:
+            return
+        self.file.flush()
+        self.idx_file.flush()
+        if fsync:
+            os.fsync(self.file.fileno())
+            os.fsync(self.idx_file.fileno())
+
+    def read(self, offset, max_bytes, out):
+        """
+        Appends to "out" the records from "offset" on, up to "max_bytes"
+        of payload (always at least one record), as views of the mapping:
+            (offset, ts, memoryview)
+        Returns:
+            the payload bytes read
+        """
+        if self.size == 0:
+            return 0
+        self.flush()
+        if self.mapped < self.size:
+            self.unmap()
+            self.rfile  = open(self.path, 'rb')
+            self.mm     = mmap.mmap(self.rfile.fileno(), self.size, access=mmap.ACCESS_READ)
+            self.mapped = self.size
+        view = memoryview(self.mm)
+        i = bisect.bisect_right(self.index, (offset, 1 << 64)) - 1
+        pos = self.index[i][1] if i >= 0 else 0
+        nbytes = 0
+        while pos < self.mapped and (nbytes < max_bytes or not out):
+            roff, ts, n = _rec_hdr.unpack_from(view, pos)
+            pos += _rec_hdr.size
+            if roff >= offset:
+                out.append((roff, ts, view[pos:pos + n]))
+                nbytes += n
+            pos += n
+        return nbytes
+
+    def unmap(self):
+        """
+        Drops the mapping, left to the garbage collector while views of it
+        are still queued for writing.
+        """
+        if self.mm is not None:
+            try:
+                self.mm.close()
+            except BufferError:
+                pass
+            self.rfile.close()
+        self.mm = self.rfile = None
+        self.mapped = 0
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.idx_file.close()
+        self.file = self.idx_file = None
+        self.unmap()
+
+    def remove(self):
+        self.close()
+        for path in (self.path, self.idx_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+#-------
+# Topic logs
+#-------
+
+class TopicLog:
+    """
+    Append-only log of the messages of one topic, in the segments found
+    in directory "dirname", numbered by consecutive offsets from 0.
+    A new segment is started once the active one reaches "log_segment_bytes";
+    whole segments are removed, oldest first, while the log exceeds
+    "log_retention_bytes" or were last written "log_retention_secs" ago.
+    """
+
+    def __init__(self, dirname, settings):
+        self.dirname  = dirname
+        self.settings = settings
+        self.lock = threading.Lock()
+        os.makedirs(dirname, exist_ok=True)
+        bases = sorted(int(f[:-len(_log_ext)]) for f in os.listdir(dirname)
+                       if f.endswith(_log_ext) and f[:-len(_log_ext)].isdigit())
+        self.segments = [Segment(dirname, b) for b in bases] or [Segment(dirname, 0)]
+        self.segments[-1].open()
+
+    def start(self):
+        """
+        Returns:
+            the oldest offset kept
+        """
+        return self.segments[0].base
+
+    def end(self):
+        """
+        Returns:
+            the offset the next message gets
+        """
+        return self.segments[-1].next
+
+    def append(self, payload, ts=None):
+        """
+        Appends a message.
+        Returns:
+            its offset
+        """
+        with self.lock:
+            seg = self.segments[-1]
+            if seg.size >= self.settings['log_segment_bytes']:
+                seg = self.roll()
+            offset = seg.next
+            seg.append(offset, time.time() if ts is None else ts, payload)
+        return offset
+
+    def roll(self):
+        seg = self.segments[-1]
+        seg.flush(fsync=self.settings['log_fsync'] != 'never')
+        seg.file.close()
+        seg.idx_file.close()
+        seg.file = seg.idx_file = None
+        new = Segment(self.dirname, seg.next)
+        new.open()
+        self.segments.append(new)
+        self.retain()
+        return new
+
+    def read(self, offset, max_bytes):
+        """
+        Reads the messages from "offset" on, or from the oldest one kept,
+        up to about "max_bytes" of payload.
+        Returns:
+            ([(offset, ts, memoryview), ..], next offset to read)
+        """
+        out = []
+        with self.lock:
+            offset = max(offset, self.start())
+            i = bisect.bisect_right([s.base for s in self.segments], offset) - 1
+            nbytes = 0
+            for seg in self.segments[max(i, 0):]:
+                if nbytes >= max_bytes:
+                    break
+                if seg.next > offset:
+                    nbytes += seg.read(offset, max_bytes - nbytes, out)
+        return out, (out[-1][0] + 1 if out else min(offset, self.end()))
+
+    def flush(self, fsync=False):
+        with self.lock:
+            self.segments[-1].flush(fsync)
+
+    def retain(self, now=None):
+        """
+        Removes the segments beyond the retention limits, never the active one.
+        Returns:
+            the number of segments removed
+        """
+        now = time.time() if now is None else now
+        max_bytes = self.settings['log_retention_bytes']
+        max_age   = self.settings['log_retention_secs']
+        total = sum(s.size for s in self.segments)
+        n = 0
+        while len(self.segments) > 1:
+            seg = self.segments[0]
+            old = max_age and now - os.path.getmtime(seg.path) > max_age
+            if not old and not (max_bytes and total > max_bytes):
+                break
+            total -= seg.size
+            seg.remove()
+            self.segments.pop(0)
+            n += 1
+        return n
+
+    def close(self):
+        with self.lock:
+            for seg in self.segments:
+                seg.close()
+
+#------
+
+class OffsetStore:
+    """
+    Offsets committed by subscribers, the next offset each subscriber id
+    is to get of a topic, in text file "path" as lines "offset sid tpc".
+    Commits only change memory; flush() rewrites the file, at most once
+    every "offsets_commit_ms", so tracking them costs no write per message.
+    One thread flushes at a time, under "lock", the publisher threads of
+    the threads broker all calling it (see LogStore.sync()).
+    """
+
+    def __init__(self, path, settings):
+        self.path     = path
+        self.settings = settings
+        self.offsets  = {}                      # (sid, tpc) --> offset
+        self.dirty    = False
+        self.flushed  = time.time()
+        self.lock     = threading.Lock()        # of flush(), the file and its ".tmp"
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    words = line.split()
+                    if len(words) == 3 and words[0].isdigit():
+                        self.offsets[(words[1], words[2])] = int(words[0])
+
+    def get(self, sid, tpc):
+        """
+        Returns:
+            None, if "sid" never committed an offset of "tpc"
+            the committed offset, when normal
+        """
+        return self.offsets.get((sid, tpc))
+
+    def commit(self, sid, tpc, offset):
+        self.offsets[(sid, tpc)] = offset
+        self.dirty = True
+
+    def flush(self, force=False):
+        """
+        Rewrites the file, if anything was committed since the last flush
+        and either "force" or "offsets_commit_ms" have passed. Unless
+        "force", it leaves the file to a thread already flushing it.
+        """
+        now = time.time()
+        if not self.dirty or not force and (now - self.flushed) * 1000 < self.settings['offsets_commit_ms']:
+            return
+        if not self.lock.acquire(blocking=force):
+            return
+        try:
+            self.dirty, self.flushed = False, now
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                f.writelines('%d %s %s\n' % (o, sid, tpc) for (sid, tpc), o in list(self.offsets.items()))
+            os.replace(tmp, self.path)
+        finally:
+            self.lock.release()
+
+#------
+
+class LogStore:
+    """
+    The topic logs of the broker, one directory per topic under "root",
+    opened as they are first written or read, also after a restart,
+    and the offsets committed by the subscribers of the topics.
+    sync() hands the appended messages to the OS and fsyncs them as
+    "log_fsync" says:
+        batch     on every sync(), i.e. before acking each read of a publisher
+        interval  at most once every "log_fsync_ms"
+        never     leaving it to the OS
+    """
+
+    def __init__(self, root, settings):
+        self.root     = root
+        self.settings = settings
+        self.lock  = threading.Lock()
+        self.logs  = {}                         # tpc --> TopicLog
+        self.dirty = set()                      # TopicLogs appended since the last sync()
+        self.synced = self.retained = time.time()
+        os.makedirs(root, exist_ok=True)
+        self.offsets = OffsetStore(os.path.join(root, _offsets_file), settings)
+
+    def get(self, tpc, create=True):
+        """
+        Returns:
+            None, if topic "tpc" has no log and not "create"
+            the TopicLog of "tpc", when normal
+        """
+        log = self.logs.get(tpc)
+        if log is not None:
+            return log
+        name = quote(tpc, safe='')
+        if name.startswith('.'):                # neither "..", nor "_offsets_file"
+            name = '%2E' + name[1:]
+        dirname = os.path.join(self.root, name)
+        if not create and not os.path.isdir(dirname):
+            return None
+        with self.lock:
+            log = self.logs.get(tpc)
+            if log is None:
+                log = self.logs[tpc] = TopicLog(dirname, self.settings)
+        return log
+
+    def topics(self):
+        """
+        Returns:
+            [tpc, ..], of every log in "root"
+        """
+        return [unquote(d) for d in os.listdir(self.root)
+                if os.path.isdir(os.path.join(self.root, d)) and not d.startswith('.')]
+
+    def append(self, tpc, payload):
+        """
+        Appends a message to the log of topic "tpc".
+        Returns:
+            its offset
+        """
+        log = self.get(tpc)
+        self.dirty.add(log)
+        return log.append(payload)
+
+    def read(self, tpc, offset, max_bytes):
+        """
+        Returns:
+            ([(offset, ts, memoryview), ..], next offset), see TopicLog.read()
+        """
+        log = self.get(tpc, create=False)
+        if log is None:
+            return [], 0
+        return log.read(offset, max_bytes)
+
+    def sync(self):
+        """
+        Flushes the logs appended since the last sync(), fsyncing them
+        per "log_fsync", and applies retention every "_retain_every" secs.
+        """
+        now = time.time()
+        policy = self.settings['log_fsync']
+        fsync = (policy == 'batch' or policy == 'interval' and
+                 (now - self.synced) * 1000 >= self.settings['log_fsync_ms'])
+        with self.lock:
+            dirty, self.dirty = self.dirty, set()
+        for log in dirty:
+            log.flush(fsync)
+        if fsync:
+            self.synced = now
+        elif policy == 'interval':              # fsync'ed later, in a batch
+            with self.lock:
+                self.dirty |= dirty
+        self.offsets.flush()
+        if now - self.retained >= _retain_every:
+            self.retained = now
+            for log in list(self.logs.values()):
+                with log.lock:
+                    log.retain(now)
+
+    def start_offset(self, sid, tpc, frm=None):
+        """
+        Resolves where a subscription of "sid" to topic "tpc" starts
+        replaying, "frm" being an offset, "_earliest", "_latest" or, if
+        None, the offset "sid" committed last.
+        Returns:
+            -1,     if "frm" is invalid
+            None,   if there is nothing to replay, live messages only
+            offset, when normal
+        """
+        if frm is None:
+            return self.offsets.get(sid, tpc)
+        if frm == _latest:
+            return None
+        if frm == _earliest:
+            return 0
+        if frm.isdigit():
+            return int(frm)
+        return -1
+
+    def close(self):
+        for log in list(self.logs.values()):
+            log.close()
+        self.offsets.flush(force=True)
@@ -0,0 +1,277 @@
+import os
+import sys
+import signal
+import struct
+import collections
+import multiprocessing
+from multiprocessing import shared_memory
+import my_sock as msock
+
+#-------
+# Global settings
+#-------
+
+_pos      = struct.Struct('Q')                  # head (offset 0) and tail (offset 8) of a ring
+_ring_hdr = 2 * _pos.size
+_rec_len  = struct.Struct('I')                  # length of each record in a ring
+_wrap     = 0xFFFFFFFF                          # record length sending the reader back to the start
+
+_flag_member = 0x02                             # "msg" frame for one group member, ext "name\0sid"
+_member_sep  = b'\0'
+_peer_sid    = ' worker%d'                      # sid of another worker in the registry, never a client's
+_retry_secs  = 0.001                            # wait before retrying records the ring had no room for
+
+#-------
+# Shared memory rings
+#-------
+
+class Ring:
+    """
+    Ring of records in shared memory, put() by one worker process and
+    get() by another. Positions only grow, taken modulo "size": the writer
+    moves "tail" once a record is written and the reader moves "head" once
+    the records are copied out, so neither takes a lock. Each record is its
+    length followed by a frame and never wraps around the end: "_wrap", or
+    less room left than a length, sends the reader back to the start.
+    The writer wakes the reader up through a pipe (see Peer.flush_out()),
+    whose syscalls also order the ring writes before the reads.
+    """
+
+    def __init__(self, size):
+        self.shm  = shared_memory.SharedMemory(create=True, size=_ring_hdr + size)
+        self.buf  = self.shm.buf
+        self.size = size
+        _pos.pack_into(self.buf, 0, 0)
+        _pos.pack_into(self.buf, _pos.size, 0)
+
+    def put(self, parts, n):
+        """
+        Appends a record made of the buffers "parts", "n" bytes in all.
+        Returns:
+            False, if the ring has no room for it now
+            True,  when normal
+        """
+        buf  = self.buf
+        head = _pos.unpack_from(buf, 0)[0]
+        tail = _pos.unpack_from(buf, _pos.size)[0]
+        pos  = tail % self.size
+        need = _rec_len.size + n
+        skip = self.size - pos if pos + need > self.size else 0
+        if tail + skip + need - head > self.size:
+            return False
+        if skip:
+            if skip >= _rec_len.size:
+                _rec_len.pack_into(buf, _ring_hdr + pos, _wrap)
+            tail += skip
+            pos = 0
+        o = _ring_hdr + pos
+        _rec_len.pack_into(buf, o, n)
+        o += _rec_len.size
+        for p in parts:
+            buf[o:o + len(p)] = p
+            o += len(p)
+        _pos.pack_into(buf, _pos.size, tail + need)
+        return True
+
+    def get(self):
+        """
+        Takes every record put so far.
+        Returns:
+            [frame, ..], copied out of the ring
+        """
+        buf  = self.buf
+        head = _pos.unpack_from(buf, 0)[0]
+        tail = _pos.unpack_from(buf, _pos.size)[0]
+        frames = []
+        while head < tail:
+            pos = head % self.size
+            if self.size - pos < _rec_len.size:
+                head += self.size - pos
+                continue
+            n = _rec_len.unpack_from(buf, _ring_hdr + pos)[0]
+            if n == _wrap:
+                head += self.size - pos
+                continue
+            o = _ring_hdr + pos + _rec_len.size
+            frames.append(bytes(buf[o:o + n]))
+            head += _rec_len.size + n
+        _pos.pack_into(buf, 0, head)
+        return frames
+
+    def close(self, unlink=False):
+        self.buf.release()
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+#-------
+# Other workers, as seen by one worker
+#-------
+
+class Peer:
+    """
+    Another worker, standing in the registry of this one as subscriber
+    "_peer_sid" of the topics and patterns its own clients subscribed to.
+    It takes the place of a SubProtocol in publish(): messages queued to
+    it are put in the ring towards that worker, which delivers them to its
+    subscribers, and flush_out() rings its doorbell once per flush.
+    Records the ring has no room for wait in "pending", retried every
+    "_retry_secs" in their order, whatever their priority.
+    """
+    binary = True
+    peer   = True
+    paused = False
+    codec  = None
+    hdr    = False
+
+    def __init__(self, wid, ring, doorbell, loop, dirty):
+        self.wid  = wid
+        self.cid  = _peer_sid % wid
+        self.ring = ring
+        self.doorbell = doorbell                # write end of the pipe waking "wid" up
+        self.loop  = loop
+        self.dirty = dirty                      # set of the queues flush_subs() flushes
+        self.pending = collections.deque()
+        self.retry = None                       # TimerHandle of the next retry
+        self.live_from = {}
+
+    def queue(self, parts, pub, bounded=True, priority=0, stamp=None):
+        self.send(parts, sum(len(p) for p in parts))
+
+    def send(self, parts, n):
+        """
+        Puts a record made of "parts" in the ring, or in "pending".
+        """
+        if _rec_len.size + n > self.ring.size:
+            print("Broker> Record of %d bytes larger than the ring to worker %d, dropped" %
+                  (n, self.wid))
+            return
+        if self.pending or not self.ring.put(parts, n):
+            self.pending.append(b''.join(parts))
+        self.dirty.add(self)
+
+    def flush_out(self):
+        pending = self.pending
+        while pending and self.ring.put((pending[0],), len(pending[0])):
+            pending.popleft()
+        if pending and self.retry is None:
+            self.retry = self.loop.call_later(_retry_secs, self.retry_pending)
+        try:
+            os.write(self.doorbell, b'\0')
+        except BlockingIOError:                 # rung enough already
+            pass
+
+    def retry_pending(self):
+        self.retry = None
+        self.flush_out()
+
+    def outstanding(self):
+        return len(self.pending)
+
+#------
+
+class PeerMember:
+    """
+    Member "sid" of consumer group "name" connected to worker "peer", in
+    the group kept by this worker: a message picked for it is sent to
+    "peer" as a "msg" frame flagged "_flag_member", for that member only.
+    "peer" may also be the SubProtocol of the link from another node of a
+    cluster (see cluster.SubLink).
+    """
+    binary = True
+    peer   = True
+    codec  = None
+    hdr    = False
+
+    def __init__(self, peer, name, sid):
+        self.worker = peer
+        self.ext    = bytes(name, msock._str_enc) + _member_sep + bytes(sid, msock._str_enc)
+        self.live_from = {}
+
+    def queue(self, parts, pub, bounded=True, priority=0, stamp=None):
+        cmd, flags, tpc, ext, payload = msock.decode_frame(b''.join(parts))
+        frame = msock.encode_frame('msg', tpc, payload, self.ext, _flag_member)
+        self.worker.queue((frame,), pub, bounded, priority)
+
+    def outstanding(self):
+        return self.worker.outstanding()
+
+#-------
+# Worker processes
+#-------
+
+class WorkerSet:
+    """
+    What "n" worker processes share, created before forking them:
+        rings     --> rings[src][dst], the Ring from worker src to worker dst
+        doorbells --> doorbells[dst], (read fd, write fd) of the pipe waking dst up
+    """
+
+    def __init__(self, n, ring_bytes):
+        self.n = n
+        self.rings = [[Ring(ring_bytes) if src != dst else None for dst in range(n)]
+                      for src in range(n)]
+        self.doorbells = [os.pipe() for _ in range(n)]
+        for r, w in self.doorbells:
+            os.set_blocking(r, False)
+            os.set_blocking(w, False)
+
+    def peers(self, wid, loop, dirty):
+        """
+        Returns:
+            [Peer, ..], the other workers as seen by worker "wid"
+        """
+        return [Peer(dst, self.rings[wid][dst], self.doorbells[dst][1], loop, dirty)
+                for dst in range(self.n) if dst != wid]
+
+    def inbox(self, wid):
+        """
+        Returns:
+            [(src, Ring), ..], the rings worker "wid" reads from
+        """
+        return [(src, self.rings[src][wid]) for src in range(self.n) if src != wid]
+
+    def close(self, unlink=False):
+        for rings in self.rings:
+            for ring in rings:
+                if ring is not None:
+                    ring.close(unlink)
+        for r, w in self.doorbells:
+            os.close(r)
+            os.close(w)
+
+#------
+
+def run(n, ring_bytes, target, args):
+    """
+    Runs "target(*args, worker_set, wid)" in "n" forked worker processes,
+    "worker_set" being their WorkerSet, until they exit, or until this
+    process is interrupted or terminated, which stops them.
+    """
+    worker_set = WorkerSet(n, ring_bytes)
+    ctx = multiprocessing.get_context('fork')
+    procs = [ctx.Process(target=run_worker, args=(target, args + (worker_set, wid)), daemon=True)
+             for wid in range(n)]
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for p in procs:
+            if p.pid is not None:
+                p.terminate()
+                p.join()
+        worker_set.close(unlink=True)
+
+#------
+
+def run_worker(target, args):
+    """
+    Runs a worker process, terminated by SIGTERM as the parent is not.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    target(*args)